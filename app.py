@@ -1,62 +1,1196 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, session, jsonify, g, has_app_context, has_request_context, Response, stream_with_context
+from flask import before_render_template, template_rendered
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from markupsafe import Markup
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.errors import PoolError
 import os
+import atexit
+import json
+import multiprocessing
+import queue
 import random
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
 import requests
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # 加载环境变量
 load_dotenv()
 
+import storage
+from storage import dialect
+
 # 创建Flask应用实例
 app = Flask(__name__)
 # 设置密钥用于session加密
 app.secret_key = os.getenv('SECRET_KEY', 'your_secret_key')
-
-# 存储验证码的字典
-verification_codes = {}
+# 前面有几层可信反向代理，大于 0 时按 X-Forwarded-For 取真实客户端地址
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
 
 # SMS API配置
 SMS_API_URL = "https://gyytz.market.alicloudapi.com/sms/smsSend"
 SMS_APPCODE = os.getenv('SMS_APPCODE')
 SMS_SIGN_ID = os.getenv('SMS_SIGN_ID')
 SMS_TEMPLATE_ID = os.getenv('SMS_TEMPLATE_ID')
+# 短信网关：alicloud（默认）或 stub（本地测试，只打印验证码）
+SMS_GATEWAY = os.getenv('SMS_GATEWAY', 'alicloud')
+# 短信发送配置
+SMS_CONNECT_TIMEOUT = float(os.getenv('SMS_CONNECT_TIMEOUT', 3))
+SMS_READ_TIMEOUT = float(os.getenv('SMS_READ_TIMEOUT', 5))
+SMS_MAX_RETRIES = int(os.getenv('SMS_MAX_RETRIES', 3))
+SMS_RETRY_BACKOFF = float(os.getenv('SMS_RETRY_BACKOFF', 0.5))
+SMS_WORKERS = int(os.getenv('SMS_WORKERS', 2))
+SMS_QUEUE_SIZE = int(os.getenv('SMS_QUEUE_SIZE', 1000))
+# 连续失败多少次后熔断，熔断多久后放行一次试探请求（秒）
+SMS_BREAKER_THRESHOLD = int(os.getenv('SMS_BREAKER_THRESHOLD', 5))
+SMS_BREAKER_RESET_TIMEOUT = float(os.getenv('SMS_BREAKER_RESET_TIMEOUT', 30))
+
+# 验证码配置
+# 验证码有效期（秒）
+SMS_CODE_TTL = int(os.getenv('SMS_CODE_TTL', 300))
+# 同一手机号两次发送的最短间隔（秒）
+SMS_RESEND_INTERVAL = int(os.getenv('SMS_RESEND_INTERVAL', 60))
+# 验证码存储：memory（单进程，默认）或 sqlite（多进程共享）
+VERIFICATION_CODE_STORE = os.getenv('VERIFICATION_CODE_STORE', 'memory')
+VERIFICATION_CODE_DB = os.getenv('VERIFICATION_CODE_DB', 'verification_codes.db')
+VERIFICATION_CODE_MAX_ENTRIES = int(os.getenv('VERIFICATION_CODE_MAX_ENTRIES', 100000))
+
+# 内存验证码存储，过期条目在写入时淘汰，条目数有上限
+class MemoryCodeStore:
+    def __init__(self, max_entries=100000):
+        self._max_entries = max_entries
+        # phone -> 验证码信息，按最后写入时间排序
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while self._entries:
+            phone, entry = next(iter(self._entries.items()))
+            if entry['evict_time'] > now and len(self._entries) <= self._max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def _touch(self, phone, entry):
+        entry['evict_time'] = max(entry['expire_time'], (entry['last_send_time'] or 0) + SMS_RESEND_INTERVAL)
+        self._entries[phone] = entry
+        self._entries.move_to_end(phone)
+
+    # 原子地检查发送频率并占用本次发送，频繁发送时返回 False
+    def reserve_send(self, phone, interval):
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            entry = self._entries.get(phone)
+            if entry and entry['last_send_time'] and now - entry['last_send_time'] < interval:
+                return False
+            entry = entry or {'code': None, 'expire_time': 0}
+            entry['last_send_time'] = now
+            self._touch(phone, entry)
+            return True
+
+    # 发送失败时撤销占用，允许立即重试
+    def release_send(self, phone):
+        with self._lock:
+            entry = self._entries.get(phone)
+            if entry:
+                entry['last_send_time'] = None
+
+    def save(self, phone, code, ttl):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(phone) or {'last_send_time': now}
+            entry['code'] = code
+            entry['expire_time'] = now + ttl
+            self._touch(phone, entry)
+            self._prune(now)
+
+    # 校验验证码：没有验证码返回 None，错误或过期返回 False，成功返回 True（验证码随即作废）
+    def verify(self, phone, code):
+        with self._lock:
+            entry = self._entries.get(phone)
+            if not entry or not entry['code']:
+                return None
+            if time.time() > entry['expire_time'] or code != entry['code']:
+                return False
+            entry['code'] = None
+            return True
+
+# SQLite验证码存储，多个工作进程共享同一个数据库文件
+class SQLiteCodeStore:
+    def __init__(self, path, max_entries=100000):
+        self._path = path
+        self._max_entries = max_entries
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS verification_codes (
+                phone TEXT PRIMARY KEY,
+                code TEXT,
+                expire_time REAL NOT NULL DEFAULT 0,
+                last_send_time REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_expire ON verification_codes(expire_time)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _prune(self, conn, now):
+        conn.execute('''
+            DELETE FROM verification_codes
+            WHERE expire_time < ? AND (last_send_time IS NULL OR last_send_time < ?)
+        ''', (now, now - SMS_RESEND_INTERVAL))
+        conn.execute('''
+            DELETE FROM verification_codes WHERE phone IN (
+                SELECT phone FROM verification_codes
+                ORDER BY expire_time DESC
+                LIMIT -1 OFFSET ?
+            )
+        ''', (self._max_entries,))
+
+    def reserve_send(self, phone, interval):
+        now = time.time()
+        conn = self._connect()
+        # 单条 upsert 完成检查和占用，多进程下也是原子的
+        cursor = conn.execute('''
+            INSERT INTO verification_codes (phone, last_send_time) VALUES (?, ?)
+            ON CONFLICT(phone) DO UPDATE SET last_send_time = excluded.last_send_time
+            WHERE last_send_time IS NULL OR last_send_time <= ?
+        ''', (phone, now, now - interval))
+        return cursor.rowcount > 0
+
+    def release_send(self, phone):
+        self._connect().execute('UPDATE verification_codes SET last_send_time = NULL WHERE phone = ?', (phone,))
+
+    def save(self, phone, code, ttl):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('''
+            INSERT INTO verification_codes (phone, code, expire_time, last_send_time) VALUES (?, ?, ?, ?)
+            ON CONFLICT(phone) DO UPDATE SET code = excluded.code, expire_time = excluded.expire_time
+        ''', (phone, code, now + ttl, now))
+        self._prune(conn, now)
+
+    def verify(self, phone, code):
+        conn = self._connect()
+        row = conn.execute('SELECT code, expire_time FROM verification_codes WHERE phone = ?', (phone,)).fetchone()
+        if not row or not row[0]:
+            return None
+        if time.time() > row[1] or code != row[0]:
+            return False
+        # 只有一个请求能作废成功，防止同一验证码被并发使用两次
+        cursor = conn.execute('UPDATE verification_codes SET code = NULL WHERE phone = ? AND code = ?', (phone, code))
+        return cursor.rowcount > 0
+
+def create_code_store():
+    if VERIFICATION_CODE_STORE == 'sqlite':
+        return SQLiteCodeStore(VERIFICATION_CODE_DB, VERIFICATION_CODE_MAX_ENTRIES)
+    return MemoryCodeStore(VERIFICATION_CODE_MAX_ENTRIES)
+
+# 存储验证码
+verification_codes = create_code_store()
+
+# MySQL配置（存储后端见 storage.py，DB_BACKEND=sqlite 时不需要）
+MYSQL_CONFIG = storage.MYSQL_CONFIG
+
+# 性能监控配置
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# /metrics 与 /pool_stats 的访问令牌（Authorization: Bearer <token>），未配置时只允许本机访问
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# 慢查询阈值（毫秒），超过后输出结构化日志，0 表示不记录
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', 200))
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 进程内指标注册表，按 Prometheus 文本格式输出
+class Metrics:
+    def __init__(self, buckets=METRICS_BUCKETS, enabled=True):
+        self._buckets = buckets
+        self.enabled = enabled
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            data = series.get(key)
+            if data is None:
+                # 各桶计数、总和、总数
+                data = series[key] = [[0] * len(self._buckets), 0.0, 0]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+    # 输出 Prometheus 文本格式，gauges / counters 为外部采集的 [(名称, 值, 标签字典)]
+    def render(self, gauges=(), counters=()):
+        lines = []
+        with self._lock:
+            histograms = {name: {k: (list(v[0]), v[1], v[2]) for k, v in series.items()}
+                          for name, series in self._histograms.items()}
+            registered = {name: dict(series) for name, series in self._counters.items()}
+        for name, series in sorted(histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for labels, (buckets, total, count) in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets, buckets):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{self._format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{self._format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {total}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+        for name, series in sorted(registered.items()):
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in series.items():
+                lines.append(f'{name}{self._format_labels(labels)} {value}')
+        for kind, samples in (('counter', counters), ('gauge', gauges)):
+            names = set()
+            for name, value, labels in samples:
+                if name not in names:
+                    lines.append(f'# TYPE {name} {kind}')
+                    names.add(name)
+                lines.append(f'{name}{self._format_labels(self._key(labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(enabled=METRICS_ENABLED)
+
+# 把 stats() 字典拆成 (计数器, 仪表)：单调递增的项加 _total 后缀按 counter 导出
+def split_stats(prefix, stats, monotonic):
+    counters, gauges = [], []
+    for name, value in stats.items():
+        if name in monotonic:
+            counters.append((f"{prefix}{name.removesuffix('_total')}_total", value, {}))
+        else:
+            gauges.append((prefix + name, value, {}))
+    return counters, gauges
+
+# 运维接口鉴权：配置了 METRICS_TOKEN 时校验 Bearer 令牌，否则只允许回环地址
+def metrics_access_allowed(remote_addr, authorization):
+    if METRICS_TOKEN:
+        scheme, _, token = (authorization or '').partition(' ')
+        return scheme.lower() == 'bearer' and secrets.compare_digest(token.strip(), METRICS_TOKEN)
+    return remote_addr in ('127.0.0.1', '::1', 'localhost')
+
+# SQL 指纹：去掉字面量和多余空白，IN 列表合并，相同结构的语句归为一类
+@lru_cache(maxsize=1024)
+def sql_fingerprint(sql):
+    fingerprint = re.sub(r"'(?:[^'\\]|\\.|'')*'", '?', sql)
+    fingerprint = re.sub(r'\b\d+\b', '?', fingerprint)
+    fingerprint = fingerprint.replace('%s', '?')
+    fingerprint = re.sub(r'\s+', ' ', fingerprint).strip()
+    fingerprint = re.sub(r'\(\?(?:\s*,\s*\?)+\)', '(?+)', fingerprint)
+    fingerprint = re.sub(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+', '(?+)+', fingerprint)
+    return fingerprint
+
+def current_endpoint():
+    if has_request_context():
+        return request.endpoint or ''
+    return ''
+
+# 记录查询耗时的游标包装，其余属性透传给原始游标
+class InstrumentedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._fingerprint = ''
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        self._fingerprint = sql_fingerprint(operation)
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.observe('db_query_duration_seconds', duration, query=self._fingerprint)
+            if SLOW_QUERY_THRESHOLD_MS and duration * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+                rowcount = self._cursor.rowcount
+                app.logger.warning(json.dumps({
+                    'event': 'slow_query',
+                    'query': self._fingerprint,
+                    'duration_ms': round(duration * 1000, 2),
+                    'rows': rowcount if rowcount is not None and rowcount >= 0 else None,
+                    'endpoint': current_endpoint()
+                }, ensure_ascii=False))
 
-# MySQL配置
-MYSQL_CONFIG = {
-    'host': os.getenv('MYSQL_HOST'),
-    'user': os.getenv('MYSQL_USER'),
-    'password': os.getenv('MYSQL_PASSWORD')
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            metrics.inc('db_query_rows_total', 1, query=self._fingerprint)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        metrics.inc('db_query_rows_total', len(rows), query=self._fingerprint)
+        return rows
+
+# 连接池配置
+DB_POOL_CONFIG = {
+    'size': int(os.getenv('MYSQL_POOL_SIZE', 10)),
+    # 借出连接的最长等待时间（秒）
+    'timeout': float(os.getenv('MYSQL_POOL_TIMEOUT', 5)),
+    # 连接最长存活时间（秒），超过后回收重建
+    'max_lifetime': float(os.getenv('MYSQL_POOL_MAX_LIFETIME', 1800)),
+    # 空闲超过该时间的连接在借出前做一次健康检查（秒）
+    'ping_interval': float(os.getenv('MYSQL_POOL_PING_INTERVAL', 30))
 }
 
+# 连接池中的一条物理连接
+class _PoolEntry:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+# 借出的连接，close() 时归还连接池而不是真正断开
+class PooledConnection:
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise PoolError('连接已归还连接池')
+        return getattr(self._entry.conn, name)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self.__getattr__('cursor')(*args, **kwargs)
+        return InstrumentedCursor(cursor) if METRICS_ENABLED else cursor
+
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool.release(entry)
+
+# 数据库连接池，connect 为创建一条物理连接的函数（由存储后端提供）
+class ConnectionPool:
+    MONOTONIC_STATS = ('checkouts', 'waits', 'wait_time_total', 'timeouts', 'created', 'recycled', 'broken')
+
+    def __init__(self, connect, size=10, timeout=5, max_lifetime=1800, ping_interval=30):
+        self._connect_fn = connect
+        self._size = size
+        self._timeout = timeout
+        self._max_lifetime = max_lifetime
+        self._ping_interval = ping_interval
+        self._idle = deque()
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'broken': 0
+        }
+
+    def _connect(self):
+        conn = self._connect_fn()
+        with self._cond:
+            self._stats['created'] += 1
+        return _PoolEntry(conn)
+
+    def _discard(self, entry, reason):
+        try:
+            entry.conn.close()
+        except Error:
+            pass
+        with self._cond:
+            self._open -= 1
+            self._stats[reason] += 1
+            self._cond.notify()
+
+    # 借出前检查连接：超过最长存活时间则回收，空闲过久则 ping 一次
+    def _is_usable(self, entry):
+        now = time.monotonic()
+        if now - entry.created_at > self._max_lifetime:
+            self._discard(entry, 'recycled')
+            return False
+        if now - entry.last_used > self._ping_interval:
+            try:
+                entry.conn.ping(reconnect=False)
+            except Error:
+                self._discard(entry, 'broken')
+                return False
+        return True
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self._timeout
+        waited = False
+        while True:
+            entry = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._open < self._size:
+                        self._open += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolError(f'等待数据库连接超时（{self._timeout}秒）')
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if entry is None:
+                try:
+                    entry = self._connect()
+                except Error:
+                    with self._cond:
+                        self._open -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_usable(entry):
+                continue
+
+            wait_time = time.monotonic() - start
+            with self._cond:
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+            return PooledConnection(self, entry)
+
+    def release(self, entry):
+        # 回滚未提交的事务，避免把事务状态和旧快照带给下一个请求
+        try:
+            entry.conn.rollback()
+        except Error:
+            self._discard(entry, 'broken')
+            return
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['open'] = self._open
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._open - len(self._idle)
+        return stats
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = ConnectionPool(dialect.connect, **DB_POOL_CONFIG)
+    return db_pool
+
 def get_db_connection():
+    start = time.perf_counter()
     try:
-        # 首先创建数据库连接（不指定数据库）
-        conn = mysql.connector.connect(**MYSQL_CONFIG)
+        conn = get_db_pool().acquire()
+    except Error as e:
+        metrics.inc('db_connection_errors_total', endpoint=current_endpoint())
+        print(f"数据库连接错误: {e}")
+        return None
+    metrics.observe('db_connection_acquire_seconds', time.perf_counter() - start)
+    # 记录本次请求借出的连接，请求结束时统一归还，防止提前返回的路由泄漏连接
+    if has_app_context():
+        g.setdefault('db_connections', []).append(conn)
+    return conn
+
+@app.teardown_appcontext
+def release_db_connections(exception):
+    for conn in g.pop('db_connections', []):
+        conn.close()
+
+# 进程内缓存：按最近使用淘汰，超过有效期自动失效
+class TTLCache:
+    def __init__(self, ttl, maxsize=1024):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expire_time = item
+            if expire_time < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self._ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# 读写分离：配置了只读副本（DB_REPLICAS）时，列表、历史记录等只读查询发往副本，写入和其余查询走主库
+# 复制进度用心跳表测量：主库定时写入当前时间，副本上读到的心跳时间就是副本已应用到的主库时间点
+# 本地验证可以用两个 SQLite 文件：DB_BACKEND=sqlite DB_REPLICAS=replica.db，用 sqlite3 的备份 API
+# 把主库复制到副本文件（见 tests/test_replicas.py）
+# 延迟超过该值（秒）的副本不再接收读请求
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))
+REPLICA_HEARTBEAT_INTERVAL = float(os.getenv('REPLICA_HEARTBEAT_INTERVAL', 1))
+
+# 一个只读副本：独立的连接池和最近一次探测到的复制进度
+class Replica:
+    def __init__(self, target):
+        self.target = target
+        self.pool = ConnectionPool(lambda: dialect.connect(target), **DB_POOL_CONFIG)
+        # 副本已应用到的主库心跳时间，探测失败或连接失败时为 None，不参与路由
+        self.applied_at = None
+
+    def lag(self):
+        if self.applied_at is None:
+            return None
+        return max(0.0, time.time() - self.applied_at)
+
+    def probe(self):
+        try:
+            conn = self.pool.acquire()
+        except Error:
+            self.applied_at = None
+            return
         cursor = conn.cursor()
-        
-        # 创建数据库（如果不存在）
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {os.getenv('MYSQL_DATABASE')}")
+        try:
+            cursor.execute('SELECT beat FROM replication_heartbeat WHERE id = 1')
+            row = cursor.fetchone()
+            self.applied_at = float(row[0]) if row else None
+        except Error:
+            self.applied_at = None
+        finally:
+            cursor.close()
+            conn.close()
+
+class ReplicaSet:
+    def __init__(self, targets, max_lag):
+        self._replicas = [Replica(target) for target in targets]
+        self._max_lag = max_lag
+
+    def __bool__(self):
+        return bool(self._replicas)
+
+    # 在复制进度不早于 since、延迟不超过上限的副本中随机选一个分摊负载，都不满足时返回 None
+    def choose(self, since=0):
+        now = time.time()
+        candidates = [r for r in self._replicas
+                      if r.applied_at is not None and r.applied_at >= since and now - r.applied_at <= self._max_lag]
+        return random.choice(candidates) if candidates else None
+
+    def probe(self):
+        for replica in self._replicas:
+            replica.probe()
+
+    def stats(self):
+        return [(replica.target, replica.lag()) for replica in self._replicas]
+
+replica_set = ReplicaSet(storage.DB_REPLICAS, REPLICA_MAX_LAG)
+
+# 主库写入心跳，多个进程同时写时只保留最大值
+def write_replication_heartbeat():
+    conn = get_db_connection()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'UPDATE replication_heartbeat SET beat = {dialect.greatest}(beat, %s) WHERE id = 1',
+                       (time.time(),))
+        conn.commit()
+    except Error as e:
+        print(f"复制心跳写入错误: {e}")
+    finally:
         cursor.close()
-        
-        # 关闭连接
         conn.close()
+
+def run_replica_monitor():
+    while True:
+        write_replication_heartbeat()
+        replica_set.probe()
+        time.sleep(REPLICA_HEARTBEAT_INTERVAL)
+
+# 读取栅栏：key -> 主库时间点。缓存失效后重新加载时只读复制进度已追上失效时间点的副本，
+# 避免把副本上的旧数据重新放进缓存；超过最大延迟后所有可用副本都已追上，条目自然过期
+read_fences = TTLCache(REPLICA_MAX_LAG, maxsize=100000)
+
+def set_read_fence(key):
+    if replica_set:
+        read_fences.set(key, time.time())
+
+# 读己之写：本会话刚写过主库，之后的读取只发往复制进度已追上这次写入的副本，追不上时读主库
+# 批量写入只入队就返回时提交时间未知，按最长确认等待时间估计
+# 写入时间点放在单独的 cookie 里（不写会话存储），任何进程处理后续请求都能读到；
+# 它只影响本人的读取路由，被篡改也只会让自己多读主库或读到稍旧的数据
+READ_AFTER_COOKIE = 'read_after'
+
+def note_write():
+    if replica_set:
+        delay = WRITE_PIPELINE_ACK_TIMEOUT if WRITE_PIPELINE_ENABLED and WRITE_PIPELINE_ACK == 'enqueue' else 0
+        g.read_after = time.time() + delay
+
+def read_after_cookie():
+    try:
+        return float(request.cookies.get(READ_AFTER_COOKIE, 0))
+    except ValueError:
+        return 0
+
+# cookie 的值和属性，异步服务（async_app.py）写入后设置同一个 cookie
+def read_after_cookie_value(read_after):
+    max_age = int(read_after - time.time() + REPLICA_MAX_LAG) + 1
+    return f'{read_after:.3f}', {'max_age': max_age, 'httponly': True, 'samesite': 'Lax'}
+
+@app.after_request
+def set_read_after_cookie(response):
+    read_after = g.pop('read_after', None)
+    if read_after is not None:
+        value, options = read_after_cookie_value(read_after)
+        response.set_cookie(READ_AFTER_COOKIE, value, **options)
+    return response
+
+# 获取只读连接：没有满足要求的副本或副本连接失败时退回主库，归还方式与 get_db_connection 相同
+# fences 为本次读取要重新加载的缓存对应的栅栏
+def get_read_connection(*fences):
+    if not replica_set:
+        return get_db_connection()
+    since = max((read_fences.get(fence, 0) for fence in fences), default=0)
+    if has_request_context():
+        since = max(since, read_after_cookie(), g.get('read_after', 0))
+    replica = replica_set.choose(since)
+    if replica is None:
+        metrics.inc('db_reads_total', target='primary')
+        return get_db_connection()
+    try:
+        conn = replica.pool.acquire()
+    except Error as e:
+        # 在下一次探测成功之前不再选这个副本
+        replica.applied_at = None
+        print(f"只读副本连接错误（{replica.target}）: {e}")
+        metrics.inc('db_reads_total', target='primary')
+        return get_db_connection()
+    metrics.inc('db_reads_total', target='replica')
+    if has_app_context():
+        g.setdefault('db_connections', []).append(conn)
+    return conn
+
+# 会话配置
+# 会话存储：sqlite（默认，多进程共享）或 memory（单进程，重启后需要重新登录）
+SESSION_STORE = os.getenv('SESSION_STORE', 'sqlite')
+SESSION_DB = os.getenv('SESSION_DB', 'sessions.db')
+# 服务端会话有效期（秒），剩余不到一半时在请求结束时自动续期
+SESSION_LIFETIME = int(os.getenv('SESSION_LIFETIME', 7 * 24 * 3600))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 100000))
+# 进程内会话缓存：其他进程注销的会话最多在这段时间（秒）内仍可能被本进程认为有效
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 5))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+
+# 内存会话存储，按最近使用淘汰，条目数有上限
+class MemorySessionStore:
+    def __init__(self, max_entries=100000):
+        self._max_entries = max_entries
+        # sid -> (序列化后的会话数据, 过期时间)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return entry
+
+    def save(self, sid, user_id, data, expire_time):
+        with self._lock:
+            self._entries[sid] = (data, expire_time)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+# SQLite会话存储，多个工作进程共享同一个数据库文件
+class SQLiteSessionStore:
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                user_id INTEGER,
+                data TEXT NOT NULL,
+                expire_time REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expire ON sessions(expire_time)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        return self._connect().execute(
+            'SELECT data, expire_time FROM sessions WHERE sid = ? AND expire_time > ?', (sid, time.time())
+        ).fetchone()
+
+    def save(self, sid, user_id, data, expire_time):
+        conn = self._connect()
+        conn.execute('''
+            INSERT INTO sessions (sid, user_id, data, expire_time) VALUES (?, ?, ?, ?)
+            ON CONFLICT(sid) DO UPDATE SET
+                user_id = excluded.user_id, data = excluded.data, expire_time = excluded.expire_time
+        ''', (sid, user_id, data, expire_time))
+        conn.execute('DELETE FROM sessions WHERE expire_time <= ?', (time.time(),))
+
+    def delete(self, sid):
+        self._connect().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+# 在共享存储前面加一层进程内 LRU 缓存，已登录用户的请求大多不需要访问存储
+class CachedSessionStore:
+    def __init__(self, store, ttl, maxsize):
+        self._store = store
+        self._cache = TTLCache(ttl, maxsize)
+
+    def get(self, sid):
+        entry = self._cache.get(sid)
+        if entry is None:
+            entry = self._store.get(sid)
+            if entry is not None:
+                self._cache.set(sid, tuple(entry))
+        return entry
+
+    def save(self, sid, user_id, data, expire_time):
+        self._store.save(sid, user_id, data, expire_time)
+        self._cache.set(sid, (data, expire_time))
+
+    def delete(self, sid):
+        self._store.delete(sid)
+        self._cache.delete(sid)
+
+def create_session_store():
+    if SESSION_STORE == 'memory':
+        return MemorySessionStore(SESSION_MAX_ENTRIES)
+    return CachedSessionStore(SQLiteSessionStore(SESSION_DB), SESSION_CACHE_TTL, SESSION_CACHE_SIZE)
+
+# 服务端会话：cookie 里只有随机的会话 id，数据保存在会话存储中
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expire_time=0):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expire_time = expire_time
+        # 登录时换发的新会话 id 生效后需要删除的旧 id
+        self.old_sid = None
+        self.modified = False
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    # 换发会话 id，防止登录前的会话 id 被人预先设置（会话固定攻击）
+    def regenerate(self):
+        if self.sid is not None:
+            self.old_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self._store = store
+
+    # 读取会话数据，会话不存在或已过期时返回 None
+    def load(self, sid):
+        entry = self._store.get(sid)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return self.serializer.loads(entry[0]), entry[1]
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        loaded = self.load(sid) if sid else None
+        if loaded is None:
+            return ServerSideSession()
+        data, expire_time = loaded
+        return ServerSideSession(data, sid, expire_time)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.old_sid:
+            self._store.delete(session.old_sid)
         
-        # 重新连接并指定数据库
-        config_with_db = MYSQL_CONFIG.copy()
-        config_with_db['database'] = os.getenv('MYSQL_DATABASE')
-        conn = mysql.connector.connect(**config_with_db)
+        # 会话被清空（退出登录）时从存储中删除，旧的会话 id 立即失效
+        if not session:
+            if session.modified and session.sid:
+                self._store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        
+        # 只在会话数据变化或需要续期时写存储，普通请求只读
+        now = time.time()
+        if not session.modified and session.expire_time - now > SESSION_LIFETIME / 2:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        session.expire_time = now + SESSION_LIFETIME
+        self._store.save(session.sid, session.get('user_id'), self.serializer.dumps(dict(session)),
+                         session.expire_time)
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain,
+                            path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+session_interface = ServerSideSessionInterface(create_session_store())
+app.session_interface = session_interface
+
+# 按会话 id 读取会话数据（供异步服务使用），无效时返回 None
+def load_session(sid):
+    loaded = session_interface.load(sid)
+    return loaded[0] if loaded else None
+
+# 实时推送配置
+PUSH_QUEUE_SIZE = int(os.getenv('PUSH_QUEUE_SIZE', 100))
+# 推送连接的心跳间隔（秒），防止代理断开空闲连接
+PUSH_HEARTBEAT_INTERVAL = float(os.getenv('PUSH_HEARTBEAT_INTERVAL', 15))
+# 推送事件的分发方式：memory（只分发给本进程的订阅者，默认）或 sqlite（事件写入共享的数据库文件，
+# 同一台机器上的所有进程，包括多个工作进程和异步服务 async_app.py，各自轮询后分发给自己的订阅者）
+PUSH_BACKEND = os.getenv('PUSH_BACKEND', 'memory')
+PUSH_DB = os.getenv('PUSH_DB', 'push_events.db')
+# 轮询间隔（秒），即跨进程推送的最大额外延迟
+PUSH_POLL_INTERVAL = float(os.getenv('PUSH_POLL_INTERVAL', 0.05))
+# 事件在共享文件中保留的时间（秒）
+PUSH_EVENT_RETENTION = 60
+
+# 进程内分发：发布时直接调用监听者
+class MemoryPushBus:
+    def __init__(self):
+        self._listeners = []
+
+    def listen(self, callback):
+        self._listeners.append(callback)
+
+    def start(self):
+        pass
+
+    def publish(self, user_ids, event_type, data):
+        for callback in self._listeners:
+            callback(user_ids, event_type, data)
+
+# SQLite 共享分发：发布时追加一行事件，后台线程按 id 顺序读取新事件并调用本进程的监听者
+# SQLite 同一时刻只有一个写入者，id 按提交顺序分配，读取方按 id 递增读取不会漏掉事件
+class SQLitePushBus:
+    def __init__(self, path, poll_interval):
+        self._path = path
+        self._poll_interval = poll_interval
+        self._local = threading.local()
+        self._listeners = []
+        self._thread = None
+        self._lock = threading.Lock()
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS push_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_ids TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
         return conn
-    except Error as e:
-        print(f"数据库连接错误: {e}")
-        return None
+
+    def listen(self, callback):
+        self._listeners.append(callback)
+
+    # 启动轮询线程（多次调用只启动一次），只分发启动之后发布的事件
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                last_id = self._connect().execute('SELECT COALESCE(MAX(id), 0) FROM push_events').fetchone()[0]
+                self._thread = threading.Thread(target=self._run, args=(last_id,), name='push-bus', daemon=True)
+                self._thread.start()
+
+    def publish(self, user_ids, event_type, data):
+        self._connect().execute(
+            'INSERT INTO push_events (user_ids, event_type, data, created_at) VALUES (?, ?, ?, ?)',
+            (json.dumps(list(user_ids)), event_type, json.dumps(data, ensure_ascii=False), time.time()))
+
+    def _run(self, last_id):
+        conn = self._connect()
+        pruned_at = 0
+        while True:
+            rows = []
+            try:
+                rows = conn.execute('''
+                    SELECT id, user_ids, event_type, data FROM push_events
+                    WHERE id > ? ORDER BY id LIMIT 1000
+                ''', (last_id,)).fetchall()
+                now = time.time()
+                if now - pruned_at > PUSH_EVENT_RETENTION:
+                    conn.execute('DELETE FROM push_events WHERE created_at < ?', (now - PUSH_EVENT_RETENTION,))
+                    pruned_at = now
+            except sqlite3.Error as e:
+                print(f"推送事件读取错误: {e}")
+            for event_id, user_ids, event_type, data in rows:
+                last_id = event_id
+                user_ids, data = json.loads(user_ids), json.loads(data)
+                for callback in self._listeners:
+                    try:
+                        callback(user_ids, event_type, data)
+                    except Exception as e:
+                        print(f"推送事件分发错误: {e}")
+            if not rows:
+                time.sleep(self._poll_interval)
+
+def create_push_bus():
+    if PUSH_BACKEND == 'sqlite':
+        return SQLitePushBus(PUSH_DB, PUSH_POLL_INTERVAL)
+    return MemoryPushBus()
+
+push_bus = create_push_bus()
+
+# 一个推送连接（一个浏览器标签页）的事件队列
+class _Subscriber:
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        # 队列满时丢弃事件并置位，客户端收到 resync 后通过历史接口补齐
+        self.overflowed = False
+
+# 发布/订阅中心，按用户 id 分发事件：发布经由 push_bus，收到的事件分发给本进程的订阅者
+class MessageHub:
+    def __init__(self, queue_size=100, bus=None):
+        self._queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._bus = bus or MemoryPushBus()
+        self._bus.listen(self._deliver)
+
+    def subscribe(self, user_id):
+        self._bus.start()
+        subscriber = _Subscriber(self._queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_ids, event_type, data):
+        self._bus.publish(user_ids, event_type, data)
+
+    def _deliver(self, user_ids, event_type, data):
+        event = (event_type, data)
+        with self._lock:
+            targets = [sub for user_id in user_ids for sub in self._subscribers.get(user_id, ())]
+        for subscriber in targets:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                subscriber.overflowed = True
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._subscribers
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+message_hub = MessageHub(PUSH_QUEUE_SIZE, push_bus)
+
+def format_sse(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # 数据库初始化函数
+# 用现有数据重新计算群组的成员数、最近活跃时间和最后一条消息摘要（先定位最后一条消息，再取它的内容）
+def recompute_group_summaries(cursor):
+    cursor.execute('''
+        UPDATE `groups`
+        SET member_count = (SELECT COUNT(*) FROM group_members gm WHERE gm.group_id = `groups`.id),
+            last_message_id = (SELECT MAX(m.id) FROM group_messages m WHERE m.group_id = `groups`.id)
+    ''')
+    cursor.execute(f'''
+        UPDATE `groups`
+        SET last_message_at = (SELECT m.created_at FROM group_messages m WHERE m.id = `groups`.last_message_id),
+            last_sender_id = (SELECT m.sender_id FROM group_messages m WHERE m.id = `groups`.last_message_id),
+            last_message_preview = (SELECT SUBSTR(m.content, 1, {storage.CONVERSATION_PREVIEW_LENGTH})
+                                    FROM group_messages m WHERE m.id = `groups`.last_message_id)
+    ''')
+
+# 按现有成员数确定群组投递方式，并为写扩散群组补齐已读水位之后的未读指针
+def backfill_group_inbox(cursor):
+    cursor.execute('UPDATE `groups` SET fanout_on_read = TRUE WHERE member_count > %s',
+                   (GROUP_FANOUT_MAX_MEMBERS,))
+    cursor.execute(f'''
+        {dialect.insert_ignore} INTO group_inbox (user_id, group_id, message_id)
+        SELECT gm.user_id, gm.group_id, m.id
+        FROM group_members gm
+        JOIN `groups` g ON g.id = gm.group_id
+        JOIN group_messages m ON m.group_id = gm.group_id AND m.id > gm.last_read_id
+                             AND m.sender_id <> gm.user_id
+        WHERE NOT g.fanout_on_read
+    ''')
+
+# 用旧的 is_read 标记换算已读水位：第一条未读消息之前的都算已读，已有水位的会话不变
+def backfill_conversation_reads(cursor):
+    cursor.execute(f'''
+        {dialect.insert_ignore} INTO conversation_reads (user_id, peer_id, last_read_id)
+        SELECT receiver_id, sender_id, COALESCE(MIN(CASE WHEN is_read = FALSE THEN id END) - 1, MAX(id))
+        FROM messages
+        GROUP BY receiver_id, sender_id
+    ''')
+
+# 用现有消息补齐会话摘要：每个会话取两个方向中 id 最大的一条
+def backfill_conversation_summaries(cursor):
+    cursor.execute(f'''
+        INSERT INTO conversation_summaries
+            (user_id, peer_id, last_message_id, last_sender_id, last_message_preview, last_message_at)
+        SELECT c.user_id, c.peer_id, m.id, m.sender_id, SUBSTR(m.content, 1, {storage.CONVERSATION_PREVIEW_LENGTH}), m.created_at
+        FROM (
+            SELECT user_id, peer_id, MAX(id) AS id FROM (
+                SELECT sender_id AS user_id, receiver_id AS peer_id, MAX(id) AS id
+                FROM messages GROUP BY sender_id, receiver_id
+                UNION ALL
+                SELECT receiver_id, sender_id, MAX(id)
+                FROM messages GROUP BY receiver_id, sender_id
+            ) d GROUP BY user_id, peer_id
+        ) c
+        JOIN messages m ON m.id = c.id
+        WHERE 1 = 1
+        {storage.conversation_summary_conflict()}
+    ''')
+
+# 重算所有冗余数据：直接向表里批量导入数据（例如基准测试写入测试数据）之后调用
+def rebuild_derived_data():
+    conn = get_db_connection()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    try:
+        recompute_group_summaries(cursor)
+        backfill_conversation_reads(cursor)
+        backfill_group_inbox(cursor)
+        backfill_conversation_summaries(cursor)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    reconcile_unread_counters()
+
 def init_db():
     try:
+        # 创建数据库（如果不存在），只在启动时执行一次；SQLite 数据库文件在第一次连接时创建
+        dialect.create_database()
+
         conn = get_db_connection()
         if conn is None:
             return
@@ -64,144 +1198,617 @@ def init_db():
         cursor = conn.cursor()
         
         # 创建用户表
-        cursor.execute('''
+        cursor.execute(dialect.ddl('''
             CREATE TABLE IF NOT EXISTS users (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+                id {pk},
                 username VARCHAR(255) UNIQUE NOT NULL,
                 password VARCHAR(255) NOT NULL,
                 phone VARCHAR(20) UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT {now}
             )
-        ''')
+        '''))
         
         # 创建群组表
-        cursor.execute('''
+        cursor.execute(dialect.ddl('''
             CREATE TABLE IF NOT EXISTS `groups` (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+                id {pk},
                 name VARCHAR(255) NOT NULL,
                 description TEXT,
                 created_by INT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT {now},
+                member_count INT NOT NULL DEFAULT 0,
+                last_message_at TIMESTAMP NULL DEFAULT NULL,
+                last_message_id INT NULL DEFAULT NULL,
+                last_sender_id INT NULL DEFAULT NULL,
+                last_message_preview VARCHAR(100) NULL DEFAULT NULL,
+                fanout_on_read BOOLEAN NOT NULL DEFAULT FALSE,
                 FOREIGN KEY (created_by) REFERENCES users(id)
             )
-        ''')
+        '''))
         
         # 创建群组成员表
-        cursor.execute('''
+        cursor.execute(dialect.ddl('''
             CREATE TABLE IF NOT EXISTS group_members (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+                id {pk},
                 group_id INT NOT NULL,
                 user_id INT NOT NULL,
-                role ENUM('admin', 'member') DEFAULT 'member',
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                role {role} DEFAULT 'member',
+                joined_at TIMESTAMP DEFAULT {now},
+                last_read_id INT NOT NULL DEFAULT 0,
                 FOREIGN KEY (group_id) REFERENCES `groups`(id),
                 FOREIGN KEY (user_id) REFERENCES users(id),
-                UNIQUE KEY unique_group_member (group_id, user_id)
+                CONSTRAINT unique_group_member UNIQUE (group_id, user_id)
             )
-        ''')
+        '''))
         
         # 创建群组消息表
-        cursor.execute('''
+        cursor.execute(dialect.ddl('''
             CREATE TABLE IF NOT EXISTS group_messages (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+                id {pk},
                 group_id INT NOT NULL,
                 sender_id INT NOT NULL,
                 content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT {now},
                 FOREIGN KEY (group_id) REFERENCES `groups`(id),
                 FOREIGN KEY (sender_id) REFERENCES users(id)
             )
-        ''')
+        '''))
         
         # 创建评论表
-        cursor.execute('''
+        cursor.execute(dialect.ddl('''
             CREATE TABLE IF NOT EXISTS comments (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+                id {pk},
                 user_id INT NOT NULL,
                 content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT {now},
                 FOREIGN KEY (user_id) REFERENCES users(id)
             )
-        ''')
+        '''))
         
         # 创建私聊消息表
-        cursor.execute('''
+        cursor.execute(dialect.ddl('''
             CREATE TABLE IF NOT EXISTS messages (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+                id {pk},
                 sender_id INT NOT NULL,
                 receiver_id INT NOT NULL,
                 content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT {now},
                 is_read BOOLEAN DEFAULT FALSE,
                 FOREIGN KEY (sender_id) REFERENCES users(id),
                 FOREIGN KEY (receiver_id) REFERENCES users(id)
             )
+        '''))
+        
+        # 为已有数据库补充新增的列（列已存在时忽略错误）
+        # 每项为 (加列语句, 加列成功后执行的回填语句)
+        columns = [
+            # 群组成员数和最近活跃时间，用于群组排序
+            ('ALTER TABLE `groups` ADD COLUMN member_count INT NOT NULL DEFAULT 0', None),
+            ('ALTER TABLE `groups` ADD COLUMN last_message_at TIMESTAMP NULL DEFAULT NULL', None),
+            # 群组最后一条消息的摘要，用于会话列表
+            ('''ALTER TABLE `groups` ADD COLUMN last_message_id INT NULL DEFAULT NULL,
+                ADD COLUMN last_sender_id INT NULL DEFAULT NULL,
+                ADD COLUMN last_message_preview VARCHAR(100) NULL DEFAULT NULL''', None),
+            # 群组投递方式：大群改为读扩散
+            ('ALTER TABLE `groups` ADD COLUMN fanout_on_read BOOLEAN NOT NULL DEFAULT FALSE', None),
+            # 群聊已读水位：成员已读到的最大群消息 id，老成员视为已读完现有消息
+            ('ALTER TABLE group_members ADD COLUMN last_read_id INT NOT NULL DEFAULT 0', '''
+                UPDATE group_members gm
+                SET gm.last_read_id = (SELECT COALESCE(MAX(m.id), 0) FROM group_messages m WHERE m.group_id = gm.group_id)
+            ''')
+        ]
+        groups_migrated = False
+        for statement, backfill in columns:
+            try:
+                cursor.execute(statement)
+            except Error as e:
+                continue
+            groups_migrated = groups_migrated or 'TABLE `groups`' in statement
+            if backfill:
+                cursor.execute(backfill)
+        
+        # 群组表加了冗余列时用现有数据计算一次，之后由写入路径维护，不在每次启动时全表重算
+        if groups_migrated:
+            recompute_group_summaries(cursor)
+        
+        # 创建群组收件箱表：写扩散群组的每条未读消息给每个成员（发送者除外）一行指针，读到后删除
+        # 消息归档后指针仍然有效，不加外键
+        inbox_exists = dialect.table_exists(cursor, 'group_inbox')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_inbox (
+                user_id INT NOT NULL,
+                group_id INT NOT NULL,
+                message_id INT NOT NULL,
+                PRIMARY KEY (user_id, group_id, message_id)
+            )
         ''')
+        if not inbox_exists:
+            backfill_group_inbox(cursor)
         
-        # 创建索引
-        try:
-            cursor.execute('CREATE INDEX idx_username ON users(username)')
-            cursor.execute('CREATE INDEX idx_phone ON users(phone)')
-            cursor.execute('CREATE INDEX idx_messages_sender ON messages(sender_id)')
-            cursor.execute('CREATE INDEX idx_messages_receiver ON messages(receiver_id)')
-            cursor.execute('CREATE INDEX idx_group_messages_group ON group_messages(group_id)')
-            cursor.execute('CREATE INDEX idx_group_messages_sender ON group_messages(sender_id)')
-            cursor.execute('CREATE INDEX idx_group_members_group ON group_members(group_id)')
-            cursor.execute('CREATE INDEX idx_group_members_user ON group_members(user_id)')
-            cursor.execute('CREATE INDEX idx_comments_user ON comments(user_id)')
-        except Error as e:
-            # 如果索引已存在，忽略错误
-            pass
+        # 创建未读计数表：每个会话（接收者, 发送者）一行
+        counters_exists = dialect.table_exists(cursor, 'unread_counters')
+        cursor.execute(dialect.ddl('''
+            CREATE TABLE IF NOT EXISTS unread_counters (
+                user_id INT NOT NULL,
+                peer_id INT NOT NULL,
+                count INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, peer_id),
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (peer_id) REFERENCES users(id)
+            )
+        '''))
+        
+        # 创建私聊已读水位表：每个会话（读者, 对方）一行，记录读者已读到的最大消息 id
+        reads_exists = dialect.table_exists(cursor, 'conversation_reads')
+        cursor.execute(dialect.ddl('''
+            CREATE TABLE IF NOT EXISTS conversation_reads (
+                user_id INT NOT NULL,
+                peer_id INT NOT NULL,
+                last_read_id INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, peer_id),
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (peer_id) REFERENCES users(id)
+            )
+        '''))
+        if not reads_exists:
+            backfill_conversation_reads(cursor)
+        
+        # 创建私聊会话摘要表：每个会话（用户, 对方）一行，记录最后一条消息，会话列表只读这张表
+        summaries_exists = dialect.table_exists(cursor, 'conversation_summaries')
+        cursor.execute(dialect.ddl('''
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                user_id INT NOT NULL,
+                peer_id INT NOT NULL,
+                last_message_id INT NOT NULL,
+                last_sender_id INT NOT NULL,
+                last_message_preview VARCHAR(100) NOT NULL,
+                last_message_at TIMESTAMP NULL DEFAULT NULL,
+                PRIMARY KEY (user_id, peer_id),
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (peer_id) REFERENCES users(id)
+            )
+        '''))
+        if not summaries_exists:
+            backfill_conversation_summaries(cursor)
+        
+        # 创建全文搜索倒排表：词项 -> 文档，按可见范围（私聊双方、群组、公开评论）分开存放
+        cursor.execute(dialect.ddl('''
+            CREATE TABLE IF NOT EXISTS search_postings (
+                term VARCHAR(32) {binary} NOT NULL,
+                scope VARCHAR(24) NOT NULL,
+                doc_type TINYINT NOT NULL,
+                doc_id INT NOT NULL,
+                tf SMALLINT NOT NULL,
+                PRIMARY KEY (term, scope, doc_type, doc_id)
+            )
+        '''))
+        
+        # 创建归档表：保存超过保留期的历史消息，压缩存储，只在翻到很早的记录时才查询
+        cursor.execute(dialect.ddl('''
+            CREATE TABLE IF NOT EXISTS messages_archive (
+                id INT PRIMARY KEY,
+                sender_id INT NOT NULL,
+                receiver_id INT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP NULL DEFAULT NULL,
+                is_read BOOLEAN DEFAULT FALSE
+            ) {compressed}
+        '''))
+        cursor.execute(dialect.ddl('''
+            CREATE TABLE IF NOT EXISTS group_messages_archive (
+                id INT PRIMARY KEY,
+                group_id INT NOT NULL,
+                sender_id INT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP NULL DEFAULT NULL
+            ) {compressed}
+        '''))
+        
+        # 创建复制心跳表：只有一行，主库定时更新，副本上读到的值用来计算复制延迟
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS replication_heartbeat (
+                id INT PRIMARY KEY,
+                beat DOUBLE NOT NULL
+            )
+        ''')
+        cursor.execute(f'{dialect.insert_ignore} INTO replication_heartbeat (id, beat) VALUES (1, 0)')
+        
+        # 创建索引（逐条创建，已存在的索引单独忽略，不影响后面的索引）
+        indexes = [
+            'CREATE INDEX idx_username ON users(username)',
+            'CREATE INDEX idx_phone ON users(phone)',
+            'CREATE INDEX idx_messages_sender ON messages(sender_id)',
+            'CREATE INDEX idx_messages_receiver ON messages(receiver_id)',
+            'CREATE INDEX idx_group_messages_group ON group_messages(group_id)',
+            'CREATE INDEX idx_group_messages_sender ON group_messages(sender_id)',
+            'CREATE INDEX idx_group_members_group ON group_members(group_id)',
+            'CREATE INDEX idx_group_members_user ON group_members(user_id)',
+            'CREATE INDEX idx_comments_user ON comments(user_id)',
+            # 私聊分页：每个方向的会话历史都是一段有序的索引范围
+            'CREATE INDEX idx_messages_conversation ON messages(sender_id, receiver_id, created_at)',
+            # 评论分页：按 (created_at, id) 倒序的范围扫描
+            'CREATE INDEX idx_comments_created ON comments(created_at, id)',
+            # 会话列表：按最近活跃时间倒序的范围扫描
+            'CREATE INDEX idx_conversation_summaries_recent ON conversation_summaries(user_id, last_message_at, peer_id)',
+            # 跨群未读消息流：按消息 id 倒序的范围扫描
+            'CREATE INDEX idx_group_inbox_feed ON group_inbox(user_id, message_id)',
+            'CREATE INDEX idx_messages_archive_conversation ON messages_archive(sender_id, receiver_id, created_at)',
+            'CREATE INDEX idx_group_messages_archive_group ON group_messages_archive(group_id)'
+        ]
+        for statement in indexes:
+            try:
+                cursor.execute(statement)
+            except Error as e:
+                # 如果索引已存在，忽略错误
+                pass
         
         conn.commit()
         cursor.close()
         conn.close()
         
+        # 首次创建未读计数表时用现有消息初始化，之后只由后台对账任务定期重算
+        if not counters_exists:
+            reconcile_unread_counters()
+        
     except Error as e:
         print(f"数据库初始化错误: {e}")
 
-# 根路由
-@app.route('/')
-def index():
-    return redirect(url_for('login'))
+# 连接池状态
+@app.route('/pool_stats')
+def pool_stats():
+    if not metrics_access_allowed(request.remote_addr, request.headers.get('Authorization')):
+        return Response('Forbidden', status=403)
+    return jsonify(get_db_pool().stats())
+
+# 请求耗时统计
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if METRICS_ENABLED and start is not None:
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                        endpoint=request.endpoint or 'unknown', method=request.method,
+                        status=response.status_code)
+    return response
+
+# 模板渲染耗时统计
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_render_metrics(sender, template, context, **extra):
+    start = g.pop('render_start', None)
+    if METRICS_ENABLED and start is not None:
+        metrics.observe('template_render_seconds', time.perf_counter() - start, template=template.name)
+
+# Prometheus 指标
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_access_allowed(request.remote_addr, request.headers.get('Authorization')):
+        return Response('Forbidden', status=403)
+    counters, gauges = split_stats('db_pool_', get_db_pool().stats(), ConnectionPool.MONOTONIC_STATS)
+    pipeline_counters, pipeline_gauges = split_stats('write_pipeline_', write_pipeline.stats(),
+                                                     WritePipeline.MONOTONIC_STATS)
+    counters += pipeline_counters
+    gauges += pipeline_gauges
+    gauges.append(('push_subscribers', message_hub.subscriber_count(), {}))
+    # 探测失败的副本延迟记为 -1
+    gauges += [('db_replica_lag_seconds', -1 if lag is None else lag, {'replica': target})
+               for target, lag in replica_set.stats()]
+    return Response(metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
+
+# 根路由
+@app.route('/')
+def index():
+    return redirect(url_for('login'))
+
+class SMSError(Exception):
+    pass
+
+# 阿里云短信网关，复用长连接
+class AlicloudSMSGateway:
+    def __init__(self):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(SMS_WORKERS, 1))
+        self._session.mount('https://', adapter)
+        self._session.headers.update({
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": "APPCODE " + (SMS_APPCODE or '')
+        })
+
+    def send(self, phone, code):
+        data = {
+            "mobile": phone,
+            "smsSignId": SMS_SIGN_ID,
+            "templateId": SMS_TEMPLATE_ID,
+            "param": f"**code**:{code},**minute**:{SMS_CODE_TTL // 60}"
+        }
+        try:
+            response = self._session.post(SMS_API_URL, params=data,
+                                          timeout=(SMS_CONNECT_TIMEOUT, SMS_READ_TIMEOUT))
+        except requests.RequestException as e:
+            raise SMSError(str(e))
+        if response.status_code != 200:
+            raise SMSError(response.text)
+
+# 本地测试用短信网关，不真正发送
+class StubSMSGateway:
+    def send(self, phone, code):
+        print(f"[短信网关桩] 向 {phone} 发送验证码 {code}")
+
+# 熔断器：连续失败达到阈值后暂停请求网关，超时后放行一次试探
+class CircuitBreaker:
+    def __init__(self, threshold, reset_timeout):
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self._reset_timeout:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self._threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half_open' if self._probing else 'open'
+
+# 短信后台发送队列，请求线程只负责入队
+class SMSDispatcher:
+    def __init__(self, gateway, breaker, workers=2, queue_size=1000):
+        self._gateway = gateway
+        self._breaker = breaker
+        self._workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        # 发送任务状态：queued / sending / sent / failed
+        self._jobs = TTLCache(SMS_CODE_TTL, maxsize=queue_size * 10)
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self._workers):
+                threading.Thread(target=self._run, name=f'sms-dispatcher-{i}', daemon=True).start()
+            self._started = True
+
+    def submit(self, phone, code):
+        self._start()
+        job_id = uuid.uuid4().hex
+        self._jobs.set(job_id, {'status': 'queued', 'phone': phone})
+        try:
+            self._queue.put_nowait((job_id, phone, code))
+        except queue.Full:
+            self._jobs.delete(job_id)
+            return None
+        return job_id
+
+    def status(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _run(self):
+        while True:
+            job_id, phone, code = self._queue.get()
+            try:
+                self._process(job_id, phone, code)
+            except Exception as e:
+                # 任何异常（例如验证码存储的数据库被锁）都只让这一个任务失败，工作线程继续处理后面的任务
+                print(f"短信任务异常: {e}")
+                self._jobs.set(job_id, {'status': 'failed', 'phone': phone, 'error': '发送失败，请稍后重试'})
+                try:
+                    verification_codes.release_send(phone)
+                except Exception as e:
+                    print(f"释放发送间隔失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _process(self, job_id, phone, code):
+        self._jobs.set(job_id, {'status': 'sending', 'phone': phone})
+        error = self._send_with_retry(phone, code)
+        if error is None:
+            # 发送成功后才保存验证码
+            verification_codes.save(phone, code, SMS_CODE_TTL)
+            self._jobs.set(job_id, {'status': 'sent', 'phone': phone})
+        else:
+            print(f"发送短信失败: {error}")
+            verification_codes.release_send(phone)
+            self._jobs.set(job_id, {'status': 'failed', 'phone': phone, 'error': error})
+
+    def _send_with_retry(self, phone, code):
+        error = None
+        for attempt in range(SMS_MAX_RETRIES):
+            if not self._breaker.allow():
+                return '短信服务暂时不可用'
+            start = time.perf_counter()
+            try:
+                self._gateway.send(phone, code)
+                metrics.observe('sms_send_duration_seconds', time.perf_counter() - start, result='ok')
+                self._breaker.record_success()
+                return None
+            except SMSError as e:
+                metrics.observe('sms_send_duration_seconds', time.perf_counter() - start, result='error')
+                self._breaker.record_failure()
+                error = str(e)
+            if attempt < SMS_MAX_RETRIES - 1:
+                # 指数退避，加随机抖动
+                time.sleep(SMS_RETRY_BACKOFF * (2 ** attempt) * (1 + random.random()))
+        return error
+
+def create_sms_gateway():
+    if SMS_GATEWAY == 'stub':
+        return StubSMSGateway()
+    return AlicloudSMSGateway()
+
+sms_dispatcher = SMSDispatcher(create_sms_gateway(),
+                               CircuitBreaker(SMS_BREAKER_THRESHOLD, SMS_BREAKER_RESET_TIMEOUT),
+                               workers=SMS_WORKERS, queue_size=SMS_QUEUE_SIZE)
+
+# 发送验证码：生成验证码并交给后台队列发送，返回发送任务 id，队列已满时返回 None
+def send_verification_code(phone):
+    # 生成验证码
+    code = str(random.randint(100000, 999999))
+    return sms_dispatcher.submit(phone, code)
+
+# 密码哈希配置
+# 哈希算法及参数，例如 scrypt、scrypt:65536:8:1、pbkdf2:sha256:600000；修改后用户下次登录时自动重新哈希
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+PASSWORD_SALT_LENGTH = int(os.getenv('PASSWORD_SALT_LENGTH', 16))
+# 哈希计算进程数，0 表示在请求线程内直接计算
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+# 排队中的哈希任务上限，超过后直接拒绝
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 64))
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+# 登录频率限制：每个 IP / 每个用户名在时间窗口内的最多失败次数
+LOGIN_WINDOW = int(os.getenv('LOGIN_WINDOW', 60))
+LOGIN_MAX_ATTEMPTS_PER_IP = int(os.getenv('LOGIN_MAX_ATTEMPTS_PER_IP', 30))
+LOGIN_MAX_ATTEMPTS_PER_USER = int(os.getenv('LOGIN_MAX_ATTEMPTS_PER_USER', 10))
+
+class PasswordHasherBusy(Exception):
+    pass
+
+# 密码哈希进程池：哈希计算在独立进程中进行，不占用请求线程的 GIL
+class PasswordHasher:
+    def __init__(self, method, salt_length, workers, max_pending, timeout):
+        self._method = method
+        self._salt_length = salt_length
+        self._workers = workers
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._current_prefix = None
+        self._lock = threading.Lock()
+
+    # 子进程不用 fork 创建，避免复制父进程中其他线程持有的锁
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                     mp_context=multiprocessing.get_context(method))
+            return self._executor
+
+    # 在启动后台线程之前创建进程池
+    def start(self):
+        if self._workers > 0:
+            self._get_executor()
+
+    def _run(self, fn, *args):
+        if self._workers <= 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            metrics.inc('password_hash_rejected_total')
+            raise PasswordHasherBusy()
+        start = time.perf_counter()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # 任务真正结束时才释放名额，等待超时的任务仍计入排队数
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            return future.result(timeout=self._timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy()
+        finally:
+            metrics.observe('password_hash_seconds', time.perf_counter() - start, operation=fn.__name__)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self._method, self._salt_length)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    # 存储的哈希与当前配置的算法参数不一致时需要重新哈希
+    def needs_rehash(self, pwhash):
+        if self._current_prefix is None:
+            self._current_prefix = generate_password_hash('', self._method, 1).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._current_prefix
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH, PASSWORD_HASH_WORKERS,
+                                 PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_TIMEOUT)
+atexit.register(password_hasher.close)
+
+# 固定窗口频率限制，只统计失败次数，窗口从第一次失败开始计算
+class LoginThrottle:
+    def __init__(self, limit, window):
+        self._limit = limit
+        self._windows = TTLCache(window, maxsize=100000)
+        self._lock = threading.Lock()
+
+    def failures(self, key):
+        with self._lock:
+            counter = self._windows.get(key)
+            return 0 if counter is None else counter[0]
+
+    def blocked(self, key):
+        return self.failures(key) >= self._limit
+
+    def fail(self, key):
+        with self._lock:
+            counter = self._windows.get(key)
+            if counter is None:
+                counter = [0]
+                self._windows.set(key, counter)
+            counter[0] += 1
 
-# 发送验证码
-def send_verification_code(phone):
+    def reset(self, key):
+        with self._lock:
+            self._windows.delete(key)
+
+login_ip_throttle = LoginThrottle(LOGIN_MAX_ATTEMPTS_PER_IP, LOGIN_WINDOW)
+login_user_throttle = LoginThrottle(LOGIN_MAX_ATTEMPTS_PER_USER, LOGIN_WINDOW)
+
+# 登录成功后按当前配置重新哈希密码，失败不影响登录
+def rehash_password(user_id, password):
     try:
-        # 生成验证码
-        code = str(random.randint(100000, 999999))
-        
-        # 准备请求参数
-        data = {
-            "mobile": phone,
-            "smsSignId": SMS_SIGN_ID,
-            "templateId": SMS_TEMPLATE_ID,
-            "param": f"**code**:{code},**minute**:5"
-        }
-        
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": "APPCODE " + SMS_APPCODE
-        }
-        
-        # 发送短信
-        response = requests.post(SMS_API_URL, headers=headers, params=data)
-        
-        if response.status_code == 200:
-            # 存储验证码
-            verification_codes[phone] = {
-                'code': code,
-                'expire_time': datetime.now() + timedelta(minutes=5),
-                'last_send_time': datetime.now()
-            }
-            return True
-        else:
-            print(f"发送短信失败: {response.text}")
-            return False
-            
-    except Exception as e:
-        print(f"发送短信失败: {str(e)}")
-        return False
+        new_hash = password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return
+    conn = get_db_connection()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    try:
+        storage.update_user_password(cursor, user_id, new_hash)
+        conn.commit()
+    except Error as e:
+        print(f"更新密码哈希失败: {e}")
+    finally:
+        cursor.close()
+        conn.close()
 
 # 登录页面
 @app.route('/login', methods=['GET', 'POST'])
@@ -213,51 +1820,65 @@ def login():
             username = request.form.get('username')
             password = request.form.get('password')
             
+            # 限制同一 IP 和同一用户名的失败次数，防止暴力破解占满 CPU；
+            # 用户名超限后只拦截窗口内失败过的 IP，别人无法靠故意输错把用户锁在门外
+            client_ip = request.remote_addr
+            if login_ip_throttle.blocked(client_ip) or (login_user_throttle.blocked(username or '')
+                                                        and login_ip_throttle.failures(client_ip) > 0):
+                flash('登录尝试过于频繁，请稍后再试', 'error')
+                return redirect(url_for('login'))
+            
             conn = get_db_connection()
             if conn is None:
                 flash('数据库连接错误', 'error')
                 return redirect(url_for('login'))
                 
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute('SELECT * FROM users WHERE username = %s', (username,))
-            user = cursor.fetchone()
+            cursor = dialect.repository_cursor(conn, dictionary=True)
+            user = storage.get_user_by_username(cursor, username)
             cursor.close()
             conn.close()
             
-            if user and check_password_hash(user['password'], password):
-                session['user_id'] = user['id']
-                session['username'] = user['username']
+            try:
+                valid = user is not None and password_hasher.verify(user['password'], password or '')
+            except PasswordHasherBusy:
+                flash('服务器繁忙，请稍后重试', 'error')
+                return redirect(url_for('login'))
+            
+            if valid:
+                login_user_throttle.reset(username)
+                if password_hasher.needs_rehash(user['password']):
+                    rehash_password(user['id'], password)
+                start_session(user)
                 return redirect(url_for('dashboard'))
             else:
+                login_ip_throttle.fail(client_ip)
+                login_user_throttle.fail(username or '')
                 flash('用户名或密码错误', 'error')
         else:
             phone = request.form.get('phone')
             code = request.form.get('code')
             
-            if phone in verification_codes:
-                stored_code = verification_codes[phone]
-                if datetime.now() <= stored_code['expire_time'] and code == stored_code['code']:
-                    conn = get_db_connection()
-                    if conn is None:
-                        flash('数据库连接错误', 'error')
-                        return redirect(url_for('login'))
-                        
-                    cursor = conn.cursor(dictionary=True)
-                    cursor.execute('SELECT * FROM users WHERE phone = %s', (phone,))
-                    user = cursor.fetchone()
-                    cursor.close()
-                    conn.close()
+            verified = verification_codes.verify(phone, code)
+            if verified is None:
+                flash('请先获取验证码', 'error')
+            elif verified:
+                conn = get_db_connection()
+                if conn is None:
+                    flash('数据库连接错误', 'error')
+                    return redirect(url_for('login'))
                     
-                    if user:
-                        session['user_id'] = user['id']
-                        session['username'] = user['username']
-                        return redirect(url_for('dashboard'))
-                    else:
-                        flash('手机号未注册', 'error')
+                cursor = dialect.repository_cursor(conn, dictionary=True)
+                user = storage.get_user_by_phone(cursor, phone)
+                cursor.close()
+                conn.close()
+                
+                if user:
+                    start_session(user)
+                    return redirect(url_for('dashboard'))
                 else:
-                    flash('验证码错误或已过期', 'error')
+                    flash('手机号未注册', 'error')
             else:
-                flash('请先获取验证码', 'error')
+                flash('验证码错误或已过期', 'error')
     
     return render_template('login.html')
 
@@ -273,26 +1894,37 @@ def send_code():
     if conn is None:
         return jsonify({'success': False, 'message': '数据库连接错误'})
         
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('SELECT * FROM users WHERE phone = %s', (phone,))
-    user = cursor.fetchone()
+    cursor = dialect.repository_cursor(conn, dictionary=True)
+    user = storage.get_user_by_phone(cursor, phone)
     cursor.close()
     conn.close()
     
     if not user:
         return jsonify({'success': False, 'message': '手机号未注册'})
     
-    # 检查是否频繁发送
-    if phone in verification_codes:
-        last_send_time = verification_codes[phone].get('last_send_time')
-        if last_send_time and datetime.now() - last_send_time < timedelta(minutes=1):
-            return jsonify({'success': False, 'message': '请稍后再试'})
+    # 检查是否频繁发送（检查和占用是一次原子操作，并发请求只有一个能通过）
+    if not verification_codes.reserve_send(phone, SMS_RESEND_INTERVAL):
+        return jsonify({'success': False, 'message': '请稍后再试'})
     
-    if send_verification_code(phone):
-        return jsonify({'success': True, 'message': '验证码已发送'})
+    job_id = send_verification_code(phone)
+    if job_id:
+        return jsonify({'success': True, 'message': '验证码发送中', 'job_id': job_id})
     else:
+        verification_codes.release_send(phone)
         return jsonify({'success': False, 'message': '发送失败，请稍后重试'})
 
+# 查询验证码发送状态
+@app.route('/send_code/status/<job_id>')
+def send_code_status(job_id):
+    job = sms_dispatcher.status(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '发送任务不存在或已过期'})
+    
+    result = {'success': True, 'status': job['status']}
+    if job['status'] == 'failed':
+        result['message'] = '发送失败，请稍后重试'
+    return jsonify(result)
+
 # 注册页面
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -305,6 +1937,12 @@ def register():
             flash('所有字段都必须填写', 'error')
             return redirect(url_for('register'))
         
+        try:
+            password_hash = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            flash('服务器繁忙，请稍后重试', 'error')
+            return redirect(url_for('register'))
+        
         conn = get_db_connection()
         if conn is None:
             flash('数据库连接错误', 'error')
@@ -312,8 +1950,7 @@ def register():
             
         cursor = conn.cursor()
         try:
-            cursor.execute('INSERT INTO users (username, password, phone) VALUES (%s, %s, %s)',
-                         (username, generate_password_hash(password), phone))
+            storage.create_user(cursor, username, password_hash, phone)
             conn.commit()
             flash('注册成功，请登录', 'success')
             return redirect(url_for('login'))
@@ -325,37 +1962,266 @@ def register():
     
     return render_template('register.html')
 
+# 登录成功：换发新的会话 id 后写入用户信息
+def start_session(user):
+    session.clear()
+    session.regenerate()
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    preload_user_groups(user['id'])
+
+# 用户基本信息缓存（id -> {id, username}），用户名不会修改，只按过期时间淘汰
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+user_cache = TTLCache(USER_CACHE_TTL, maxsize=10000)
+
+# 按 id 获取用户基本信息：同一请求内直接复用，跨请求走进程内缓存，都没有时才查数据库
+def get_user(user_id):
+    users = g.setdefault('users', {})
+    if user_id in users:
+        return users[user_id]
+    user = user_cache.get(user_id)
+    if user is None:
+        conn = get_db_connection()
+        if conn is None:
+            return None
+        cursor = dialect.repository_cursor(conn, dictionary=True)
+        user = storage.get_user_by_id(cursor, user_id)
+        cursor.close()
+        conn.close()
+        if user is not None:
+            user_cache.set(user_id, user)
+    users[user_id] = user
+    return user
+
+# 当前登录用户，未登录时返回 None
+def get_current_user():
+    if 'user_id' not in session:
+        return None
+    return get_user(session['user_id'])
+
 # 仪表板页面
 @app.route('/dashboard')
 def dashboard():
-    if 'user_id' not in session:
+    user = get_current_user()
+    if user is None:
         return redirect(url_for('login'))
-    return render_template('dashboard.html', username=session['username'])
+    return render_template('dashboard.html', username=user['username'])
 
-# 退出登录
+# 退出登录：清空会话，服务端同时删除会话记录，旧的会话 id 立即失效
 @app.route('/logout')
 def logout():
     session.clear()
     return redirect(url_for('login'))
 
+# 用户列表每页条数
+USER_PAGE_SIZE = int(os.getenv('USER_PAGE_SIZE', 50))
+
+# 按用户名前缀分页查询用户，走 username 唯一索引的范围扫描，游标为上一页最后一个用户名
+def fetch_user_page(cursor, exclude_id, prefix='', after=None, limit=None):
+    limit = limit or USER_PAGE_SIZE
+    rows = storage.find_users_by_prefix(cursor, exclude_id, prefix, after, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = rows[-1]['username'] if has_more else None
+    return rows, next_cursor
+
 # 用户列表页面
 @app.route('/users')
 def user_list():
     if 'user_id' not in session:
         return redirect(url_for('login'))
+    
+    query = request.args.get('q', '').strip()
         
-    conn = get_db_connection()
+    conn = get_read_connection()
     if conn is None:
         flash('数据库连接错误', 'error')
         return redirect(url_for('dashboard'))
         
     cursor = conn.cursor(dictionary=True)
-    cursor.execute('SELECT id, username FROM users WHERE id != %s', (session['user_id'],))
-    users = cursor.fetchall()
+    users, next_cursor = fetch_user_page(cursor, session['user_id'], query)
+    cursor.close()
+    conn.close()
+    
+    return render_template('users.html', users=users, query=query, next_cursor=next_cursor)
+
+# 搜索用户（用户名前缀匹配，分页）
+@app.route('/users/search')
+def user_search():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    query = request.args.get('q', '').strip()
+    after = request.args.get('after')
+    
+    conn = get_read_connection()
+    if conn is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+        
+    cursor = conn.cursor(dictionary=True)
+    users, next_cursor = fetch_user_page(cursor, session['user_id'], query, after,
+                                         get_page_size(USER_PAGE_SIZE))
     cursor.close()
     conn.close()
     
-    return render_template('users.html', users=users)
+    return jsonify({'success': True, 'users': users, 'next_cursor': next_cursor})
+
+# 聊天记录每页条数
+CHAT_PAGE_SIZE = int(os.getenv('CHAT_PAGE_SIZE', 50))
+CHAT_PAGE_SIZE_MAX = int(os.getenv('CHAT_PAGE_SIZE_MAX', 200))
+
+# 消息片段缓存：单条消息渲染好的 HTML，键为 (片段模板, 消息 id, 查看者 id, 影响显示的状态)
+# 片段和整页一样带着请求上下文（session、g、request）渲染，可能包含查看者自己的信息，所以按查看者分开缓存；
+# 消息内容和发送者用户名都不会修改，同一个键的片段永远相同，只按容量和有效期淘汰
+MESSAGE_FRAGMENT_CACHE_TTL = int(os.getenv('MESSAGE_FRAGMENT_CACHE_TTL', 3600))
+message_fragment_cache = TTLCache(MESSAGE_FRAGMENT_CACHE_TTL,
+                                  maxsize=int(os.getenv('MESSAGE_FRAGMENT_CACHE_SIZE', 20000)))
+
+# 逐条产出消息片段，缓存未命中时才渲染；在整页模板流式输出的过程中按需调用，
+# 不单独触发模板渲染信号，耗时计入整页的渲染时间
+def render_message_fragments(template_name, messages, viewer_id, state=()):
+    template = app.jinja_env.get_template(template_name)
+    context = {}
+    app.update_template_context(context)
+    for message in messages:
+        key = (template_name, message['id'], viewer_id) + tuple(message.get(name) for name in state)
+        fragment = message_fragment_cache.get(key)
+        if fragment is None:
+            fragment = Markup(template.render(context, message=message, is_mine=message['sender_id'] == viewer_id))
+            message_fragment_cache.set(key, fragment)
+        yield fragment
+
+# 读取请求中的每页条数，限制在允许范围内
+def get_page_size(default=None, maximum=None):
+    default = default or CHAT_PAGE_SIZE
+    maximum = maximum or CHAT_PAGE_SIZE_MAX
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        limit = default
+    return max(1, min(limit, maximum))
+
+# 分页游标：消息的 (created_at, id)，编码为 "20240101120000-123"
+def encode_cursor(created_at, row_id):
+    return f"{created_at.strftime('%Y%m%d%H%M%S')}-{row_id}"
+
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = cursor.split('-')
+        return datetime.strptime(created_at, '%Y%m%d%H%M%S'), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+# 转换为可以直接返回给前端的消息字典
+def serialize_message(message):
+    data = dict(message)
+    for key, value in data.items():
+        if isinstance(value, datetime):
+            data[key] = value.strftime('%Y-%m-%d %H:%M:%S')
+    return data
+
+# 归档水位：归档表中最大的消息 id，没有归档过任何消息时为 0；各进程短暂缓存
+ARCHIVE_WATERMARK_TTL = int(os.getenv('ARCHIVE_WATERMARK_TTL', 60))
+archive_watermarks = TTLCache(ARCHIVE_WATERMARK_TTL, maxsize=8)
+
+def archive_watermark_query(archive_table_name):
+    return f'SELECT MAX(id) AS watermark FROM {archive_table_name}', ()
+
+def get_archive_watermark(cursor, archive_table_name):
+    if not ARCHIVE_ENABLED:
+        return 0
+    watermark = archive_watermarks.get(archive_table_name)
+    if watermark is None:
+        cursor.execute(*archive_watermark_query(archive_table_name))
+        row = storage.fetch_first(cursor)
+        watermark = (row['watermark'] if isinstance(row, dict) else row[0]) or 0
+        archive_watermarks.set(archive_table_name, watermark)
+    return watermark
+
+# 热表不够一页时是否需要看归档表：从未归档过则不查；第一页只要热表里有消息就不查归档表，
+# 只标记还有更早的消息，用户继续往前翻页时再查，避免每个短会话的首屏都多一次归档查询
+# 返回 'query'（查询归档表）、'more'（标记还有更多）或 None
+def archive_lookup(watermark, before, rows, limit):
+    if len(rows) > limit or not watermark:
+        return None
+    if before is None and rows:
+        return 'more'
+    return 'query'
+
+# 整理查询结果：截取一页、生成下一页游标，按时间正序返回
+# more=True 表示热表之外可能还有更早的消息（归档表未查询）
+def chat_page_result(rows, limit=None, more=False):
+    limit = CHAT_PAGE_SIZE if limit is None else limit
+    has_more = len(rows) > limit or (more and bool(rows))
+    rows = list(rows[:limit])
+    next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_more else None
+    rows.reverse()
+    return rows, next_cursor
+
+# 按游标获取两人之间的一页聊天记录（从新到旧取，按时间正序返回）
+def fetch_chat_page(cursor, user_id, peer_id, before=None, limit=None):
+    limit = CHAT_PAGE_SIZE if limit is None else limit
+    rows = storage.find_chat_page(cursor, user_id, peer_id, before, limit)
+    # 热表不够一页，说明已经翻到热表中最早的消息，再从归档表补齐（归档消息都比热表中的旧）
+    lookup = archive_lookup(get_archive_watermark(cursor, 'messages_archive'), before, rows, limit)
+    if lookup == 'query':
+        rows = list(rows) + storage.find_chat_page(cursor, user_id, peer_id, before, limit - len(rows),
+                                                   'messages_archive')
+    return chat_page_result(rows, limit, more=lookup == 'more')
+
+# 私聊已读水位：每个会话只记录读者已读到的最大消息 id，水位之后的对方消息即为未读
+def read_watermarks_query(user_id, peer_id):
+    sql = '''
+        SELECT user_id, last_read_id FROM conversation_reads
+        WHERE (user_id = %s AND peer_id = %s) OR (user_id = %s AND peer_id = %s)
+    '''
+    return sql, (user_id, peer_id, peer_id, user_id)
+
+# 返回 (我的水位, 对方的水位)，没有记录的会话水位为 0
+def read_watermarks_result(rows, user_id):
+    watermarks = {row[0]: row[1] for row in rows}
+    mine = watermarks.pop(user_id, 0)
+    return mine, next(iter(watermarks.values()), 0)
+
+def get_read_watermarks(conn, user_id, peer_id):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(*read_watermarks_query(user_id, peer_id))
+        return read_watermarks_result(cursor.fetchall(), user_id)
+    finally:
+        cursor.close()
+
+# 根据双方水位填充消息的已读状态：自己发的看对方水位，对方发的看自己的水位
+def apply_read_state(messages, user_id, my_read_id, peer_read_id):
+    for message in messages:
+        watermark = peer_read_id if message['sender_id'] == user_id else my_read_id
+        message['is_read'] = message['id'] <= watermark
+    return messages
+
+# 把会话标记为已读到 last_id：只写一行水位，未读数按水位之后的 id 范围重新计算
+def mark_conversation_read(conn, user_id, peer_id, last_id):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'''
+            INSERT INTO conversation_reads (user_id, peer_id, last_read_id)
+            VALUES (%s, %s, %s)
+            {dialect.on_conflict('user_id, peer_id')}
+                last_read_id = {dialect.greatest}(last_read_id, {dialect.new('last_read_id')})
+        ''', (user_id, peer_id, last_id))
+        cursor.execute('''
+            UPDATE unread_counters
+            SET count = (
+                SELECT COUNT(*) FROM messages
+                WHERE sender_id = %s AND receiver_id = %s
+                  AND id > (SELECT last_read_id FROM conversation_reads WHERE user_id = %s AND peer_id = %s)
+            )
+            WHERE user_id = %s AND peer_id = %s
+        ''', (peer_id, user_id, user_id, peer_id, user_id, peer_id))
+        conn.commit()
+    finally:
+        cursor.close()
+    unread_cache.delete(user_id)
+    set_read_fence(('unread', user_id))
 
 # 聊天页面
 @app.route('/chat/<int:user_id>')
@@ -363,43 +2229,328 @@ def chat(user_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
+    # 获取聊天对象信息（先于获取连接，缓存未命中时不会同时占用两个连接）
+    chat_user = get_user(user_id)
+    
+    if not chat_user:
+        flash('用户不存在', 'error')
+        return redirect(url_for('user_list'))
+    
+    conn = get_read_connection()
     if conn is None:
         flash('数据库连接错误', 'error')
         return redirect(url_for('dashboard'))
         
-    cursor = conn.cursor(dictionary=True)
-    # 获取聊天对象信息
-    cursor.execute('SELECT id, username FROM users WHERE id = %s', (user_id,))
-    chat_user = cursor.fetchone()
+    cursor = dialect.repository_cursor(conn, dictionary=True)
     
-    if not chat_user:
-        flash('用户不存在', 'error')
-        return redirect(url_for('user_list'))
+    # 获取最近一页历史消息，更早的消息通过 /chat/<user_id>/history 加载
+    messages, next_cursor = fetch_chat_page(cursor, session['user_id'], user_id)
+    cursor.close()
+    my_read_id, peer_read_id = get_read_watermarks(conn, session['user_id'], user_id)
+    conn.close()
     
-    # 获取历史消息
-    cursor.execute('''
-        SELECT m.*, u.username as sender_name 
-        FROM messages m 
-        JOIN users u ON m.sender_id = u.id 
-        WHERE (m.sender_id = %s AND m.receiver_id = %s)
-        OR (m.sender_id = %s AND m.receiver_id = %s)
-        ORDER BY m.created_at ASC
-    ''', (session['user_id'], user_id, user_id, session['user_id']))
-    messages = cursor.fetchall()
-    
-    # 标记消息为已读
-    cursor.execute('''
-        UPDATE messages 
-        SET is_read = TRUE 
-        WHERE receiver_id = %s AND sender_id = %s AND is_read = FALSE
-    ''', (session['user_id'], user_id))
+    # 把水位推进到本页最新一条对方消息，水位没有变化时不写数据库（写入走主库）
+    last_id = max((m['id'] for m in messages if m['sender_id'] == user_id), default=0)
+    if last_id > my_read_id:
+        conn = get_db_connection()
+        if conn is not None:
+            mark_conversation_read(conn, session['user_id'], user_id, last_id)
+            conn.close()
+            note_write()
+            my_read_id = last_id
+    apply_read_state(messages, session['user_id'], my_read_id, peer_read_id)
+    
+    # 流式输出整页，消息列表由缓存的片段拼成（模板中输出 message_blocks 的每一项）
+    blocks = render_message_fragments('_chat_message.html', messages, session['user_id'], ('is_read',))
+    return stream_template('chat.html', chat_user=chat_user, messages=messages, message_blocks=blocks,
+                           next_cursor=next_cursor)
+
+# 加载更早的聊天记录
+@app.route('/chat/<int:user_id>/history')
+def chat_history(user_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    before = request.args.get('before')
+    cursor_value = decode_cursor(before) if before else None
+    if before and cursor_value is None:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    conn = get_read_connection()
+    if conn is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+        
+    cursor = dialect.repository_cursor(conn, dictionary=True)
+    messages, next_cursor = fetch_chat_page(cursor, session['user_id'], user_id,
+                                            before=cursor_value, limit=get_page_size())
+    cursor.close()
+    apply_read_state(messages, session['user_id'], *get_read_watermarks(conn, session['user_id'], user_id))
+    conn.close()
+    
+    return jsonify({
+        'success': True,
+        'messages': [serialize_message(m) for m in messages],
+        'next_cursor': next_cursor
+    })
+
+# 标记已读：客户端收到推送的新消息后上报已读到的最大消息 id，一次请求覆盖之前所有消息
+@app.route('/chat/<int:user_id>/read', methods=['POST'])
+def mark_chat_read(user_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    last_id = request.form.get('last_id', type=int)
+    if last_id is None:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
     
-    conn.commit()
+    cursor = conn.cursor()
+    # 水位不能超过对方实际发来的最后一条消息，否则之后的新消息会被误判为已读
+    cursor.execute('''
+        SELECT id FROM messages
+        WHERE sender_id = %s AND receiver_id = %s AND id <= %s
+        ORDER BY id DESC LIMIT 1
+    ''', (user_id, session['user_id'], last_id))
+    row = cursor.fetchone()
     cursor.close()
+    if row:
+        mark_conversation_read(conn, session['user_id'], user_id, row[0])
+        note_write()
     conn.close()
     
-    return render_template('chat.html', chat_user=chat_user, messages=messages)
+    return jsonify({'success': True, 'last_read_id': row[0] if row else 0})
+
+# 批量写入配置：开启后消息和评论先进入内存缓冲区，由后台线程合并成多行 INSERT 在一个事务内提交
+WRITE_PIPELINE_ENABLED = os.getenv('WRITE_PIPELINE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# 确认方式：flush（提交到数据库后才返回，默认）或 enqueue（进入缓冲区即返回，进程崩溃时可能丢失）
+WRITE_PIPELINE_ACK = os.getenv('WRITE_PIPELINE_ACK', 'flush')
+WRITE_PIPELINE_BATCH_SIZE = int(os.getenv('WRITE_PIPELINE_BATCH_SIZE', 100))
+# 第一条写入进入缓冲区后最多等待多久就提交（秒）
+WRITE_PIPELINE_MAX_DELAY = float(os.getenv('WRITE_PIPELINE_MAX_DELAY', 0.05))
+WRITE_PIPELINE_BUFFER_SIZE = int(os.getenv('WRITE_PIPELINE_BUFFER_SIZE', 10000))
+# 缓冲区满时最多等待多久（秒），超时拒绝写入
+WRITE_PIPELINE_ENQUEUE_TIMEOUT = float(os.getenv('WRITE_PIPELINE_ENQUEUE_TIMEOUT', 1))
+WRITE_PIPELINE_ACK_TIMEOUT = float(os.getenv('WRITE_PIPELINE_ACK_TIMEOUT', 10))
+
+# 写入私聊消息，行格式 (sender_id, receiver_id, content)
+def write_messages(cursor, rows):
+    ids = storage.insert_messages(cursor, rows)
+    
+    # 同一事务内累加接收者的未读计数
+    storage.increment_unread_counters(
+        cursor, Counter((receiver_id, sender_id) for sender_id, receiver_id, content in rows))
+    
+    # 同一事务内更新双方的会话摘要
+    storage.upsert_conversation_summaries(cursor, [
+        (message_id, sender_id, receiver_id, content)
+        for message_id, (sender_id, receiver_id, content) in zip(ids, rows)])
+    
+    index_documents(cursor, 'message', [
+        (message_id, message_scopes(sender_id, receiver_id), content)
+        for message_id, (sender_id, receiver_id, content) in zip(ids, rows)])
+    return ids
+
+# 写入群组消息，行格式 (group_id, sender_id, content)
+def write_group_messages(cursor, rows):
+    ids = storage.insert_group_messages(cursor, rows)
+    
+    # 更新群组最近活跃时间和最后一条消息摘要，每个群只取本批最新的一条
+    latest = {}
+    for message_id, (group_id, sender_id, content) in zip(ids, rows):
+        latest[group_id] = (message_id, sender_id, content)
+    for group_id in sorted(latest):
+        storage.update_group_summary(cursor, group_id, *latest[group_id])
+    
+    deliver_group_messages(cursor, [(message_id, group_id, sender_id)
+                                    for message_id, (group_id, sender_id, content) in zip(ids, rows)])
+    
+    index_documents(cursor, 'group_message', [
+        (message_id, group_message_scopes(group_id), content)
+        for message_id, (group_id, sender_id, content) in zip(ids, rows)])
+    return ids
+
+# 写入评论，行格式 (user_id, content)
+def write_comments(cursor, rows):
+    ids = storage.insert_comments(cursor, rows)
+    index_documents(cursor, 'comment', [
+        (comment_id, COMMENT_SCOPES, content) for comment_id, (user_id, content) in zip(ids, rows)])
+    return ids
+
+WRITE_HANDLERS = {
+    'message': write_messages,
+    'group_message': write_group_messages,
+    'comment': write_comments
+}
+
+class _WriteItem:
+    def __init__(self, kind, row, on_commit):
+        self.kind = kind
+        self.row = row
+        self.on_commit = on_commit
+        self.row_id = None
+        self.error = None
+        self.done = threading.Event()
+
+# 批量写入管道：单个后台线程按数量或时间阈值合并提交，保持写入顺序
+class WritePipeline:
+    MONOTONIC_STATS = ('batches', 'rows', 'rejected', 'errors')
+
+    def __init__(self, batch_size=100, max_delay=0.05, buffer_size=10000, enqueue_timeout=1):
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'batches': 0, 'rows': 0, 'rejected': 0, 'errors': 0}
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-pipeline', daemon=True)
+                self._thread.start()
+
+    # 放入缓冲区，缓冲区满且等待超时返回 None（背压）
+    def submit(self, kind, row, on_commit=None):
+        self._start()
+        item = _WriteItem(kind, row, on_commit)
+        try:
+            self._queue.put(item, timeout=self._enqueue_timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            return None
+        return item
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self._max_delay
+            stop = False
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # 兜底：无论出什么错都只让这一批失败，写入线程继续运行
+                print(f"批量写入异常: {e}")
+                for item in batch:
+                    if not item.done.is_set():
+                        item.row_id = None
+                        item.error = '写入失败，请稍后重试'
+                        item.done.set()
+            if stop:
+                return
+
+    def _write(self, cursor, items):
+        by_kind = OrderedDict()
+        for item in items:
+            by_kind.setdefault(item.kind, []).append(item)
+        for kind, kind_items in by_kind.items():
+            ids = WRITE_HANDLERS[kind](cursor, [item.row for item in kind_items])
+            for item, row_id in zip(kind_items, ids):
+                item.row_id = row_id
+
+    def _flush(self, batch):
+        conn = get_db_connection()
+        if conn is None:
+            for item in batch:
+                item.error = '数据库连接错误'
+        else:
+            cursor = dialect.repository_cursor(conn)
+            try:
+                self._write(cursor, batch)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"批量写入失败，逐条重试: {e}")
+                # 整批失败时逐条重试，避免一行坏数据拖累整批（处理函数的程序错误也按单条失败处理）
+                for item in batch:
+                    try:
+                        self._write(cursor, [item])
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        item.row_id = None
+                        item.error = str(e)
+            finally:
+                cursor.close()
+                conn.close()
+        
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['rows'] += len(batch)
+            self._stats['errors'] += sum(1 for item in batch if item.error)
+        for item in batch:
+            if item.error is None and item.on_commit:
+                try:
+                    item.on_commit(item.row_id)
+                except Exception as e:
+                    print(f"写入回调错误: {e}")
+            item.done.set()
+
+    # 退出前把缓冲区里的写入全部提交
+    def close(self, timeout=10):
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['buffered'] = self._queue.qsize()
+        return stats
+
+write_pipeline = WritePipeline(WRITE_PIPELINE_BATCH_SIZE, WRITE_PIPELINE_MAX_DELAY,
+                               WRITE_PIPELINE_BUFFER_SIZE, WRITE_PIPELINE_ENQUEUE_TIMEOUT)
+atexit.register(write_pipeline.close)
+
+# 写入一行：开启批量写入时交给后台管道，否则在当前请求内直接写入并提交
+# on_commit(row_id) 在提交成功后调用；成功返回 None，失败返回错误信息
+def write_row(kind, row, on_commit=None):
+    if not WRITE_PIPELINE_ENABLED:
+        conn = get_db_connection()
+        if conn is None:
+            return '数据库连接错误'
+        cursor = dialect.repository_cursor(conn)
+        try:
+            row_id = WRITE_HANDLERS[kind](cursor, [row])[0]
+            conn.commit()
+        except Error as e:
+            return str(e)
+        finally:
+            cursor.close()
+            conn.close()
+        if on_commit:
+            on_commit(row_id)
+        return None
+    
+    item = write_pipeline.submit(kind, row, on_commit)
+    if item is None:
+        return '服务器繁忙，请稍后重试'
+    if WRITE_PIPELINE_ACK == 'enqueue':
+        return None
+    if not item.done.wait(WRITE_PIPELINE_ACK_TIMEOUT):
+        return '写入超时，请稍后重试'
+    return item.error
 
 # 发送消息接口
 @app.route('/send_message', methods=['POST'])
@@ -410,48 +2561,299 @@ def send_message():
     receiver_id = request.form.get('receiver_id')
     content = request.form.get('content')
     
-    if not receiver_id or not content:
+    if not receiver_id or not content or not receiver_id.isdigit():
         return jsonify({'success': False, 'message': '参数错误'})
+    receiver_id = int(receiver_id)
+    sender_id = session['user_id']
+    sender_name = session['username']
+    
+    def on_commit(message_id):
+        unread_cache.delete(receiver_id)
+        set_read_fence(('unread', receiver_id))
+        
+        # 推送给在线的接收者
+        message_hub.publish([receiver_id], 'message', {
+            'id': message_id,
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'sender_name': sender_name,
+            'content': content,
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        })
     
+    error = write_row('message', (sender_id, receiver_id, content), on_commit)
+    if error:
+        return jsonify({'success': False, 'message': error})
+    note_write()
+    return jsonify({'success': True, 'message': '发送成功'})
+
+# 未读计数缓存：user_id -> {发送者 id: 未读条数}，发送和标记已读时失效
+UNREAD_CACHE_TTL = int(os.getenv('UNREAD_CACHE_TTL', 60))
+unread_cache = TTLCache(UNREAD_CACHE_TTL, maxsize=int(os.getenv('UNREAD_CACHE_SIZE', 10000)))
+# 未读计数与消息表对账的间隔（秒）
+UNREAD_RECONCILE_INTERVAL = int(os.getenv('UNREAD_RECONCILE_INTERVAL', 600))
+
+# 其他进程（多个工作进程、异步服务）写入的私聊消息经推送总线到达时，同样让本进程缓存的接收者未读计数失效
+def invalidate_unread_on_message(user_ids, event_type, data):
+    if event_type == 'message':
+        for user_id in user_ids:
+            unread_cache.delete(user_id)
+            set_read_fence(('unread', user_id))
+
+push_bus.listen(invalidate_unread_on_message)
+
+def get_unread_counts(user_id):
+    counts = unread_cache.get(user_id)
+    if counts is None:
+        conn = get_read_connection(('unread', user_id))
+        if conn is None:
+            return None
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT peer_id, count
+            FROM unread_counters
+            WHERE user_id = %s AND count > 0
+        ''', (user_id,))
+        counts = dict(cursor.fetchall())
+        cursor.close()
+        conn.close()
+        unread_cache.set(user_id, counts)
+    return counts
+
+# 按消息表重新计算未读计数，修正计数器漂移
+def reconcile_unread_counters():
     conn = get_db_connection()
     if conn is None:
-        return jsonify({'success': False, 'message': '数据库连接错误'})
-        
+        return
     cursor = conn.cursor()
     try:
+        # 没有未读消息的会话清零（未读 = 已读水位之后的对方消息）
         cursor.execute('''
-            INSERT INTO messages (sender_id, receiver_id, content)
-            VALUES (%s, %s, %s)
-        ''', (session['user_id'], receiver_id, content))
+            UPDATE unread_counters
+            SET count = 0
+            WHERE count > 0 AND NOT EXISTS (
+                SELECT 1 FROM messages m
+                WHERE m.receiver_id = unread_counters.user_id AND m.sender_id = unread_counters.peer_id
+                  AND m.id > COALESCE((
+                      SELECT r.last_read_id FROM conversation_reads r
+                      WHERE r.user_id = unread_counters.user_id AND r.peer_id = unread_counters.peer_id
+                  ), 0)
+            )
+        ''')
+        # 有未读消息的会话写入真实条数
+        cursor.execute(f'''
+            INSERT INTO unread_counters (user_id, peer_id, count)
+            SELECT m.receiver_id, m.sender_id, COUNT(*)
+            FROM messages m
+            LEFT JOIN conversation_reads r ON r.user_id = m.receiver_id AND r.peer_id = m.sender_id
+            WHERE m.id > COALESCE(r.last_read_id, 0)
+            GROUP BY m.receiver_id, m.sender_id
+            {dialect.on_conflict('user_id, peer_id')} count = {dialect.new('count')}
+        ''')
         conn.commit()
-        return jsonify({'success': True, 'message': '发送成功'})
+        unread_cache.clear()
     except Error as e:
-        return jsonify({'success': False, 'message': str(e)})
+        print(f"未读计数对账错误: {e}")
     finally:
         cursor.close()
         conn.close()
 
+def run_unread_reconciler():
+    while True:
+        time.sleep(UNREAD_RECONCILE_INTERVAL)
+        reconcile_unread_counters()
+
 # 获取未读消息数量
 @app.route('/unread_count')
 def unread_count():
     if 'user_id' not in session:
         return jsonify({'count': 0})
-        
-    conn = get_db_connection()
-    if conn is None:
+    
+    counts = get_unread_counts(session['user_id'])
+    if counts is None:
         return jsonify({'count': 0})
-        
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute('''
-        SELECT COUNT(*) as count 
-        FROM messages 
-        WHERE receiver_id = %s AND is_read = FALSE
-    ''', (session['user_id'],))
-    result = cursor.fetchone()
+    
+    return jsonify({'count': sum(counts.values())})
+
+# 按会话获取未读消息数量
+@app.route('/unread_counts')
+def unread_counts():
+    if 'user_id' not in session:
+        return jsonify({'count': 0, 'conversations': {}})
+    
+    counts = get_unread_counts(session['user_id'])
+    if counts is None:
+        return jsonify({'count': 0, 'conversations': {}})
+    
+    return jsonify({'count': sum(counts.values()), 'conversations': counts})
+
+# 会话列表：私聊摘要来自 conversation_summaries，群聊摘要来自 groups 表，一次查询按最近活跃时间合并分页
+CONVERSATION_PAGE_SIZE = int(os.getenv('CONVERSATION_PAGE_SIZE', 20))
+CONVERSATION_PAGE_SIZE_MAX = int(os.getenv('CONVERSATION_PAGE_SIZE_MAX', 100))
+# 会话列表游标：(最近活跃时间, 类型, 对方或群组 id)，编码为 "20240101120000-private-123"
+def encode_conversation_cursor(row):
+    return f"{row['last_message_at'].strftime('%Y%m%d%H%M%S')}-{row['kind']}-{row['target_id']}"
+
+def decode_conversation_cursor(cursor):
+    try:
+        last_message_at, kind, target_id = cursor.split('-')
+        if kind not in ('private', 'group'):
+            return None
+        return datetime.strptime(last_message_at, '%Y%m%d%H%M%S'), kind, int(target_id)
+    except (AttributeError, ValueError):
+        return None
+
+# 整理查询结果：截取一页、生成下一页游标
+def conversations_result(rows, limit=None):
+    limit = CONVERSATION_PAGE_SIZE if limit is None else limit
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    next_cursor = encode_conversation_cursor(rows[-1]) if has_more else None
+    conversations = []
+    for row in rows:
+        conversation = serialize_message(row)
+        del conversation['private_unread'], conversation['last_read_id'], conversation['fanout_on_read']
+        conversations.append(conversation)
+    return conversations, next_cursor
+
+# 会话列表：私聊和群聊按最近一条消息的时间倒序，带最后一条消息预览和未读数
+@app.route('/conversations')
+def conversations():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    before = request.args.get('before')
+    cursor_value = decode_conversation_cursor(before) if before else None
+    if before and cursor_value is None:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    conn = get_read_connection()
+    if conn is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+    
+    limit = get_page_size(CONVERSATION_PAGE_SIZE, CONVERSATION_PAGE_SIZE_MAX)
+    cursor = dialect.repository_cursor(conn, dictionary=True)
+    rows = storage.find_conversations(cursor, session['user_id'], cursor_value, limit)
+    items, next_cursor = conversations_result(rows, limit)
     cursor.close()
     conn.close()
     
-    return jsonify({'count': result['count']})
+    return jsonify({'success': True, 'conversations': items, 'next_cursor': next_cursor})
+
+# 实时消息推送（Server-Sent Events）
+@app.route('/events')
+def events():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'}), 401
+    
+    user_id = session['user_id']
+    subscriber = message_hub.subscribe(user_id)
+    
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event_type, data = subscriber.queue.get(timeout=PUSH_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                yield format_sse(event_type, data)
+                if subscriber.overflowed and subscriber.queue.empty():
+                    subscriber.overflowed = False
+                    yield format_sse('resync', {})
+        finally:
+            message_hub.unsubscribe(user_id, subscriber)
+    
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# 可加入群组每页条数
+GROUP_PAGE_SIZE = int(os.getenv('GROUP_PAGE_SIZE', 20))
+# 群组目录缓存时间（秒），所有用户共享一份
+GROUP_CATALOG_TTL = int(os.getenv('GROUP_CATALOG_TTL', 60))
+# 群组排序方式：成员数、最近活跃、最新创建
+GROUP_SORT_KEYS = {
+    'members': lambda g: (-g['member_count'], -g['id']),
+    'active': lambda g: (-(g['last_message_at'] or g['created_at']).timestamp(), -g['id']),
+    'new': lambda g: -g['id']
+}
+
+# 所有群组的共享目录，按各种排序方式预先排好，过期后由一个请求重新加载
+class GroupCatalog:
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._sorted = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._loaded_at = 0
+        set_read_fence('group_catalog')
+
+    def _load(self):
+        conn = get_read_connection('group_catalog')
+        if conn is None:
+            return None
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute('''
+            SELECT id, name, description, created_by, created_at, member_count, last_message_at
+            FROM `groups`
+        ''')
+        groups = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return {sort: sorted(groups, key=key) for sort, key in GROUP_SORT_KEYS.items()}
+
+    def get(self, sort):
+        if time.monotonic() - self._loaded_at > self._ttl:
+            with self._lock:
+                if time.monotonic() - self._loaded_at > self._ttl:
+                    loaded = self._load()
+                    if loaded is not None:
+                        self._sorted = loaded
+                        self._loaded_at = time.monotonic()
+        if self._sorted is None:
+            return None
+        return self._sorted[sort]
+
+group_catalog = GroupCatalog(GROUP_CATALOG_TTL)
+
+# 用户所在群组 id 集合缓存，加入、创建、被移除时失效
+USER_GROUPS_CACHE_TTL = int(os.getenv('USER_GROUPS_CACHE_TTL', 300))
+user_groups_cache = TTLCache(USER_GROUPS_CACHE_TTL, maxsize=int(os.getenv('USER_GROUPS_CACHE_SIZE', 10000)))
+
+def get_user_group_ids(cursor, user_id):
+    group_ids = user_groups_cache.get(user_id)
+    if group_ids is None:
+        group_ids = frozenset(group_id for group_id, role in storage.list_user_memberships(cursor, user_id))
+        user_groups_cache.set(user_id, group_ids)
+    return group_ids
+
+def invalidate_user_groups(user_id):
+    user_groups_cache.delete(int(user_id))
+    set_read_fence(('groups', int(user_id)))
+
+# 从共享目录中过滤掉用户已加入的群组并分页，返回 (groups, next_offset)，目录加载失败时返回 None
+def get_discoverable_groups(joined_ids, sort='members', offset=0, limit=None):
+    limit = limit or GROUP_PAGE_SIZE
+    catalog = group_catalog.get(sort if sort in GROUP_SORT_KEYS else 'members')
+    if catalog is None:
+        return None
+    page = []
+    skipped = 0
+    for group in catalog:
+        if group['id'] in joined_ids:
+            continue
+        if skipped < offset:
+            skipped += 1
+            continue
+        if len(page) == limit:
+            return page, offset + limit
+        page.append(group)
+    return page, None
 
 # 群组列表页面
 @app.route('/groups')
@@ -459,7 +2861,7 @@ def group_list():
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
+    conn = get_read_connection(('groups', session['user_id']))
     if conn is None:
         flash('数据库连接错误', 'error')
         return redirect(url_for('dashboard'))
@@ -474,22 +2876,52 @@ def group_list():
     ''', (session['user_id'],))
     my_groups = cursor.fetchall()
     
-    # 获取其他可加入的群组
-    cursor.execute('''
-        SELECT g.* 
-        FROM `groups` g
-        WHERE g.id NOT IN (
-            SELECT group_id 
-            FROM group_members 
-            WHERE user_id = %s
-        )
-    ''', (session['user_id'],))
-    other_groups = cursor.fetchall()
-    
     cursor.close()
     conn.close()
     
-    return render_template('groups.html', my_groups=my_groups, other_groups=other_groups)
+    # 获取其他可加入的群组（共享目录中过滤掉已加入的群组）
+    joined_ids = frozenset(g['id'] for g in my_groups)
+    user_groups_cache.set(session['user_id'], joined_ids)
+    page = get_discoverable_groups(joined_ids)
+    if page is None:
+        flash('数据库连接错误', 'error')
+        return redirect(url_for('dashboard'))
+    other_groups, next_offset = page
+    
+    return render_template('groups.html', my_groups=my_groups, other_groups=other_groups, next_offset=next_offset)
+
+# 可加入的群组（分页，可按 members / active / new 排序）
+@app.route('/groups/discover')
+def discover_groups():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    sort = request.args.get('sort', 'members')
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    joined_ids = user_groups_cache.get(session['user_id'])
+    if joined_ids is None:
+        conn = get_read_connection(('groups', session['user_id']))
+        if conn is None:
+            return jsonify({'success': False, 'message': '数据库连接错误'})
+        cursor = conn.cursor(dictionary=True)
+        joined_ids = get_user_group_ids(cursor, session['user_id'])
+        cursor.close()
+        conn.close()
+    
+    page = get_discoverable_groups(joined_ids, sort, offset, get_page_size(GROUP_PAGE_SIZE))
+    if page is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+    groups, next_offset = page
+    
+    return jsonify({
+        'success': True,
+        'groups': [serialize_message(g) for g in groups],
+        'next_offset': next_offset
+    })
 
 # 创建群组
 @app.route('/create_group', methods=['POST'])
@@ -510,19 +2942,15 @@ def create_group():
     cursor = conn.cursor()
     try:
         # 创建群组
-        cursor.execute('''
-            INSERT INTO `groups` (name, description, created_by)
-            VALUES (%s, %s, %s)
-        ''', (name, description, session['user_id']))
-        group_id = cursor.lastrowid
+        group_id = storage.create_group(cursor, name, description, session['user_id'])
         
         # 添加创建者为管理员
-        cursor.execute('''
-            INSERT INTO group_members (group_id, user_id, role)
-            VALUES (%s, %s, 'admin')
-        ''', (group_id, session['user_id']))
+        storage.add_group_member(cursor, group_id, session['user_id'], 'admin')
         
         conn.commit()
+        invalidate_group_role(group_id, session['user_id'])
+        invalidate_user_groups(session['user_id'])
+        group_catalog.invalidate()
         return jsonify({'success': True, 'message': '群组创建成功'})
     except Error as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -543,11 +2971,14 @@ def join_group(group_id):
         
     cursor = conn.cursor()
     try:
-        cursor.execute('''
-            INSERT INTO group_members (group_id, user_id)
-            VALUES (%s, %s)
-        ''', (group_id, session['user_id']))
+        # 新成员的已读水位从加入时的最新消息开始，之前的历史消息不计入未读
+        # 先更新群组行再写成员行，与消息投递在群组行上串行（见 group_fanout_query）
+        storage.adjust_member_count(cursor, group_id, 1)
+        storage.add_group_member(cursor, group_id, session['user_id'])
         conn.commit()
+        invalidate_group_members(group_id)
+        invalidate_group_role(group_id, session['user_id'])
+        invalidate_user_groups(session['user_id'])
         flash('成功加入群组', 'success')
     except Error as e:
         flash('加入群组失败', 'error')
@@ -557,67 +2988,420 @@ def join_group(group_id):
     
     return redirect(url_for('group_list'))
 
+# 群组成员列表缓存，成员变动（加入、移除、升降级）时失效
+GROUP_MEMBERS_CACHE_TTL = int(os.getenv('GROUP_MEMBERS_CACHE_TTL', 300))
+group_members_cache = TTLCache(GROUP_MEMBERS_CACHE_TTL, maxsize=int(os.getenv('GROUP_MEMBERS_CACHE_SIZE', 1024)))
+
+def get_group_members(conn, group_id):
+    members = group_members_cache.get(group_id)
+    if members is None:
+        cursor = dialect.repository_cursor(conn, dictionary=True)
+        members = storage.list_group_members(cursor, group_id)
+        cursor.close()
+        group_members_cache.set(group_id, members)
+    return members
+
+def invalidate_group_members(group_id):
+    group_members_cache.delete(int(group_id))
+    set_read_fence(('members', int(group_id)))
+
+# 群组角色缓存：(group_id, user_id) -> 'admin' / 'member'，不缓存非成员
+# 加入、创建群组和移除、升降级成员时失效，登录时批量预热
+# 缓存只在本进程内失效，其他进程最多在 TTL 内沿用旧角色，因此只用于展示类的读请求
+GROUP_ROLE_CACHE_TTL = int(os.getenv('GROUP_ROLE_CACHE_TTL', 5))
+group_role_cache = TTLCache(GROUP_ROLE_CACHE_TTL, maxsize=int(os.getenv('GROUP_ROLE_CACHE_SIZE', 100000)))
+
+# 获取用户在群组中的角色，不是成员时返回 None
+# fresh=True 时跳过缓存直接查询（写入和管理操作，cursor 须来自主库）
+def get_group_role(cursor, group_id, user_id, fresh=False):
+    key = (int(group_id), int(user_id))
+    role = None if fresh else group_role_cache.get(key)
+    if role is None:
+        role = storage.get_member_role(cursor, *key)
+        if role:
+            group_role_cache.set(key, role)
+        else:
+            group_role_cache.delete(key)
+    return role or None
+
+def invalidate_group_role(group_id, user_id):
+    group_role_cache.delete((int(group_id), int(user_id)))
+
+# 权限判断读主库：副本可能还没应用移除、降级，读取栅栏也只在执行变更的进程内有效
+# 返回角色，不是成员时返回空字符串，主库连接失败时返回 None
+def get_primary_group_role(group_id, user_id):
+    conn = get_db_connection()
+    if conn is None:
+        return None
+    cursor = conn.cursor()
+    try:
+        return get_group_role(cursor, group_id, user_id, fresh=True) or ''
+    finally:
+        cursor.close()
+        conn.close()
+
+# 登录时一次查询预热用户的全部群组角色和群组 id 集合，之后进群、发消息都不用再查成员表
+def preload_user_groups(user_id):
+    conn = get_db_connection()
+    if conn is None:
+        return
+    cursor = dialect.repository_cursor(conn)
+    try:
+        rows = storage.list_user_memberships(cursor, user_id)
+    except Error as e:
+        print(f"预热群组角色错误: {e}")
+        return
+    finally:
+        cursor.close()
+        conn.close()
+    for group_id, role in rows:
+        group_role_cache.set((group_id, user_id), role)
+    user_groups_cache.set(user_id, frozenset(group_id for group_id, role in rows))
+
+# 整理查询结果，返回 (按时间正序的消息, 是否还有更多)
+def group_messages_result(rows, after=None, limit=None, more=False):
+    limit = CHAT_PAGE_SIZE if limit is None else limit
+    has_more = len(rows) > limit or (more and bool(rows))
+    rows = list(rows[:limit])
+    if after is None:
+        rows.reverse()
+    return rows, has_more
+
+def fetch_group_messages(cursor, group_id, before=None, after=None, limit=None):
+    limit = CHAT_PAGE_SIZE if limit is None else limit
+    rows = storage.find_group_messages(cursor, group_id, before, after, limit)
+    # 往前翻页且热表不够一页时，从归档表补齐；新消息只会在热表中
+    lookup = None
+    if after is None:
+        lookup = archive_lookup(get_archive_watermark(cursor, 'group_messages_archive'), before, rows, limit)
+    if lookup == 'query':
+        rows = list(rows) + storage.find_group_messages(cursor, group_id, before, None, limit - len(rows),
+                                                        'group_messages_archive')
+    return group_messages_result(rows, after, limit, more=lookup == 'more')
+
+# 读取请求中的消息 id 参数
+def get_message_id_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return False
+
+# 推进群聊已读水位：只更新成员自己这一行，水位不会回退，同时清理已读的收件箱指针，返回水位是否有变化
+def mark_group_read(conn, group_id, user_id, last_id):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            UPDATE group_members SET last_read_id = %s
+            WHERE group_id = %s AND user_id = %s AND last_read_id < %s
+        ''', (last_id, group_id, user_id, last_id))
+        advanced = cursor.rowcount > 0
+        # 已读的收件箱指针不再需要
+        if advanced:
+            cursor.execute('''
+                DELETE FROM group_inbox
+                WHERE user_id = %s AND group_id = %s AND message_id <= %s
+            ''', (user_id, group_id, last_id))
+        conn.commit()
+        return advanced
+    finally:
+        cursor.close()
+
 # 群组聊天页面
 @app.route('/group_chat/<int:group_id>')
 def group_chat(group_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
-    if conn is None:
+    # 检查用户是否是群组成员（主库）
+    role = get_primary_group_role(group_id, session['user_id'])
+    if role is None:
         flash('数据库连接错误', 'error')
         return redirect(url_for('dashboard'))
-        
-    cursor = conn.cursor(dictionary=True)
-    
-    # 检查用户是否是群组成员
-    cursor.execute('''
-        SELECT role FROM group_members 
-        WHERE group_id = %s AND user_id = %s
-    ''', (group_id, session['user_id']))
-    member = cursor.fetchone()
     
-    if not member:
+    if not role:
         flash('你不是该群组成员', 'error')
         return redirect(url_for('group_list'))
     
+    conn = get_read_connection(('members', group_id))
+    if conn is None:
+        flash('数据库连接错误', 'error')
+        return redirect(url_for('dashboard'))
+        
+    cursor = dialect.repository_cursor(conn, dictionary=True)
+    
     # 获取群组信息
-    cursor.execute('''
-        SELECT g.*, u.username as creator_name
-        FROM `groups` g
-        JOIN users u ON g.created_by = u.id
-        WHERE g.id = %s
-    ''', (group_id,))
-    group = cursor.fetchone()
+    group = storage.get_group(cursor, group_id)
     
-    # 获取群组成员
-    cursor.execute('''
-        SELECT u.id, u.username, gm.role, gm.joined_at
-        FROM group_members gm
-        JOIN users u ON gm.user_id = u.id
-        WHERE gm.group_id = %s
-        ORDER BY gm.joined_at ASC
-    ''', (group_id,))
-    members = cursor.fetchall()
+    # 获取群组成员（缓存）
+    members = get_group_members(conn, group_id)
     
-    # 获取群组消息
-    cursor.execute('''
-        SELECT gm.*, u.username as sender_name
-        FROM group_messages gm
-        JOIN users u ON gm.sender_id = u.id
-        WHERE gm.group_id = %s
-        ORDER BY gm.created_at ASC
-    ''', (group_id,))
-    messages = cursor.fetchall()
+    # 获取最近一页群组消息，更早的消息通过 /group_chat/<group_id>/history 加载
+    messages, has_more = fetch_group_messages(cursor, group_id)
+    next_cursor = messages[0]['id'] if has_more else None
     
     cursor.close()
     conn.close()
+    # 已读水位写入主库
+    if messages:
+        conn = get_db_connection()
+        if conn is not None:
+            if mark_group_read(conn, group_id, session['user_id'], messages[-1]['id']):
+                note_write()
+            conn.close()
     
-    return render_template('group_chat.html', 
+    blocks = render_message_fragments('_group_message.html', messages, session['user_id'])
+    return stream_template('group_chat.html', 
                          group=group, 
                          members=members, 
                          messages=messages,
-                         is_admin=member['role'] == 'admin')
+                         message_blocks=blocks,
+                         next_cursor=next_cursor,
+                         is_admin=role == 'admin')
+
+# 加载更早的群组消息
+@app.route('/group_chat/<int:group_id>/history')
+def group_chat_history(group_id):
+    return group_messages_json(group_id, before=get_message_id_arg('before'))
+
+# 获取指定消息 id 之后的新群组消息
+@app.route('/group_chat/<int:group_id>/messages')
+def group_chat_messages(group_id):
+    after = get_message_id_arg('after')
+    if after is None:
+        return jsonify({'success': False, 'message': '参数错误'})
+    return group_messages_json(group_id, after=after)
+
+def group_messages_json(group_id, before=None, after=None):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    if before is False or after is False:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    role = get_primary_group_role(group_id, session['user_id'])
+    if role is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+    if not role:
+        return jsonify({'success': False, 'message': '你不是该群组成员'})
+    
+    conn = get_read_connection()
+    if conn is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+        
+    cursor = dialect.repository_cursor(conn, dictionary=True)
+    try:
+        messages, has_more = fetch_group_messages(cursor, group_id, before=before, after=after,
+                                                  limit=get_page_size())
+    finally:
+        cursor.close()
+        conn.close()
+    
+    result = {
+        'success': True,
+        'messages': [serialize_message(m) for m in messages],
+        'has_more': has_more
+    }
+    if after is None:
+        result['next_cursor'] = messages[0]['id'] if has_more else None
+    else:
+        result['last_id'] = messages[-1]['id'] if messages else after
+    return jsonify(result)
+
+# 标记群聊已读：客户端上报已读到的最大群消息 id
+@app.route('/group_chat/<int:group_id>/read', methods=['POST'])
+def mark_group_chat_read(group_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    last_id = request.form.get('last_id', type=int)
+    if last_id is None:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+    
+    cursor = conn.cursor()
+    if not get_group_role(cursor, group_id, session['user_id'], fresh=True):
+        cursor.close()
+        conn.close()
+        return jsonify({'success': False, 'message': '你不是该群组成员'})
+    # 水位不能超过群里实际的最后一条消息
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM group_messages WHERE group_id = %s', (group_id,))
+    last_id = min(last_id, cursor.fetchone()[0])
+    cursor.close()
+    if mark_group_read(conn, group_id, session['user_id'], last_id):
+        note_write()
+    conn.close()
+    
+    return jsonify({'success': True, 'last_read_id': last_id})
+
+# 群组投递：成员数不超过阈值的群组写扩散，每条消息给除发送者外的每个成员写一条收件箱指针，
+# 未读数和跨群未读流只读用户自己的指针；超过阈值的群组读扩散，按已读水位扫描群消息表
+# 群组切换到读扩散后不再切回，否则切换期间的消息没有指针
+# 指针和消息在同一个写事务内写入，批量写入时一批消息最多产生 批大小 × 阈值 行指针，阈值不宜过大
+GROUP_FANOUT_MAX_MEMBERS = int(os.getenv('GROUP_FANOUT_MAX_MEMBERS', 100))
+GROUP_INBOX_INSERT_BATCH = 1000
+GROUP_FEED_PAGE_SIZE = int(os.getenv('GROUP_FEED_PAGE_SIZE', 50))
+
+# 锁定本批消息所在的群组行，返回 [(group_id, 是否读扩散)]：已经切换的，或成员数超过阈值需要切换的
+# 加入群组先更新群组行（adjust_member_count）再写成员行，与投递在群组行上串行：
+# 投递先拿到锁时，加入要等消息提交，新成员的水位会覆盖这条消息；加入先提交时，投递在拿到锁之后
+# 才读取成员（这之前事务内没有一致性读），能看到新成员并给他写指针。因此不会有消息既无指针又在水位之后
+def group_fanout_query(group_ids):
+    placeholders = ', '.join(['%s'] * len(group_ids))
+    sql = f'''
+        SELECT id, fanout_on_read OR member_count > %s FROM `groups`
+        WHERE id IN ({placeholders})
+        ORDER BY id
+        {dialect.for_update}
+    '''
+    return sql, (GROUP_FANOUT_MAX_MEMBERS,) + tuple(group_ids)
+
+# 写扩散群组的成员（普通一致性读，不给成员行加锁，不阻塞加入群组和标记已读）
+def group_fanout_members_query(group_ids):
+    placeholders = ', '.join(['%s'] * len(group_ids))
+    return f'SELECT group_id, user_id FROM group_members WHERE group_id IN ({placeholders})', tuple(group_ids)
+
+# 投递语句：切换大群的投递方式，给写扩散群组的成员写指针（多行 INSERT，按批拆分）
+# messages 为 [(message_id, group_id, sender_id)]，members 为 [(group_id, user_id)]
+def group_delivery_statements(messages, fanout_on_read_ids, members):
+    statements = []
+    if fanout_on_read_ids:
+        ids = sorted(fanout_on_read_ids)
+        statements.append((f'''
+            UPDATE `groups` SET fanout_on_read = TRUE
+            WHERE id IN ({', '.join(['%s'] * len(ids))}) AND NOT fanout_on_read
+        ''', tuple(ids)))
+    members_by_group = {}
+    for group_id, user_id in members:
+        members_by_group.setdefault(group_id, []).append(user_id)
+    rows = [(user_id, group_id, message_id)
+            for message_id, group_id, sender_id in messages
+            for user_id in members_by_group.get(group_id, ()) if user_id != sender_id]
+    for i in range(0, len(rows), GROUP_INBOX_INSERT_BATCH):
+        batch = rows[i:i + GROUP_INBOX_INSERT_BATCH]
+        statements.append(('INSERT INTO group_inbox (user_id, group_id, message_id) VALUES '
+                           + ', '.join(['(%s, %s, %s)'] * len(batch)),
+                           tuple(value for row in batch for value in row)))
+    return statements
+
+# 在写入群消息的事务内投递到成员收件箱
+def deliver_group_messages(cursor, messages):
+    group_ids = sorted({group_id for message_id, group_id, sender_id in messages})
+    cursor.execute(*group_fanout_query(group_ids))
+    fanout_on_read_ids = {group_id for group_id, on_read in cursor.fetchall() if on_read}
+    fanout_ids = [group_id for group_id in group_ids if group_id not in fanout_on_read_ids]
+    members = []
+    if fanout_ids:
+        cursor.execute(*group_fanout_members_query(fanout_ids))
+        members = cursor.fetchall()
+    for statement in group_delivery_statements(messages, fanout_on_read_ids, members):
+        cursor.execute(*statement)
+
+# 用户各群组的未读数：写扩散群组数自己的指针，读扩散群组扫描水位之后的消息
+def group_unread_query(user_id):
+    sql = '''
+        SELECT i.group_id, COUNT(*)
+        FROM group_inbox i
+        JOIN group_members gm ON gm.group_id = i.group_id AND gm.user_id = i.user_id
+        JOIN `groups` g ON g.id = i.group_id
+        WHERE i.user_id = %s AND i.message_id > gm.last_read_id AND NOT g.fanout_on_read
+        GROUP BY i.group_id
+        UNION ALL
+        SELECT gm.group_id,
+               (SELECT COUNT(*) FROM group_messages m
+                WHERE m.group_id = gm.group_id AND m.id > gm.last_read_id AND m.sender_id <> gm.user_id)
+        FROM group_members gm
+        JOIN `groups` g ON g.id = gm.group_id
+        WHERE gm.user_id = %s AND g.fanout_on_read
+    '''
+    return sql, (user_id, user_id)
+
+# 跨群未读消息流：所有群组中已读水位之后的他人消息按 id 倒序分页，游标为上一页最后一条消息 id
+# 写扩散群组取自收件箱指针，读扩散群组逐个按 (group_id) 索引取一页，合并后统一取详情
+def fetch_group_feed(cursor, user_id, before=None, limit=None):
+    limit = limit or GROUP_FEED_PAGE_SIZE
+    before_condition = 'AND i.message_id < %s' if before else ''
+    cursor.execute(f'''
+        SELECT i.message_id
+        FROM group_inbox i
+        JOIN group_members gm ON gm.group_id = i.group_id AND gm.user_id = i.user_id
+        JOIN `groups` g ON g.id = i.group_id
+        WHERE i.user_id = %s AND i.message_id > gm.last_read_id AND NOT g.fanout_on_read {before_condition}
+        ORDER BY i.message_id DESC
+        LIMIT %s
+    ''', (user_id,) + ((before,) if before else ()) + (limit + 1,))
+    ids = [row['message_id'] for row in cursor.fetchall()]
+    
+    cursor.execute('''
+        SELECT gm.group_id, gm.last_read_id
+        FROM group_members gm
+        JOIN `groups` g ON g.id = gm.group_id
+        WHERE gm.user_id = %s AND g.fanout_on_read
+    ''', (user_id,))
+    before_condition = 'AND id < %s' if before else ''
+    for group in cursor.fetchall():
+        cursor.execute(f'''
+            SELECT id FROM group_messages
+            WHERE group_id = %s AND id > %s AND sender_id <> %s {before_condition}
+            ORDER BY id DESC
+            LIMIT %s
+        ''', (group['group_id'], group['last_read_id'], user_id) + ((before,) if before else ()) + (limit + 1,))
+        ids += [row['id'] for row in cursor.fetchall()]
+    
+    ids = sorted(set(ids), reverse=True)[:limit + 1]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    documents = fetch_search_documents(cursor, 'group_message', ids) if ids else {}
+    messages = [documents[message_id] for message_id in ids if message_id in documents]
+    return messages, ids[-1] if has_more else None
+
+# 按群组获取未读消息数量
+@app.route('/group_unread_counts')
+def group_unread_counts():
+    if 'user_id' not in session:
+        return jsonify({'count': 0, 'groups': {}})
+    
+    conn = get_read_connection()
+    if conn is None:
+        return jsonify({'count': 0, 'groups': {}})
+    
+    cursor = conn.cursor()
+    cursor.execute(*group_unread_query(session['user_id']))
+    counts = {group_id: count for group_id, count in cursor.fetchall() if count}
+    cursor.close()
+    conn.close()
+    
+    return jsonify({'count': sum(counts.values()), 'groups': counts})
+
+# 跨群未读消息流
+@app.route('/group_feed')
+def group_feed():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    before = get_message_id_arg('before')
+    if before is False:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    conn = get_read_connection()
+    if conn is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+    
+    cursor = conn.cursor(dictionary=True)
+    messages, next_cursor = fetch_group_feed(cursor, session['user_id'], before, get_page_size(GROUP_FEED_PAGE_SIZE))
+    cursor.close()
+    conn.close()
+    
+    return jsonify({
+        'success': True,
+        'messages': [serialize_message(m) for m in messages],
+        'next_cursor': next_cursor
+    })
 
 # 发送群组消息
 @app.route('/send_group_message', methods=['POST'])
@@ -628,8 +3412,9 @@ def send_group_message():
     group_id = request.form.get('group_id')
     content = request.form.get('content')
     
-    if not group_id or not content:
+    if not group_id or not content or not group_id.isdigit():
         return jsonify({'success': False, 'message': '参数错误'})
+    group_id = int(group_id)
     
     conn = get_db_connection()
     if conn is None:
@@ -637,28 +3422,37 @@ def send_group_message():
         
     cursor = conn.cursor()
     try:
-        # 检查用户是否是群组成员
-        cursor.execute('''
-            SELECT 1 FROM group_members 
-            WHERE group_id = %s AND user_id = %s
-        ''', (group_id, session['user_id']))
-        
-        if not cursor.fetchone():
+        # 检查用户是否是群组成员：写入前以主库为准，不信任其他进程可能未失效的缓存
+        if not get_group_role(cursor, group_id, session['user_id'], fresh=True):
             return jsonify({'success': False, 'message': '你不是该群组成员'})
         
-        # 发送消息
-        cursor.execute('''
-            INSERT INTO group_messages (group_id, sender_id, content)
-            VALUES (%s, %s, %s)
-        ''', (group_id, session['user_id'], content))
-        
-        conn.commit()
-        return jsonify({'success': True, 'message': '发送成功'})
+        member_ids = [m['id'] for m in get_group_members(conn, group_id) if m['id'] != session['user_id']]
     except Error as e:
         return jsonify({'success': False, 'message': str(e)})
     finally:
         cursor.close()
         conn.close()
+    
+    sender_id = session['user_id']
+    sender_name = session['username']
+    
+    def on_commit(message_id):
+        # 推送给在线的其他群成员
+        message_hub.publish(member_ids, 'group_message', {
+            'id': message_id,
+            'group_id': group_id,
+            'sender_id': sender_id,
+            'sender_name': sender_name,
+            'content': content,
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        })
+    
+    # 发送消息
+    error = write_row('group_message', (group_id, sender_id, content), on_commit)
+    if error:
+        return jsonify({'success': False, 'message': error})
+    note_write()
+    return jsonify({'success': True, 'message': '发送成功'})
 
 # 管理群组成员
 @app.route('/manage_group/<int:group_id>', methods=['GET', 'POST'])
@@ -673,14 +3467,10 @@ def manage_group(group_id):
         
     cursor = conn.cursor(dictionary=True)
     
-    # 检查用户是否是群组管理员
-    cursor.execute('''
-        SELECT role FROM group_members 
-        WHERE group_id = %s AND user_id = %s
-    ''', (group_id, session['user_id']))
-    member = cursor.fetchone()
+    # 检查用户是否是群组管理员（以主库为准）
+    role = get_group_role(cursor, group_id, session['user_id'], fresh=True)
     
-    if not member or member['role'] != 'admin':
+    if role != 'admin':
         flash('你没有权限管理该群组', 'error')
         return redirect(url_for('group_list'))
     
@@ -689,78 +3479,104 @@ def manage_group(group_id):
         user_id = request.form.get('user_id')
         
         if action == 'remove':
-            cursor.execute('''
-                DELETE FROM group_members 
-                WHERE group_id = %s AND user_id = %s
-            ''', (group_id, user_id))
+            if storage.remove_group_member(cursor, group_id, user_id):
+                storage.adjust_member_count(cursor, group_id, -1)
             flash('成员已移除', 'success')
         elif action == 'promote':
-            cursor.execute('''
-                UPDATE group_members 
-                SET role = 'admin' 
-                WHERE group_id = %s AND user_id = %s
-            ''', (group_id, user_id))
+            storage.set_member_role(cursor, group_id, user_id, 'admin')
             flash('成员已提升为管理员', 'success')
         elif action == 'demote':
-            cursor.execute('''
-                UPDATE group_members 
-                SET role = 'member' 
-                WHERE group_id = %s AND user_id = %s
-            ''', (group_id, user_id))
+            storage.set_member_role(cursor, group_id, user_id, 'member')
             flash('成员已降级为普通成员', 'success')
         
         conn.commit()
+        invalidate_group_members(group_id)
+        if user_id and user_id.isdigit():
+            invalidate_group_role(group_id, user_id)
+            if action == 'remove':
+                invalidate_user_groups(user_id)
         return redirect(url_for('manage_group', group_id=group_id))
     
     # 获取群组信息
-    cursor.execute('''
-        SELECT g.*, u.username as creator_name
-        FROM `groups` g
-        JOIN users u ON g.created_by = u.id
-        WHERE g.id = %s
-    ''', (group_id,))
-    group = cursor.fetchone()
+    group = storage.get_group(cursor, group_id)
     
-    # 获取群组成员
-    cursor.execute('''
-        SELECT u.id, u.username, gm.role, gm.joined_at
-        FROM group_members gm
-        JOIN users u ON gm.user_id = u.id
-        WHERE gm.group_id = %s
-        ORDER BY gm.joined_at ASC
-    ''', (group_id,))
-    members = cursor.fetchall()
+    # 获取群组成员（缓存）
+    members = get_group_members(conn, group_id)
     
     cursor.close()
     conn.close()
     
     return render_template('manage_group.html', group=group, members=members)
 
+# 评论每页条数
+COMMENT_PAGE_SIZE = int(os.getenv('COMMENT_PAGE_SIZE', 20))
+# 评论首页缓存，发表评论时清空
+COMMENT_CACHE_TTL = int(os.getenv('COMMENT_CACHE_TTL', 30))
+comment_first_page_cache = TTLCache(COMMENT_CACHE_TTL, maxsize=16)
+# 带游标的评论页只包含游标之前的评论，新评论不会改变它们，可以缓存更久
+COMMENT_PAGE_CACHE_TTL = int(os.getenv('COMMENT_PAGE_CACHE_TTL', 600))
+comment_page_cache = TTLCache(COMMENT_PAGE_CACHE_TTL, maxsize=int(os.getenv('COMMENT_PAGE_CACHE_SIZE', 256)))
+
+def fetch_comment_page(cursor, before=None, limit=None):
+    limit = limit or COMMENT_PAGE_SIZE
+    rows = storage.find_comments(cursor, before, limit)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_more else None
+    return rows, next_cursor
+
+# 读取一页评论（先查缓存），数据库连接失败时返回 None
+def get_comment_page(before=None, limit=None):
+    limit = limit or COMMENT_PAGE_SIZE
+    cache = comment_page_cache if before else comment_first_page_cache
+    key = (before, limit)
+    page = cache.get(key)
+    if page is None:
+        conn = get_read_connection('comments')
+        if conn is None:
+            return None
+        cursor = conn.cursor(dictionary=True)
+        page = fetch_comment_page(cursor, decode_cursor(before) if before else None, limit)
+        cursor.close()
+        conn.close()
+        cache.set(key, page)
+    return page
+
 # 评论区页面
 @app.route('/comments')
 def comment_list():
     if 'user_id' not in session:
         return redirect(url_for('login'))
-        
-    conn = get_db_connection()
-    if conn is None:
+    
+    # 获取最新一页评论，包括评论者信息，更早的评论通过 /comments/page 加载
+    page = get_comment_page()
+    if page is None:
         flash('数据库连接错误', 'error')
         return redirect(url_for('dashboard'))
-        
-    cursor = conn.cursor(dictionary=True)
-    # 获取所有评论，包括评论者信息
-    cursor.execute('''
-        SELECT c.*, u.username
-        FROM comments c
-        JOIN users u ON c.user_id = u.id
-        ORDER BY c.created_at DESC
-    ''')
-    comments = cursor.fetchall()
+    comments, next_cursor = page
     
-    cursor.close()
-    conn.close()
+    return render_template('comments.html', comments=comments, next_cursor=next_cursor)
+
+# 加载更早的评论
+@app.route('/comments/page')
+def comment_page():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    before = request.args.get('before')
+    if before and decode_cursor(before) is None:
+        return jsonify({'success': False, 'message': '参数错误'})
     
-    return render_template('comments.html', comments=comments)
+    page = get_comment_page(before, get_page_size(COMMENT_PAGE_SIZE))
+    if page is None:
+        return jsonify({'success': False, 'message': '数据库连接错误'})
+    comments, next_cursor = page
+    
+    return jsonify({
+        'success': True,
+        'comments': [serialize_message(c) for c in comments],
+        'next_cursor': next_cursor
+    })
 
 # 发表评论
 @app.route('/add_comment', methods=['POST'])
@@ -772,24 +3588,372 @@ def add_comment():
     if not content:
         return jsonify({'success': False, 'message': '评论内容不能为空'})
     
+    def on_commit(comment_id):
+        comment_first_page_cache.clear()
+        set_read_fence('comments')
+    
+    error = write_row('comment', (session['user_id'], content), on_commit)
+    if error:
+        return jsonify({'success': False, 'message': error})
+    note_write()
+    return jsonify({'success': True, 'message': '评论发表成功'})
+
+# 全文搜索配置：关闭后不再写倒排表，搜索接口返回空结果
+SEARCH_ENABLED = os.getenv('SEARCH_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+SEARCH_PAGE_SIZE_MAX = int(os.getenv('SEARCH_PAGE_SIZE_MAX', 100))
+# 排序结果最多翻到第几条，避免深分页扫描大量倒排记录
+SEARCH_MAX_OFFSET = int(os.getenv('SEARCH_MAX_OFFSET', 1000))
+SEARCH_MAX_TERMS = 16
+SEARCH_TERM_LENGTH = 32
+SEARCH_INSERT_BATCH = 1000
+# 每个查询词最多统计的倒排记录数，所有查询词都很常见时只在最少见词的最新这么多篇文档中查找
+SEARCH_MAX_POSTINGS = int(os.getenv('SEARCH_MAX_POSTINGS', 1000))
+# 文档类型在倒排表中的编号
+SEARCH_DOC_TYPES = {'message': 1, 'group_message': 2, 'comment': 3}
+SEARCH_DOC_TYPE_NAMES = {value: key for key, value in SEARCH_DOC_TYPES.items()}
+
+# 中日韩文字没有空格分词，按单字（unigram）和相邻两个字（bigram）切分；其他文字按连续的字母数字切成词
+# 建索引时单字和双字都写入，单字查询（如“好”）也能命中；查询时连续两个字以上只用区分度更高的双字
+# 修改分词规则后需要运行 rebuild_search_index() 重建倒排表
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+SEARCH_TOKEN_RE = re.compile(f'([{CJK_CHARS}]+)|([^\\W{CJK_CHARS}]+)')
+
+def tokenize(text, query=False):
+    # 全角字母数字转半角，统一小写
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = []
+    for cjk, word in SEARCH_TOKEN_RE.findall(text):
+        if word:
+            tokens.append(word[:SEARCH_TERM_LENGTH])
+            continue
+        if len(cjk) == 1 or not query:
+            tokens.extend(cjk)
+        tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
+
+# 可见范围：私聊消息对双方可见，群组消息对群成员可见，评论公开
+COMMENT_SCOPES = ('c',)
+
+def message_scopes(sender_id, receiver_id):
+    return tuple(f'u:{user_id}' for user_id in sorted({sender_id, receiver_id}))
+
+def group_message_scopes(group_id):
+    return (f'g:{group_id}',)
+
+def user_search_scopes(user_id, group_ids):
+    return [f'u:{user_id}'] + [f'g:{group_id}' for group_id in sorted(group_ids)] + list(COMMENT_SCOPES)
+
+# 倒排记录的多行插入语句，docs 为 [(doc_id, scopes, content)]，按批拆成多条 (sql, params)
+def search_postings_inserts(doc_type, docs):
+    rows = []
+    for doc_id, scopes, content in docs:
+        for term, tf in Counter(tokenize(content)).items():
+            for scope in scopes:
+                rows.append((term, scope, SEARCH_DOC_TYPES[doc_type], doc_id, min(tf, 32767)))
+    statements = []
+    for i in range(0, len(rows), SEARCH_INSERT_BATCH):
+        batch = rows[i:i + SEARCH_INSERT_BATCH]
+        sql = f'''
+            INSERT INTO search_postings (term, scope, doc_type, doc_id, tf)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(batch))}
+            {dialect.on_conflict('term, scope, doc_type, doc_id')} tf = {dialect.new('tf')}
+        '''
+        statements.append((sql, [value for row in batch for value in row]))
+    return statements
+
+# 在写入文档的同一事务内更新倒排表
+def index_documents(cursor, doc_type, docs):
+    if not SEARCH_ENABLED:
+        return
+    for sql, params in search_postings_inserts(doc_type, docs):
+        cursor.execute(sql, params)
+
+# 可见范围和文档类型的过滤条件
+def search_filter(scopes, doc_type=None):
+    condition = f"scope IN ({', '.join(['%s'] * len(scopes))})"
+    params = list(scopes)
+    if doc_type is not None:
+        condition += ' AND doc_type = %s'
+        params.append(SEARCH_DOC_TYPES[doc_type])
+    return condition, params
+
+# 每个查询词在可见范围内的文档数，最多数到 SEARCH_MAX_POSTINGS + 1，常见词不会扫完整个倒排链
+def term_frequency_query(terms, scopes, doc_type=None):
+    condition, filter_params = search_filter(scopes, doc_type)
+    branches = []
+    params = []
+    for i, term in enumerate(terms):
+        branches.append(f'''
+            SELECT %s AS term, COUNT(*) AS df FROM (
+                SELECT 1 FROM search_postings WHERE term = %s AND {condition} LIMIT %s
+            ) t{i}
+        ''')
+        params += [term, term] + filter_params + [SEARCH_MAX_POSTINGS + 1]
+    return ' UNION ALL '.join(branches), params
+
+# 候选文档：取最少见的词在可见范围内最新的 SEARCH_MAX_POSTINGS 篇文档
+def search_candidates_query(term, scopes, doc_type=None):
+    condition, params = search_filter(scopes, doc_type)
+    sql = f'''
+        SELECT DISTINCT doc_type, doc_id FROM search_postings
+        WHERE term = %s AND {condition}
+        ORDER BY doc_id DESC
+        LIMIT %s
+    '''
+    return sql, [term] + params + [SEARCH_MAX_POSTINGS]
+
+# 一页搜索结果的查询语句：只在候选文档 {doc_type: [doc_id]} 中查找，文档必须包含全部查询词，
+# 按词频之和排序，同分时新的在前
+def search_query(terms, scopes, candidates, doc_type=None, offset=0, limit=None):
+    limit = SEARCH_PAGE_SIZE if limit is None else limit
+    condition, filter_params = search_filter(scopes, doc_type)
+    candidate_conditions = []
+    candidate_params = []
+    for number, doc_ids in sorted(candidates.items()):
+        candidate_conditions.append(f"(doc_type = %s AND doc_id IN ({', '.join(['%s'] * len(doc_ids))}))")
+        candidate_params += [number] + list(doc_ids)
+    sql = f'''
+        SELECT doc_type, doc_id, SUM(tf) AS score
+        FROM search_postings
+        WHERE term IN ({', '.join(['%s'] * len(terms))})
+          AND {condition}
+          AND ({' OR '.join(candidate_conditions)})
+        GROUP BY doc_type, doc_id
+        HAVING COUNT(*) = %s
+        ORDER BY score DESC, doc_id DESC
+        LIMIT %s OFFSET %s
+    '''
+    params = list(terms) + filter_params + candidate_params + [len(terms), limit + 1, offset]
+    return sql, params
+
+# 按文档类型批量读取命中的文档，热表中没有的（已归档）再查归档表
+SEARCH_DOCUMENT_QUERIES = {
+    'message': ('messages', 'messages_archive', '''
+        SELECT m.id, m.sender_id, m.receiver_id, m.content, m.created_at, u.username AS sender_name
+        FROM {table} m JOIN users u ON u.id = m.sender_id
+        WHERE m.id IN ({ids})
+    '''),
+    'group_message': ('group_messages', 'group_messages_archive', '''
+        SELECT m.id, m.group_id, m.sender_id, m.content, m.created_at,
+               u.username AS sender_name, g.name AS group_name
+        FROM {table} m JOIN users u ON u.id = m.sender_id JOIN `groups` g ON g.id = m.group_id
+        WHERE m.id IN ({ids})
+    '''),
+    'comment': ('comments', None, '''
+        SELECT c.id, c.user_id AS sender_id, c.content, c.created_at, u.username AS sender_name
+        FROM {table} c JOIN users u ON u.id = c.user_id
+        WHERE c.id IN ({ids})
+    ''')
+}
+
+def fetch_search_documents(cursor, doc_type, doc_ids):
+    table, archive, template = SEARCH_DOCUMENT_QUERIES[doc_type]
+    documents = {}
+    for name in (table, archive if ARCHIVE_ENABLED else None):
+        missing = [doc_id for doc_id in doc_ids if doc_id not in documents]
+        if not name or not missing:
+            continue
+        cursor.execute(template.format(table=name, ids=', '.join(['%s'] * len(missing))), missing)
+        documents.update((row['id'], row) for row in cursor.fetchall())
+    return documents
+
+# 搜索消息和评论，返回 (results, next_offset)
+def search_documents(conn, user_id, text, doc_type=None, offset=0, limit=None):
+    limit = SEARCH_PAGE_SIZE if limit is None else limit
+    terms = sorted(set(tokenize(text, query=True)))[:SEARCH_MAX_TERMS]
+    if not terms or not SEARCH_ENABLED:
+        return [], None
+    cursor = conn.cursor(dictionary=True)
+    try:
+        # 群组范围以主库的成员表为准，被移出群组后立即搜不到该群的消息
+        group_ids = [group_id for group_id, role in storage.list_user_memberships(cursor, user_id)]
+        scopes = user_search_scopes(user_id, group_ids)
+        # 从最少见的词开始求交集，只在它的候选文档中统计其他词
+        cursor.execute(*term_frequency_query(terms, scopes, doc_type))
+        frequencies = {row['term']: row['df'] for row in cursor.fetchall()}
+        rarest = min(terms, key=lambda term: frequencies.get(term, 0))
+        if not frequencies.get(rarest):
+            return [], None
+        cursor.execute(*search_candidates_query(rarest, scopes, doc_type))
+        candidates = {}
+        for row in cursor.fetchall():
+            candidates.setdefault(row['doc_type'], []).append(row['doc_id'])
+        cursor.execute(*search_query(terms, scopes, candidates, doc_type, offset, limit))
+        hits = cursor.fetchall()
+        has_more = len(hits) > limit and offset + limit < SEARCH_MAX_OFFSET
+        hits = hits[:limit]
+        
+        documents = {}
+        for name, number in SEARCH_DOC_TYPES.items():
+            doc_ids = [hit['doc_id'] for hit in hits if hit['doc_type'] == number]
+            if doc_ids:
+                documents[number] = fetch_search_documents(cursor, name, doc_ids)
+    finally:
+        cursor.close()
+    
+    results = []
+    for hit in hits:
+        document = documents[hit['doc_type']].get(hit['doc_id'])
+        if document is None:
+            continue
+        result = serialize_message(document)
+        result['type'] = SEARCH_DOC_TYPE_NAMES[hit['doc_type']]
+        result['score'] = int(hit['score'])
+        results.append(result)
+    return results, offset + limit if has_more else None
+
+# 全文搜索：q 为关键词，type 可选 message / group_message / comment，offset 翻页
+@app.route('/search')
+def search():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    text = request.args.get('q', '').strip()
+    doc_type = request.args.get('type') or None
+    offset = request.args.get('offset', '0')
+    if not text or (doc_type and doc_type not in SEARCH_DOC_TYPES) or not offset.isdigit():
+        return jsonify({'success': False, 'message': '参数错误'})
+    offset = int(offset)
+    if offset >= SEARCH_MAX_OFFSET:
+        return jsonify({'success': True, 'results': [], 'next_offset': None})
+    
     conn = get_db_connection()
     if conn is None:
         return jsonify({'success': False, 'message': '数据库连接错误'})
-        
+    
+    limit = min(get_page_size(SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE_MAX), SEARCH_MAX_OFFSET - offset)
+    try:
+        results, next_offset = search_documents(conn, session['user_id'], text, doc_type, offset, limit)
+    except Error as e:
+        return jsonify({'success': False, 'message': str(e)})
+    finally:
+        conn.close()
+    
+    return jsonify({'success': True, 'results': results, 'next_offset': next_offset})
+
+# 重建倒排表：用于首次启用搜索或修改分词规则后，按 id 分批读取已有的消息和评论（含归档）
+def rebuild_search_index(batch_size=1000):
+    conn = get_db_connection()
+    if conn is None:
+        return
+    sources = [
+        ('message', 'messages', 'id, sender_id, receiver_id, content',
+         lambda row: (row[0], message_scopes(row[1], row[2]), row[3])),
+        ('message', 'messages_archive', 'id, sender_id, receiver_id, content',
+         lambda row: (row[0], message_scopes(row[1], row[2]), row[3])),
+        ('group_message', 'group_messages', 'id, group_id, content',
+         lambda row: (row[0], group_message_scopes(row[1]), row[2])),
+        ('group_message', 'group_messages_archive', 'id, group_id, content',
+         lambda row: (row[0], group_message_scopes(row[1]), row[2])),
+        ('comment', 'comments', 'id, content',
+         lambda row: (row[0], COMMENT_SCOPES, row[1]))
+    ]
     cursor = conn.cursor()
     try:
-        cursor.execute('''
-            INSERT INTO comments (user_id, content)
-            VALUES (%s, %s)
-        ''', (session['user_id'], content))
+        cursor.execute('DELETE FROM search_postings')
         conn.commit()
-        return jsonify({'success': True, 'message': '评论发表成功'})
+        for doc_type, table, columns, to_doc in sources:
+            last_id = 0
+            while True:
+                cursor.execute(f'SELECT {columns} FROM {table} WHERE id > %s ORDER BY id LIMIT %s',
+                               (last_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                for sql, params in search_postings_inserts(doc_type, [to_doc(row) for row in rows]):
+                    cursor.execute(sql, params)
+                conn.commit()
+                last_id = rows[-1][0]
+    finally:
+        cursor.close()
+        conn.close()
+
+# 消息归档配置：超过保留天数的私聊和群组消息移入归档表，0 表示不归档（默认），需要显式开启
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 0))
+ARCHIVE_ENABLED = ARCHIVE_AFTER_DAYS > 0
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+# 归档任务执行间隔（秒）
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', 86400))
+
+# 只归档所有接收者都已读的消息：未读数只统计热表，未读消息留在热表中，归档不会改变任何人的未读数
+# 私聊看接收者的已读水位，群聊看除发送者外每个成员的已读水位（条件中消息表的别名为 m）
+ARCHIVE_READ_CONDITIONS = {
+    'messages': '''m.id <= COALESCE((
+        SELECT r.last_read_id FROM conversation_reads r
+        WHERE r.user_id = m.receiver_id AND r.peer_id = m.sender_id
+    ), 0)''',
+    'group_messages': '''NOT EXISTS (
+        SELECT 1 FROM group_members gm
+        WHERE gm.group_id = m.group_id AND gm.user_id <> m.sender_id AND gm.last_read_id < m.id
+    )'''
+}
+
+# 把一张表中早于 cutoff 且已读的消息分批移入归档表，每批一个事务，返回移动的条数
+def archive_table(conn, table, archive_table_name, columns, cutoff):
+    condition = f'm.created_at < %s AND {ARCHIVE_READ_CONDITIONS[table]}'
+    cursor = conn.cursor()
+    moved = 0
+    try:
+        while True:
+            cursor.execute(f'''
+                SELECT MIN(id), MAX(id) FROM (
+                    SELECT m.id FROM {table} m WHERE {condition} ORDER BY m.id LIMIT %s
+                ) t
+            ''', (cutoff, ARCHIVE_BATCH_SIZE))
+            min_id, max_id = cursor.fetchone()
+            if max_id is None:
+                break
+            cursor.execute(f'''
+                {dialect.insert_ignore} INTO {archive_table_name} ({columns})
+                SELECT {', '.join('m.' + column.strip() for column in columns.split(','))}
+                FROM {table} m WHERE m.id BETWEEN %s AND %s AND {condition}
+            ''', (min_id, max_id, cutoff))
+            # 只删除已经在归档表中的行：两条语句之间水位可能前进，不能按已读条件再判断一次
+            cursor.execute(f'''
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {archive_table_name} WHERE id BETWEEN %s AND %s
+                )
+            ''', (min_id, max_id))
+            moved += cursor.rowcount
+            conn.commit()
+            archive_watermarks.delete(archive_table_name)
     except Error as e:
-        return jsonify({'success': False, 'message': str(e)})
+        conn.rollback()
+        print(f"消息归档错误: {e}")
     finally:
         cursor.close()
+    return moved
+
+def archive_old_messages():
+    conn = get_db_connection()
+    if conn is None:
+        return
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    try:
+        archive_table(conn, 'messages', 'messages_archive',
+                      'id, sender_id, receiver_id, content, created_at, is_read', cutoff)
+        archive_table(conn, 'group_messages', 'group_messages_archive',
+                      'id, group_id, sender_id, content, created_at', cutoff)
+    finally:
         conn.close()
 
+def run_message_archiver():
+    while True:
+        archive_old_messages()
+        time.sleep(ARCHIVE_INTERVAL)
+
+# 启动后台任务
+def start_background_jobs():
+    password_hasher.start()
+    push_bus.start()
+    threading.Thread(target=run_unread_reconciler, name='unread-reconciler', daemon=True).start()
+    if ARCHIVE_ENABLED:
+        threading.Thread(target=run_message_archiver, name='message-archiver', daemon=True).start()
+    if replica_set:
+        threading.Thread(target=run_replica_monitor, name='replica-monitor', daemon=True).start()
+
 if __name__ == '__main__':
     init_db()
+    start_background_jobs()
     app.run(debug=True)
\ No newline at end of file
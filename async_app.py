@@ -0,0 +1,480 @@
+# 异步消息服务：用 aiohttp + aiomysql 提供聊天相关接口，空闲的长连接客户端不再各占一个线程
+#
+# 和同步的 Flask 应用（app.py）共用数据库、登录会话（同一个服务端会话存储，SESSION_STORE 需为 sqlite）、
+# 推送总线（PUSH_BACKEND 需为 sqlite，两边写入的消息互相推送）和查询语句，
+# 两个服务同时运行，由反向代理把下面这些路径转发到本服务，其余路径仍由 Flask 处理：
+#   /send_message  /send_group_message  /unread_count  /unread_counts  /events
+#   /chat/<id>/history  /group_chat/<id>/history  /group_chat/<id>/messages
+#
+# 运行：python async_app.py --host 127.0.0.1 --port 5001
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import aiomysql
+from aiohttp import web
+
+import app as webapp
+
+# 异步连接池大小：协程不占线程，连接数可以按数据库承受能力设置
+ASYNC_POOL_SIZE = int(os.getenv('ASYNC_MYSQL_POOL_SIZE', 20))
+
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+
+class _AsyncSubscriber:
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # 队列满时丢弃事件并置位，客户端收到 resync 后通过历史接口补齐
+        self.overflowed = False
+
+
+# 发布/订阅中心（协程版），所有订阅者都在同一个事件循环中。
+# 与同步服务共用推送总线 webapp.push_bus：发布写入总线，总线的轮询线程收到事件后交给事件循环分发，
+# 两个服务写入的消息都能推送到任意一边的订阅者
+class AsyncMessageHub:
+    def __init__(self, queue_size=100, bus=None):
+        self._queue_size = queue_size
+        self._subscribers = {}
+        self._loop = None
+        self._bus = bus or webapp.MemoryPushBus()
+        self._bus.listen(self._on_event)
+
+    def subscribe(self, user_id):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._bus.start()
+        subscriber = _AsyncSubscriber(self._queue_size)
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id, subscriber):
+        subscribers = self._subscribers.get(user_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[user_id]
+
+    # 总线写入是同步的，放到线程池里执行
+    async def publish(self, user_ids, event_type, data):
+        await asyncio.get_running_loop().run_in_executor(None, self._bus.publish, user_ids, event_type, data)
+
+    # 在总线线程中调用，转回事件循环线程操作队列
+    def _on_event(self, user_ids, event_type, data):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._deliver, user_ids, event_type, data)
+
+    def _deliver(self, user_ids, event_type, data):
+        for user_id in user_ids:
+            for subscriber in self._subscribers.get(user_id, ()):
+                try:
+                    subscriber.queue.put_nowait((event_type, data))
+                except asyncio.QueueFull:
+                    subscriber.overflowed = True
+
+    def subscriber_count(self):
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+message_hub = AsyncMessageHub(webapp.PUSH_QUEUE_SIZE, webapp.push_bus)
+
+
+# 按 cookie 中的会话 id 从服务端会话存储读取会话（与 Flask 应用共用），返回 session 字典，未登录返回 None
+async def get_session(request):
+    cookie = request.cookies.get(webapp.app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    # 与 Flask 应用共用服务端会话存储，退出登录后的会话 id 在这里同样失效；
+    # 会话存储是同步的，放到线程池里读取，不阻塞事件循环
+    data = await asyncio.get_running_loop().run_in_executor(None, webapp.load_session, cookie)
+    return data if data and 'user_id' in data else None
+
+
+def get_page_size(request, default=None, maximum=None):
+    default = default or webapp.CHAT_PAGE_SIZE
+    maximum = maximum or webapp.CHAT_PAGE_SIZE_MAX
+    try:
+        limit = int(request.query.get('limit', default))
+    except ValueError:
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+async def fetch_all(pool, sql, params=()):
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            await cursor.execute(sql, params)
+            return await cursor.fetchall()
+
+
+# 归档水位，与同步服务共用进程内缓存
+async def get_archive_watermark(pool, archive_table_name):
+    if not webapp.ARCHIVE_ENABLED:
+        return 0
+    watermark = webapp.archive_watermarks.get(archive_table_name)
+    if watermark is None:
+        row = await fetch_one(pool, *webapp.archive_watermark_query(archive_table_name))
+        watermark = (row['watermark'] if row else None) or 0
+        webapp.archive_watermarks.set(archive_table_name, watermark)
+    return watermark
+
+
+# 在写入消息的同一事务内更新全文搜索倒排表
+async def index_documents(cursor, doc_type, docs):
+    if not webapp.SEARCH_ENABLED:
+        return
+    for sql, params in webapp.search_postings_inserts(doc_type, docs):
+        await cursor.execute(sql, params)
+
+
+# 与同步服务相同的群组投递：写扩散群组给成员写收件箱指针，大群切换为读扩散
+async def deliver_group_messages(cursor, messages):
+    group_ids = sorted({group_id for message_id, group_id, sender_id in messages})
+    await cursor.execute(*webapp.group_fanout_query(group_ids))
+    fanout_on_read_ids = {group_id for group_id, on_read in await cursor.fetchall() if on_read}
+    fanout_ids = [group_id for group_id in group_ids if group_id not in fanout_on_read_ids]
+    members = []
+    if fanout_ids:
+        await cursor.execute(*webapp.group_fanout_members_query(fanout_ids))
+        members = await cursor.fetchall()
+    for sql, params in webapp.group_delivery_statements(messages, fanout_on_read_ids, members):
+        await cursor.execute(sql, params)
+
+
+async def fetch_one(pool, sql, params=()):
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            await cursor.execute(sql, params)
+            return await cursor.fetchone()
+
+
+def now_string():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+# 读己之写：写入主库后设置与同步服务相同的 read_after cookie，之后发往同步服务的读取不会读到落后的副本
+def note_write(response):
+    if webapp.replica_set:
+        value, options = webapp.read_after_cookie_value(time.time())
+        response.set_cookie(webapp.READ_AFTER_COOKIE, value, **options)
+    return response
+
+
+# 发送消息接口
+async def send_message(request):
+    session = await get_session(request)
+    if session is None:
+        return json_response({'success': False, 'message': '请先登录'})
+
+    form = await request.post()
+    receiver_id = form.get('receiver_id')
+    content = form.get('content')
+    if not receiver_id or not content or not receiver_id.isdigit():
+        return json_response({'success': False, 'message': '参数错误'})
+    receiver_id = int(receiver_id)
+
+    pool = request.app['db']
+    row = (session['user_id'], receiver_id, content)
+    try:
+        async with pool.acquire() as conn:
+            await conn.begin()
+            async with conn.cursor() as cursor:
+                # 与同步服务的 write_messages 使用相同的语句
+                await cursor.execute(*webapp.storage.insert_rows_statement(
+                    'messages', ('sender_id', 'receiver_id', 'content'), [row]))
+                message_id = cursor.lastrowid
+                # 同一事务内累加接收者的未读计数
+                await cursor.execute(*webapp.storage.unread_counters_increment(
+                    {(receiver_id, session['user_id']): 1}))
+                # 更新双方的会话摘要
+                await cursor.execute(*webapp.storage.conversation_summary_upsert([(message_id,) + row]))
+                await index_documents(cursor, 'message', [
+                    (message_id, webapp.message_scopes(session['user_id'], receiver_id), content)])
+            await conn.commit()
+    except aiomysql.Error as e:
+        return json_response({'success': False, 'message': str(e)})
+    # 推送给在线的接收者；同步服务的各进程收到事件后让接收者的未读计数缓存失效
+    await message_hub.publish([receiver_id], 'message', {
+        'id': message_id,
+        'sender_id': session['user_id'],
+        'receiver_id': receiver_id,
+        'sender_name': session.get('username'),
+        'content': content,
+        'created_at': now_string()
+    })
+    return note_write(json_response({'success': True, 'message': '发送成功'}))
+
+
+# 发送群组消息
+async def send_group_message(request):
+    session = await get_session(request)
+    if session is None:
+        return json_response({'success': False, 'message': '请先登录'})
+
+    form = await request.post()
+    group_id = form.get('group_id')
+    content = form.get('content')
+    if not group_id or not content or not group_id.isdigit():
+        return json_response({'success': False, 'message': '参数错误'})
+    group_id = int(group_id)
+
+    pool = request.app['db']
+    try:
+        members = await fetch_all(pool, 'SELECT user_id FROM group_members WHERE group_id = %s', (group_id,))
+        member_ids = [m['user_id'] for m in members]
+        # 检查用户是否是群组成员
+        if session['user_id'] not in member_ids:
+            return json_response({'success': False, 'message': '你不是该群组成员'})
+
+        async with pool.acquire() as conn:
+            await conn.begin()
+            async with conn.cursor() as cursor:
+                await cursor.execute(*webapp.storage.insert_rows_statement(
+                    'group_messages', ('group_id', 'sender_id', 'content'), [(group_id, session['user_id'], content)]))
+                message_id = cursor.lastrowid
+                await cursor.execute(*webapp.storage.group_summary_update(
+                    group_id, message_id, session['user_id'], content))
+                await deliver_group_messages(cursor, [(message_id, group_id, session['user_id'])])
+                await index_documents(cursor, 'group_message', [
+                    (message_id, webapp.group_message_scopes(group_id), content)])
+            await conn.commit()
+    except aiomysql.Error as e:
+        return json_response({'success': False, 'message': str(e)})
+
+    # 推送给在线的其他群成员
+    await message_hub.publish([m for m in member_ids if m != session['user_id']], 'group_message', {
+        'id': message_id,
+        'group_id': group_id,
+        'sender_id': session['user_id'],
+        'sender_name': session.get('username'),
+        'content': content,
+        'created_at': now_string()
+    })
+    return note_write(json_response({'success': True, 'message': '发送成功'}))
+
+
+# 未读计数直接读库：标记已读由同步服务处理，不会经过本进程，进程内缓存无法及时失效
+async def get_unread_counts(request, session):
+    rows = await fetch_all(request.app['db'], '''
+        SELECT peer_id, count
+        FROM unread_counters
+        WHERE user_id = %s AND count > 0
+    ''', (session['user_id'],))
+    return {row['peer_id']: row['count'] for row in rows}
+
+
+# 获取未读消息数量
+async def unread_count(request):
+    session = await get_session(request)
+    if session is None:
+        return json_response({'count': 0})
+    try:
+        counts = await get_unread_counts(request, session)
+    except aiomysql.Error:
+        return json_response({'count': 0})
+    return json_response({'count': sum(counts.values())})
+
+
+# 按会话获取未读消息数量
+async def unread_counts(request):
+    session = await get_session(request)
+    if session is None:
+        return json_response({'count': 0, 'conversations': {}})
+    try:
+        counts = await get_unread_counts(request, session)
+    except aiomysql.Error:
+        return json_response({'count': 0, 'conversations': {}})
+    return json_response({'count': sum(counts.values()), 'conversations': counts})
+
+
+# 加载更早的聊天记录
+async def chat_history(request):
+    session = await get_session(request)
+    if session is None:
+        return json_response({'success': False, 'message': '请先登录'})
+
+    user_id = int(request.match_info['user_id'])
+    before = request.query.get('before')
+    cursor_value = webapp.decode_cursor(before) if before else None
+    if before and cursor_value is None:
+        return json_response({'success': False, 'message': '参数错误'})
+
+    pool = request.app['db']
+    limit = get_page_size(request)
+    try:
+        rows = await fetch_all(pool, *webapp.storage.chat_page_query(
+            session['user_id'], user_id, cursor_value, limit))
+        # 热表不够一页时按归档水位决定是否从归档表补齐
+        lookup = webapp.archive_lookup(await get_archive_watermark(pool, 'messages_archive'), cursor_value, rows, limit)
+        if lookup == 'query':
+            rows = list(rows) + list(await fetch_all(pool, *webapp.storage.chat_page_query(
+                session['user_id'], user_id, cursor_value, limit - len(rows), 'messages_archive')))
+        reads = await fetch_all(pool, *webapp.read_watermarks_query(session['user_id'], user_id))
+    except aiomysql.Error:
+        return json_response({'success': False, 'message': '数据库连接错误'})
+    messages, next_cursor = webapp.chat_page_result(rows, limit, more=lookup == 'more')
+    watermarks = webapp.read_watermarks_result([(r['user_id'], r['last_read_id']) for r in reads], session['user_id'])
+    webapp.apply_read_state(messages, session['user_id'], *watermarks)
+
+    return json_response({
+        'success': True,
+        'messages': [webapp.serialize_message(m) for m in messages],
+        'next_cursor': next_cursor
+    })
+
+
+# 群组历史消息（before）和新消息（after）
+async def group_messages(request):
+    session = await get_session(request)
+    if session is None:
+        return json_response({'success': False, 'message': '请先登录'})
+
+    group_id = int(request.match_info['group_id'])
+    newer = request.path.endswith('/messages')
+    value = request.query.get('after' if newer else 'before')
+    if (newer and value is None) or (value is not None and not value.isdigit()):
+        return json_response({'success': False, 'message': '参数错误'})
+    before = None if newer or value is None else int(value)
+    after = int(value) if newer else None
+
+    pool = request.app['db']
+    limit = get_page_size(request)
+    try:
+        member = await fetch_one(pool, 'SELECT role FROM group_members WHERE group_id = %s AND user_id = %s',
+                                 (group_id, session['user_id']))
+        if not member:
+            return json_response({'success': False, 'message': '你不是该群组成员'})
+        rows = await fetch_all(pool, *webapp.storage.group_messages_query(group_id, before, after, limit))
+        lookup = None
+        if after is None:
+            lookup = webapp.archive_lookup(await get_archive_watermark(pool, 'group_messages_archive'),
+                                           before, rows, limit)
+        if lookup == 'query':
+            rows = list(rows) + list(await fetch_all(pool, *webapp.storage.group_messages_query(
+                group_id, before, None, limit - len(rows), 'group_messages_archive')))
+    except aiomysql.Error:
+        return json_response({'success': False, 'message': '数据库连接错误'})
+    messages, has_more = webapp.group_messages_result(rows, after, limit, more=lookup == 'more')
+
+    result = {
+        'success': True,
+        'messages': [webapp.serialize_message(m) for m in messages],
+        'has_more': has_more
+    }
+    if after is None:
+        result['next_cursor'] = messages[0]['id'] if has_more else None
+    else:
+        result['last_id'] = messages[-1]['id'] if messages else after
+    return json_response(result)
+
+
+# 实时消息推送（Server-Sent Events），每个连接只占一个协程
+async def events(request):
+    session = await get_session(request)
+    if session is None:
+        return json_response({'success': False, 'message': '请先登录'}, status=401)
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+
+    user_id = session['user_id']
+    subscriber = message_hub.subscribe(user_id)
+    try:
+        await response.write(b'retry: 3000\n\n')
+        while True:
+            try:
+                event_type, data = await asyncio.wait_for(subscriber.queue.get(), webapp.PUSH_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                await response.write(b': heartbeat\n\n')
+                continue
+            await response.write(webapp.format_sse(event_type, data).encode('utf-8'))
+            if subscriber.overflowed and subscriber.queue.empty():
+                subscriber.overflowed = False
+                await response.write(webapp.format_sse('resync', {}).encode('utf-8'))
+    except ConnectionResetError:
+        pass
+    finally:
+        message_hub.unsubscribe(user_id, subscriber)
+    return response
+
+
+# Prometheus 指标
+async def metrics_endpoint(request):
+    if not webapp.metrics_access_allowed(request.remote, request.headers.get('Authorization')):
+        return web.Response(status=403, text='Forbidden')
+    gauges = [('push_subscribers', message_hub.subscriber_count(), {})]
+    pool = request.app['db']
+    gauges += [('db_pool_size', pool.size, {}), ('db_pool_idle', pool.freesize, {})]
+    return web.Response(text=webapp.metrics.render(gauges), content_type='text/plain')
+
+
+# 请求耗时统计
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.perf_counter()
+    response = await handler(request)
+    if webapp.METRICS_ENABLED:
+        route = request.match_info.route.resource
+        webapp.metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                               endpoint=route.canonical if route else 'unknown', method=request.method,
+                               status=response.status)
+    return response
+
+
+async def create_db_pool(application):
+    config = webapp.MYSQL_CONFIG
+    application['db'] = await aiomysql.create_pool(
+        host=config['host'],
+        user=config['user'],
+        password=config['password'] or '',
+        db=os.getenv('MYSQL_DATABASE'),
+        maxsize=ASYNC_POOL_SIZE,
+        pool_recycle=int(webapp.DB_POOL_CONFIG['max_lifetime']),
+        autocommit=True,
+        charset='utf8mb4'
+    )
+
+
+async def close_db_pool(application):
+    application['db'].close()
+    await application['db'].wait_closed()
+
+
+def create_app():
+    application = web.Application(middlewares=[metrics_middleware])
+    application.on_startup.append(create_db_pool)
+    application.on_cleanup.append(close_db_pool)
+    application.router.add_post('/send_message', send_message)
+    application.router.add_post('/send_group_message', send_group_message)
+    application.router.add_get('/unread_count', unread_count)
+    application.router.add_get('/unread_counts', unread_counts)
+    application.router.add_get('/chat/{user_id:\\d+}/history', chat_history)
+    application.router.add_get('/group_chat/{group_id:\\d+}/history', group_messages)
+    application.router.add_get('/group_chat/{group_id:\\d+}/messages', group_messages)
+    application.router.add_get('/events', events)
+    application.router.add_get('/metrics', metrics_endpoint)
+    return application
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='异步消息服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+    # aiomysql 只支持 MySQL，SQLite 后端请使用同步服务
+    if webapp.dialect.name != 'mysql':
+        sys.exit(f'异步服务只支持 MySQL 后端，当前 DB_BACKEND={webapp.storage.DB_BACKEND}')
+    # 进程内的推送总线到不了同步服务的订阅者
+    if webapp.PUSH_BACKEND != 'sqlite':
+        sys.exit(f'异步服务需要与同步服务共用推送总线，当前 PUSH_BACKEND={webapp.PUSH_BACKEND}')
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,339 @@
+# 性能基准测试：向本地数据库写入测试数据，用并发模拟客户端压测热点接口，输出吞吐量和延迟分位数
+#
+# 用法示例：
+#   MYSQL_DATABASE=getmemory_bench python benchmark.py --reset --users 1000 --messages 100000
+#   DB_BACKEND=sqlite python benchmark.py --reset   # 使用本地 SQLite 文件，不需要数据库服务
+#   python benchmark.py --skip-seed --concurrency 32 --requests 2000 --json bench.json
+#   python benchmark.py --skip-seed --url http://127.0.0.1:5000   # 压测已启动的服务
+# 压测已启动的服务时，服务端也要调大 LOGIN_MAX_ATTEMPTS_PER_IP / LOGIN_MAX_ATTEMPTS_PER_USER，否则登录会被限流
+# 并发客户端数较大时，同时调大 MYSQL_POOL_SIZE，避免等待连接超时
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+# 默认使用单独的测试库，避免写入正式数据
+os.environ.setdefault('MYSQL_DATABASE', 'getmemory_bench')
+os.environ.setdefault('SQLITE_DB', 'getmemory_bench.db')
+# 压测时短信走本地桩
+os.environ.setdefault('SMS_GATEWAY', 'stub')
+# 所有客户端共用同一个地址，放开登录限流，避免压测登录接口时被拦截
+os.environ.setdefault('LOGIN_MAX_ATTEMPTS_PER_IP', '1000000000')
+os.environ.setdefault('LOGIN_MAX_ATTEMPTS_PER_USER', '1000000000')
+
+import requests
+from werkzeug.security import generate_password_hash
+
+import app as webapp
+import storage
+from storage import dialect
+
+BENCH_PASSWORD = 'bench_password'
+# 聊天页面的 HTML 模板不在仓库中，读路径压测对应的 JSON 历史接口（页面首屏查询与之相同）
+ENDPOINTS = ['login', 'send_message', 'unread_count', 'chat_history', 'group_history', 'search']
+# 消息内容从固定词表中取词，搜索接口用同一个词表构造查询
+WORDS = ['apple', 'banana', 'cherry', 'dragon', 'eagle', 'forest', 'garden', 'harbor', 'island', 'jungle',
+         'kettle', 'lemon', 'meadow', 'night', 'ocean', 'pepper', 'quartz', 'river', 'silver', 'tiger',
+         '天气', '周末', '电影', '晚饭', '会议', '项目', '旅行', '音乐', '咖啡', '快递']
+# 每个会话中较早的这一比例的消息已读，之后的未读
+READ_RATIO = 0.8
+
+
+def bench_text(rng, kind):
+    return f'bench {kind} {" ".join(rng.sample(WORDS, 3))} {rng.random():.8f}'
+
+
+# 清空测试库：SQLite 删除数据库文件，MySQL 删除整个库
+def reset_database(database):
+    if dialect.name == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database + suffix):
+                os.remove(database + suffix)
+        return
+    import mysql.connector
+    conn = mysql.connector.connect(**webapp.MYSQL_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute(f'DROP DATABASE IF EXISTS {database}')
+    cursor.close()
+    conn.close()
+
+
+# 写入测试数据
+def seed(args, rng):
+    database = storage.SQLITE_DB if dialect.name == 'sqlite' else os.environ['MYSQL_DATABASE']
+    if args.reset:
+        if 'bench' not in database and not args.force:
+            sys.exit(f'拒绝清空数据库 {database}：库名不含 bench，确认无误请加 --force')
+        reset_database(database)
+
+    webapp.init_db()
+
+    conn = dialect.connect()
+    cursor = conn.cursor()
+
+    def insert_many(sql, rows):
+        for i in range(0, len(rows), args.batch_size):
+            cursor.executemany(sql, rows[i:i + args.batch_size])
+            conn.commit()
+
+    started = time.perf_counter()
+    # 所有测试用户共用一个密码哈希，避免写数据时反复计算
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM users')
+    base = cursor.fetchone()[0]
+    insert_many('INSERT INTO users (username, password, phone) VALUES (%s, %s, %s)',
+                [(f'bench_user_{base + i}', password_hash, f'19{base + i:09d}') for i in range(args.users)])
+    cursor.execute("SELECT id FROM users WHERE username LIKE 'bench!_user!_%' ESCAPE '!'")
+    user_ids = [row[0] for row in cursor.fetchall()]
+
+    # 每个用户只和少数固定的人聊天，形成较长的会话
+    pairs = []
+    for _ in range(args.messages):
+        sender = rng.randrange(len(user_ids))
+        receiver = (sender + 1 + rng.randrange(args.peers)) % len(user_ids)
+        pairs.append((user_ids[sender], user_ids[receiver]))
+    # 每个方向较早的 READ_RATIO 条消息标记已读，rebuild_derived_data 按标记换算已读水位和未读计数
+    totals = {}
+    for pair in pairs:
+        totals[pair] = totals.get(pair, 0) + 1
+    seen = {}
+    messages = []
+    for pair in pairs:
+        seen[pair] = seen.get(pair, 0) + 1
+        messages.append(pair + (bench_text(rng, 'message'), seen[pair] <= totals[pair] * READ_RATIO))
+    insert_many('INSERT INTO messages (sender_id, receiver_id, content, is_read) VALUES (%s, %s, %s, %s)', messages)
+
+    group_ids = []
+    for i in range(args.groups):
+        cursor.execute('INSERT INTO `groups` (name, description, created_by) VALUES (%s, %s, %s)',
+                       (f'bench_group_{i}', 'benchmark group', rng.choice(user_ids)))
+        group_ids.append(cursor.lastrowid)
+    conn.commit()
+
+    members = set()
+    for group_id in group_ids:
+        for user_id in rng.sample(user_ids, min(args.group_members, len(user_ids))):
+            members.add((group_id, user_id))
+    insert_many(f'{dialect.insert_ignore} INTO group_members (group_id, user_id, role) VALUES (%s, %s, %s)',
+                [(group_id, user_id, 'member') for group_id, user_id in sorted(members)])
+    members = sorted(members)
+
+    insert_many('INSERT INTO group_messages (group_id, sender_id, content) VALUES (%s, %s, %s)',
+                [rng.choice(members) + (bench_text(rng, 'group message'),)
+                 for _ in range(args.group_messages)])
+    insert_many('INSERT INTO comments (user_id, content) VALUES (%s, %s)',
+                [(rng.choice(user_ids), bench_text(rng, 'comment')) for _ in range(args.comments)])
+
+    cursor.close()
+    conn.close()
+
+    # 重新计算群组成员数、已读水位、会话摘要、未读计数等冗余数据，并建立搜索倒排表
+    webapp.rebuild_derived_data()
+    if webapp.SEARCH_ENABLED:
+        webapp.rebuild_search_index()
+    print(f'写入测试数据完成，用时 {time.perf_counter() - started:.1f} 秒')
+
+
+# 模拟客户端：进程内用 Flask 测试客户端，指定 --url 时用 HTTP 请求已启动的服务
+class Client:
+    def __init__(self, url=None):
+        self._url = url
+        if url:
+            self._session = requests.Session()
+        else:
+            self._client = webapp.app.test_client()
+
+    # 返回 (状态码, 重定向路径, JSON 内容)
+    @staticmethod
+    def _result(response, payload):
+        return response.status_code, urlsplit(response.headers.get('Location', '')).path, payload
+
+    def get(self, path):
+        if self._url:
+            response = self._session.get(self._url + path, allow_redirects=False)
+            return self._result(response, self._json(response))
+        response = self._client.get(path)
+        return self._result(response, response.get_json(silent=True))
+
+    def post(self, path, data):
+        if self._url:
+            response = self._session.post(self._url + path, data=data, allow_redirects=False)
+            return self._result(response, self._json(response))
+        response = self._client.post(path, data=data)
+        return self._result(response, response.get_json(silent=True))
+
+    @staticmethod
+    def _json(response):
+        if 'json' not in response.headers.get('Content-Type', ''):
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+    # 登录成功时跳转到个人主页
+    def login(self, username):
+        status, location, _ = self.post('/login', {'login_type': 'password', 'username': username,
+                                                   'password': BENCH_PASSWORD})
+        return 300 <= status < 400 and location == '/dashboard'
+
+
+# 请求是否成功：4xx/5xx、被重定向回登录页、JSON 返回 success: false 都算失败
+def is_success(result):
+    status, location, payload = result
+    if status >= 400:
+        return False
+    if 300 <= status < 400 and location == '/login':
+        return False
+    return not (isinstance(payload, dict) and payload.get('success') is False)
+
+
+def load_fixtures():
+    conn = webapp.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, username FROM users WHERE username LIKE 'bench!_user!_%' ESCAPE '!'")
+    users = cursor.fetchall()
+    cursor.execute('SELECT group_id, user_id FROM group_members')
+    memberships = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    if not users:
+        sys.exit('没有测试用户，请先写入测试数据（去掉 --skip-seed）')
+    return users, memberships
+
+
+# 单个请求：返回是否成功
+def make_request(endpoint, client, rng, user, users, groups_by_user):
+    if endpoint == 'login':
+        return Client(client._url).login(user[1])
+    if endpoint == 'send_message':
+        peer = rng.choice(users)
+        result = client.post('/send_message', {'receiver_id': peer[0], 'content': f'bench {rng.random():.8f}'})
+    elif endpoint == 'unread_count':
+        result = client.get('/unread_count')
+    elif endpoint == 'chat_history':
+        result = client.get(f'/chat/{rng.choice(users)[0]}/history')
+    elif endpoint == 'search':
+        result = client.get('/search?' + urlencode({'q': ' '.join(rng.sample(WORDS, rng.randint(1, 2)))}))
+    else:
+        group_ids = groups_by_user.get(user[0])
+        if not group_ids:
+            return None
+        result = client.get(f'/group_chat/{rng.choice(group_ids)}/history')
+    return is_success(result)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# 对一个接口发起 total 次请求，concurrency 个客户端并发
+def run_endpoint(endpoint, args, users, groups_by_user):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_client = max(1, args.requests // args.concurrency)
+    if endpoint == 'group_history':
+        users = [user for user in users if user[0] in groups_by_user]
+
+    def worker(index):
+        rng = random.Random(args.seed * 1000 + index)
+        user = users[index % len(users)]
+        client = Client(args.url)
+        if not client.login(user[1]):
+            raise RuntimeError(f'测试用户 {user[1]} 登录失败，压测结果无效')
+        local_latencies = []
+        local_errors = 0
+        for _ in range(per_client):
+            start = time.perf_counter()
+            ok = make_request(endpoint, client, rng, user, users, groups_by_user)
+            if ok is None:
+                continue
+            local_latencies.append(time.perf_counter() - start)
+            if not ok:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'endpoint': endpoint,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000
+    }
+
+
+def print_report(results):
+    print(f"{'接口':<14}{'请求数':>8}{'错误':>7}{'吞吐(req/s)':>13}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for r in results:
+        print(f"{r['endpoint']:<14}{r['requests']:>8}{r['errors']:>7}{r['throughput']:>13.1f}"
+              f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['max_ms']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='热点接口性能基准测试')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子，保证多次运行的数据和请求序列一致')
+    parser.add_argument('--reset', action='store_true', help='写入数据前清空测试库')
+    parser.add_argument('--force', action='store_true', help='允许清空库名不含 bench 的数据库')
+    parser.add_argument('--skip-seed', action='store_true', help='不写入测试数据，直接压测')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--peers', type=int, default=10, help='每个用户的聊天对象数')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--group-members', type=int, default=50)
+    parser.add_argument('--group-messages', type=int, default=50000)
+    parser.add_argument('--comments', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=1000, help='写入测试数据时每批行数')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发客户端数')
+    parser.add_argument('--requests', type=int, default=1000, help='每个接口的请求总数')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='要压测的接口，逗号分隔')
+    parser.add_argument('--url', help='压测已启动的服务，例如 http://127.0.0.1:5000；不指定时在进程内压测')
+    parser.add_argument('--json', help='把结果写入 JSON 文件，便于多次运行对比')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if not args.skip_seed:
+        seed(args, rng)
+
+    users, memberships = load_fixtures()
+    groups_by_user = {}
+    for group_id, user_id in memberships:
+        groups_by_user.setdefault(user_id, []).append(group_id)
+
+    results = []
+    for endpoint in args.endpoints.split(','):
+        endpoint = endpoint.strip()
+        if endpoint not in ENDPOINTS:
+            sys.exit(f'未知接口: {endpoint}，可选: {", ".join(ENDPOINTS)}')
+        if endpoint == 'search' and not webapp.SEARCH_ENABLED:
+            sys.exit('SEARCH_ENABLED 未开启，不能压测搜索接口')
+        results.append(run_endpoint(endpoint, args, users, groups_by_user))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,643 @@
+# 数据访问层：存储后端（MySQL / 嵌入式 SQLite）、SQL 方言差异和按实体划分的常用查询
+#
+# 后端由环境变量 DB_BACKEND 选择：
+#   mysql（默认）：连接 MYSQL_HOST 上的 MYSQL_DATABASE
+#   sqlite：使用本地文件 SQLITE_DB（WAL 模式），不需要数据库服务，适合小规模部署、测试和基准测试
+# 两种后端的连接对象接口一致（cursor(dictionary=True)、%s 占位符、commit/rollback、mysql.connector 的异常类型），
+# 业务代码只在语法确实不同的地方通过 dialect 取对应的写法
+import os
+import re
+import sqlite3
+from datetime import datetime
+from functools import lru_cache
+
+import mysql.connector
+from mysql.connector import errors
+
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql')
+SQLITE_DB = os.getenv('SQLITE_DB', 'getmemory.db')
+# 写锁被占用时最多等待多久（秒）
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 5))
+# 每个连接缓存的预编译语句条数
+SQLITE_STATEMENT_CACHE = int(os.getenv('SQLITE_STATEMENT_CACHE', 256))
+
+MYSQL_CONFIG = {
+    'host': os.getenv('MYSQL_HOST'),
+    'user': os.getenv('MYSQL_USER'),
+    'password': os.getenv('MYSQL_PASSWORD')
+}
+
+# 只读副本，逗号分隔：MySQL 为 host 或 host:port（账号和库名与主库相同），SQLite 为数据库文件路径
+DB_REPLICAS = [target.strip() for target in os.getenv('DB_REPLICAS', '').split(',') if target.strip()]
+
+
+# MySQL 方言
+class MySQLDialect:
+    name = 'mysql'
+    insert_ignore = 'INSERT IGNORE'
+    greatest = 'GREATEST'
+    least = 'LEAST'
+    # 锁定读：读取最新提交的数据并给行加排他锁
+    for_update = 'FOR UPDATE'
+    # 建表语句中的类型占位符
+    ddl_types = {
+        'pk': 'INT AUTO_INCREMENT PRIMARY KEY',
+        'role': "ENUM('admin', 'member')",
+        'binary': 'CHARACTER SET utf8mb4 COLLATE utf8mb4_bin',
+        'compressed': 'ROW_FORMAT=COMPRESSED',
+        'now': 'CURRENT_TIMESTAMP'
+    }
+
+    def ddl(self, statement):
+        return statement.format(**self.ddl_types)
+
+    # upsert：冲突时更新，keys 为唯一键的列（MySQL 不需要）
+    def on_conflict(self, keys):
+        return 'ON DUPLICATE KEY UPDATE'
+
+    # upsert 更新子句中引用本次要插入的值
+    def new(self, column):
+        return f'VALUES({column})'
+
+    # 多行 INSERT 后第一行的自增 id（MySQL 的 lastrowid 是第一行）
+    def first_insert_id(self, cursor, count):
+        return cursor.lastrowid
+
+    # 一条多行 INSERT 分配的自增 id 是否一定连续：自增步长必须为 1，且不能是交错锁模式
+    # （innodb_autoinc_lock_mode=2 时其他进程并发的批量插入可能穿插进来）。结果按进程缓存
+    _contiguous_ids = None
+
+    def contiguous_ids(self, cursor):
+        if self._contiguous_ids is None:
+            cursor.execute('SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode')
+            increment, lock_mode = fetch_first(cursor)
+            self._contiguous_ids = int(increment) == 1 and int(lock_mode) != 2
+            if not self._contiguous_ids:
+                print(f'auto_increment_increment={increment}, innodb_autoinc_lock_mode={lock_mode}：'
+                      '多行插入的 id 不保证连续，批量写入改为逐行插入')
+        return self._contiguous_ids
+
+    # 仓储查询使用服务端预编译语句，同一游标重复执行相同语句时只发送参数
+    def repository_cursor(self, conn, dictionary=False):
+        return conn.cursor(dictionary=dictionary, prepared=True)
+
+    def table_exists(self, cursor, table):
+        cursor.execute('SHOW TABLES LIKE %s', (table,))
+        return cursor.fetchone() is not None
+
+    def create_database(self):
+        conn = mysql.connector.connect(**MYSQL_CONFIG)
+        cursor = conn.cursor()
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {os.getenv('MYSQL_DATABASE')}")
+        cursor.close()
+        conn.close()
+
+    # target 为副本地址（host 或 host:port），不指定时连接主库
+    def connect(self, target=None):
+        config = MYSQL_CONFIG.copy()
+        config['database'] = os.getenv('MYSQL_DATABASE')
+        if target:
+            host, _, port = target.partition(':')
+            config['host'] = host
+            if port:
+                config['port'] = int(port)
+        return mysql.connector.connect(**config)
+
+
+# SQLite 方言
+class SQLiteDialect:
+    name = 'sqlite'
+    insert_ignore = 'INSERT OR IGNORE'
+    # SQLite 的多参数 MAX/MIN 是标量函数
+    greatest = 'MAX'
+    least = 'MIN'
+    # SQLite 写事务独占整个数据库，不需要行锁
+    for_update = ''
+    ddl_types = {
+        'pk': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        'role': 'TEXT',
+        # SQLite 默认按二进制比较
+        'binary': '',
+        'compressed': '',
+        # CURRENT_TIMESTAMP 在 SQLite 中是 UTC，默认值改用本地时间，与应用写入的时间一致
+        'now': "(datetime('now', 'localtime'))"
+    }
+
+    def ddl(self, statement):
+        return statement.format(**self.ddl_types)
+
+    def on_conflict(self, keys):
+        return f'ON CONFLICT({keys}) DO UPDATE SET'
+
+    def new(self, column):
+        return f'excluded.{column}'
+
+    # SQLite 的 lastrowid 是最后一行
+    def first_insert_id(self, cursor, count):
+        return cursor.lastrowid - count + 1
+
+    # 同一时刻只有一个写事务，多行 INSERT 的 id 总是连续
+    def contiguous_ids(self, cursor):
+        return True
+
+    # sqlite3 按连接缓存预编译语句（SQLITE_STATEMENT_CACHE），普通游标即可
+    def repository_cursor(self, conn, dictionary=False):
+        return conn.cursor(dictionary=dictionary)
+
+    def table_exists(self, cursor, table):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", (table,))
+        return cursor.fetchone() is not None
+
+    def create_database(self):
+        pass
+
+    # target 为副本的数据库文件，不指定时连接主库
+    def connect(self, target=None):
+        return SQLiteConnection(target or SQLITE_DB)
+
+
+# 时间统一按 MySQL TIMESTAMP 的文本格式存储，读出时还原为 datetime
+sqlite3.register_adapter(datetime, lambda value: value.strftime('%Y-%m-%d %H:%M:%S'))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+
+# 把 %s 占位符换成 SQLite 的 ?，同一条语句只转换一次
+@lru_cache(maxsize=1024)
+def sqlite_statement(sql):
+    return sql.replace('%s', '?')
+
+
+# 把 sqlite3 的异常转换成 mysql.connector 的异常类型，业务代码的 except Error 对两种后端都生效
+def translate_error(e):
+    if isinstance(e, sqlite3.IntegrityError):
+        return errors.IntegrityError(msg=str(e))
+    if isinstance(e, sqlite3.OperationalError):
+        return errors.OperationalError(msg=str(e))
+    if isinstance(e, sqlite3.ProgrammingError):
+        return errors.ProgrammingError(msg=str(e))
+    return errors.DatabaseError(msg=str(e))
+
+
+# SQLite 游标，接口与 mysql.connector 的游标一致
+class SQLiteCursor:
+    def __init__(self, cursor, dictionary=False):
+        self._cursor = cursor
+        self._dictionary = dictionary
+
+    def execute(self, operation, params=None):
+        try:
+            self._cursor.execute(sqlite_statement(operation), params or ())
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def executemany(self, operation, seq_params):
+        try:
+            self._cursor.executemany(sqlite_statement(operation), seq_params)
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return dict(zip((column[0] for column in self._cursor.description), row))
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+# SQLite 连接：WAL 模式下读写互不阻塞，写操作自动开启事务，commit 前对其他连接不可见（与 MySQL 非自动提交一致）
+class SQLiteConnection:
+    def __init__(self, path):
+        try:
+            self._conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT,
+                                         detect_types=sqlite3.PARSE_DECLTYPES,
+                                         check_same_thread=False,
+                                         cached_statements=SQLITE_STATEMENT_CACHE)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('PRAGMA foreign_keys=ON')
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def cursor(self, dictionary=False, **kwargs):
+        return SQLiteCursor(self._conn.cursor(), dictionary)
+
+    def commit(self):
+        try:
+            self._conn.commit()
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def rollback(self):
+        try:
+            self._conn.rollback()
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def ping(self, reconnect=False):
+        try:
+            self._conn.execute('SELECT 1')
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self._conn.close()
+
+
+DIALECTS = {'mysql': MySQLDialect, 'sqlite': SQLiteDialect}
+dialect = DIALECTS[DB_BACKEND]()
+
+
+# 写入数据库的时间戳：由应用按本地时间生成，两种后端一致；精确到秒，与分页游标的编码一致
+def current_timestamp():
+    return datetime.now().replace(microsecond=0)
+
+
+# 按唯一键查询单行：读完整个结果集，预编译游标（不缓冲）之后可以继续执行其他语句
+def fetch_first(cursor):
+    rows = cursor.fetchall()
+    return rows[0] if rows else None
+
+
+# 用户
+
+def get_user_by_id(cursor, user_id):
+    cursor.execute('SELECT id, username FROM users WHERE id = %s', (user_id,))
+    return fetch_first(cursor)
+
+def get_user_by_username(cursor, username):
+    cursor.execute('SELECT * FROM users WHERE username = %s', (username,))
+    return fetch_first(cursor)
+
+def get_user_by_phone(cursor, phone):
+    cursor.execute('SELECT * FROM users WHERE phone = %s', (phone,))
+    return fetch_first(cursor)
+
+def create_user(cursor, username, password_hash, phone):
+    cursor.execute('INSERT INTO users (username, password, phone, created_at) VALUES (%s, %s, %s, %s)',
+                   (username, password_hash, phone, current_timestamp()))
+    return cursor.lastrowid
+
+def update_user_password(cursor, user_id, password_hash):
+    cursor.execute('UPDATE users SET password = %s WHERE id = %s', (password_hash, user_id))
+
+# 按用户名前缀分页，走 username 唯一索引的范围扫描；前缀中的通配符用 ! 转义（两种后端都支持 ESCAPE）
+def find_users_by_prefix(cursor, exclude_id, prefix, after, limit):
+    pattern = prefix.replace('!', '!!').replace('%', '!%').replace('_', '!_') + '%'
+    cursor.execute('''
+        SELECT id, username
+        FROM users
+        WHERE username LIKE %s ESCAPE '!' AND username > %s AND id != %s
+        ORDER BY username ASC
+        LIMIT %s
+    ''', (pattern, after or '', exclude_id, limit))
+    return cursor.fetchall()
+
+
+# 群组
+
+def create_group(cursor, name, description, created_by):
+    cursor.execute('''
+        INSERT INTO `groups` (name, description, created_by, member_count, created_at)
+        VALUES (%s, %s, %s, 1, %s)
+    ''', (name, description, created_by, current_timestamp()))
+    return cursor.lastrowid
+
+def get_group(cursor, group_id):
+    cursor.execute('''
+        SELECT g.*, u.username as creator_name
+        FROM `groups` g
+        JOIN users u ON g.created_by = u.id
+        WHERE g.id = %s
+    ''', (group_id,))
+    return fetch_first(cursor)
+
+def adjust_member_count(cursor, group_id, delta):
+    cursor.execute('UPDATE `groups` SET member_count = member_count + %s WHERE id = %s', (delta, group_id))
+
+
+# 群组成员
+
+def get_member_role(cursor, group_id, user_id):
+    cursor.execute('''
+        SELECT role FROM group_members
+        WHERE group_id = %s AND user_id = %s
+    ''', (group_id, user_id))
+    member = fetch_first(cursor)
+    if not member:
+        return None
+    return member['role'] if isinstance(member, dict) else member[0]
+
+def list_group_members(cursor, group_id):
+    cursor.execute('''
+        SELECT u.id, u.username, gm.role, gm.joined_at
+        FROM group_members gm
+        JOIN users u ON gm.user_id = u.id
+        WHERE gm.group_id = %s
+        ORDER BY gm.joined_at ASC
+    ''', (group_id,))
+    return cursor.fetchall()
+
+# 用户加入的全部群组，返回 [(group_id, role)]
+def list_user_memberships(cursor, user_id):
+    cursor.execute('SELECT group_id, role FROM group_members WHERE user_id = %s', (user_id,))
+    return [(row['group_id'], row['role']) if isinstance(row, dict) else tuple(row) for row in cursor.fetchall()]
+
+# 添加成员，新成员的已读水位从当前最新一条群消息开始
+def add_group_member(cursor, group_id, user_id, role='member'):
+    cursor.execute('''
+        INSERT INTO group_members (group_id, user_id, role, last_read_id)
+        SELECT %s, %s, %s, COALESCE(MAX(id), 0) FROM group_messages WHERE group_id = %s
+    ''', (group_id, user_id, role, group_id))
+
+# 移除成员，同时清理该成员在这个群的收件箱指针，返回是否真的删除了成员
+def remove_group_member(cursor, group_id, user_id):
+    cursor.execute('''
+        DELETE FROM group_members
+        WHERE group_id = %s AND user_id = %s
+    ''', (group_id, user_id))
+    removed = cursor.rowcount > 0
+    cursor.execute('DELETE FROM group_inbox WHERE user_id = %s AND group_id = %s', (user_id, group_id))
+    return removed
+
+def set_member_role(cursor, group_id, user_id, role):
+    cursor.execute('''
+        UPDATE group_members
+        SET role = %s
+        WHERE group_id = %s AND user_id = %s
+    ''', (role, group_id, user_id))
+
+
+# 私聊消息
+
+# 两人之间一页聊天记录的查询语句，多取一条用于判断是否还有更早的消息
+def chat_page_query(user_id, peer_id, before, limit, table='messages'):
+    # 两个方向分别走 (sender_id, receiver_id, created_at) 索引的范围扫描，再合并，避免 OR 条件导致的全表排序
+    condition = ''
+    cursor_params = ()
+    if before:
+        condition = 'AND (m.created_at < %s OR (m.created_at = %s AND m.id < %s))'
+        cursor_params = (before[0], before[0], before[1])
+    branch = f'''
+        (SELECT m.*, u.username as sender_name
+         FROM {table} m
+         JOIN users u ON m.sender_id = u.id
+         WHERE m.sender_id = %s AND m.receiver_id = %s {condition}
+         ORDER BY m.created_at DESC, m.id DESC
+         LIMIT %s)
+    '''
+    sql = f'''
+        SELECT * FROM (
+            SELECT * FROM {branch} a
+            UNION ALL
+            SELECT * FROM {branch} b
+        ) t
+        ORDER BY t.created_at DESC, t.id DESC
+        LIMIT %s
+    '''
+    params = ((user_id, peer_id) + cursor_params + (limit + 1,)
+              + (peer_id, user_id) + cursor_params + (limit + 1,)
+              + (limit + 1,))
+    return sql, params
+
+def find_chat_page(cursor, user_id, peer_id, before, limit, table='messages'):
+    cursor.execute(*chat_page_query(user_id, peer_id, before, limit, table))
+    return cursor.fetchall()
+
+# 多行 INSERT 语句，created_at 由应用写入（current_timestamp），不依赖数据库默认值
+def insert_rows_statement(table, columns, rows):
+    columns = tuple(columns) + ('created_at',)
+    now = current_timestamp()
+    placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([placeholders] * len(rows))}"
+    return sql, [value for row in rows for value in tuple(row) + (now,)]
+
+# 多行插入，返回每一行的自增 id（同一条多行 INSERT 分配的自增值是连续的，数据库配置不保证连续时逐行插入）
+def insert_rows(cursor, table, columns, rows):
+    # 数据库配置不保证 id 连续时逐行插入，逐行取 lastrowid（仍在同一个事务内提交）
+    if len(rows) > 1 and not dialect.contiguous_ids(cursor):
+        ids = []
+        for row in rows:
+            cursor.execute(*insert_rows_statement(table, columns, [row]))
+            ids.append(cursor.lastrowid)
+        return ids
+    cursor.execute(*insert_rows_statement(table, columns, rows))
+    first_id = dialect.first_insert_id(cursor, len(rows))
+    return list(range(first_id, first_id + len(rows)))
+
+# 行格式 (sender_id, receiver_id, content)，返回每一行的 id
+def insert_messages(cursor, rows):
+    return insert_rows(cursor, 'messages', ('sender_id', 'receiver_id', 'content'), rows)
+
+# 累加未读计数的 upsert，counts 为 {(user_id, peer_id): 新增条数}
+def unread_counters_increment(counts):
+    placeholders = ', '.join(['(%s, %s, %s)'] * len(counts))
+    sql = f'''
+        INSERT INTO unread_counters (user_id, peer_id, count)
+        VALUES {placeholders}
+        {dialect.on_conflict('user_id, peer_id')} count = count + {dialect.new('count')}
+    '''
+    params = [value for (user_id, peer_id), count in sorted(counts.items()) for value in (user_id, peer_id, count)]
+    return sql, params
+
+def increment_unread_counters(cursor, counts):
+    cursor.execute(*unread_counters_increment(counts))
+
+
+# 会话列表
+
+# 会话摘要中最后一条消息的预览长度
+CONVERSATION_PREVIEW_LENGTH = 100
+
+# 会话摘要的冲突更新子句：并发事务可能乱序提交，只有 id 更大的消息才覆盖摘要
+# （MySQL 按顺序赋值，last_message_id 必须放在最后；SQLite 的右侧表达式都取旧值）
+def conversation_summary_conflict():
+    newer = f"{dialect.new('last_message_id')} > last_message_id"
+    assignments = [
+        f"{column} = CASE WHEN {newer} THEN {dialect.new(column)} ELSE {column} END"
+        for column in ('last_sender_id', 'last_message_preview', 'last_message_at')
+    ]
+    assignments.append(f"last_message_id = {dialect.greatest}(last_message_id, {dialect.new('last_message_id')})")
+    return f"{dialect.on_conflict('user_id, peer_id')} {', '.join(assignments)}"
+
+# 私聊会话摘要的批量 upsert，行格式 (message_id, sender_id, receiver_id, content)
+def conversation_summary_upsert(messages):
+    latest = {}
+    for message_id, sender_id, receiver_id, content in messages:
+        preview = content[:CONVERSATION_PREVIEW_LENGTH]
+        latest[(sender_id, receiver_id)] = (message_id, sender_id, preview)
+        latest[(receiver_id, sender_id)] = (message_id, sender_id, preview)
+    now = current_timestamp()
+    placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(latest))
+    sql = f'''
+        INSERT INTO conversation_summaries
+            (user_id, peer_id, last_message_id, last_sender_id, last_message_preview, last_message_at)
+        VALUES {placeholders}
+        {conversation_summary_conflict()}
+    '''
+    params = [value for (user_id, peer_id), summary in sorted(latest.items())
+              for value in (user_id, peer_id) + summary + (now,)]
+    return sql, params
+
+def upsert_conversation_summaries(cursor, messages):
+    cursor.execute(*conversation_summary_upsert(messages))
+
+# 排序键为 (last_message_at, kind, target_id) 倒序，每个分支的 kind 固定，游标条件按分支展开
+def conversation_cursor_condition(kind, before, time_column, id_column):
+    if not before:
+        return '', ()
+    last_message_at, before_kind, target_id = before
+    if kind == before_kind:
+        return (f'AND ({time_column} < %s OR ({time_column} = %s AND {id_column} < %s))',
+                (last_message_at, last_message_at, target_id))
+    if kind < before_kind:
+        return f'AND {time_column} <= %s', (last_message_at,)
+    return f'AND {time_column} < %s', (last_message_at,)
+
+# 一页会话的查询语句：两个分支各取一页再合并，多取一条用于判断是否还有下一页
+def conversations_query(user_id, before, limit):
+    private_condition, private_params = conversation_cursor_condition(
+        'private', before, 'c.last_message_at', 'c.peer_id')
+    group_condition, group_params = conversation_cursor_condition(
+        'group', before, 'g.last_message_at', 'g.id')
+    sql = f'''
+        SELECT t.*,
+               CASE WHEN t.kind = 'private' THEN t.private_unread
+                    WHEN t.fanout_on_read THEN (
+                        SELECT COUNT(*) FROM group_messages m
+                        WHERE m.group_id = t.target_id AND m.id > t.last_read_id AND m.sender_id <> %s
+                    )
+                    ELSE (
+                        SELECT COUNT(*) FROM group_inbox i
+                        WHERE i.user_id = %s AND i.group_id = t.target_id AND i.message_id > t.last_read_id
+                    ) END AS unread
+        FROM (
+            SELECT * FROM (SELECT 'private' AS kind, c.peer_id AS target_id, u.username AS name,
+                    c.last_message_id, c.last_sender_id, c.last_message_preview, c.last_message_at,
+                    COALESCE(uc.count, 0) AS private_unread, 0 AS last_read_id, FALSE AS fanout_on_read
+             FROM conversation_summaries c
+             JOIN users u ON u.id = c.peer_id
+             LEFT JOIN unread_counters uc ON uc.user_id = c.user_id AND uc.peer_id = c.peer_id
+             WHERE c.user_id = %s {private_condition}
+             ORDER BY c.last_message_at DESC, c.peer_id DESC
+             LIMIT %s) p
+            UNION ALL
+            SELECT * FROM (SELECT 'group' AS kind, g.id AS target_id, g.name,
+                    g.last_message_id, g.last_sender_id, g.last_message_preview, g.last_message_at,
+                    0 AS private_unread, gm.last_read_id, g.fanout_on_read
+             FROM group_members gm
+             JOIN `groups` g ON g.id = gm.group_id
+             WHERE gm.user_id = %s AND g.last_message_at IS NOT NULL {group_condition}
+             ORDER BY g.last_message_at DESC, g.id DESC
+             LIMIT %s) q
+        ) t
+        ORDER BY t.last_message_at DESC, t.kind DESC, t.target_id DESC
+        LIMIT %s
+    '''
+    params = ((user_id, user_id)
+              + (user_id,) + private_params + (limit + 1,)
+              + (user_id,) + group_params + (limit + 1,)
+              + (limit + 1,))
+    return sql, params
+
+def find_conversations(cursor, user_id, before, limit):
+    cursor.execute(*conversations_query(user_id, before, limit))
+    return cursor.fetchall()
+
+
+# 群组消息
+
+# 按消息 id 获取一页群组消息，(group_id) 索引隐含主键 id，before/after 都是索引范围扫描
+def group_messages_query(group_id, before, after, limit, table='group_messages'):
+    if after is not None:
+        # 新消息：从 after 往后按时间正序取
+        return '''
+            SELECT gm.*, u.username as sender_name
+            FROM group_messages gm
+            JOIN users u ON gm.sender_id = u.id
+            WHERE gm.group_id = %s AND gm.id > %s
+            ORDER BY gm.id ASC
+            LIMIT %s
+        ''', (group_id, after, limit + 1)
+
+    # 历史消息：从 before（不传则从最新）往前取
+    condition = 'AND gm.id < %s' if before is not None else ''
+    params = (group_id, before) if before is not None else (group_id,)
+    return f'''
+        SELECT gm.*, u.username as sender_name
+        FROM {table} gm
+        JOIN users u ON gm.sender_id = u.id
+        WHERE gm.group_id = %s {condition}
+        ORDER BY gm.id DESC
+        LIMIT %s
+    ''', params + (limit + 1,)
+
+def find_group_messages(cursor, group_id, before, after, limit, table='group_messages'):
+    cursor.execute(*group_messages_query(group_id, before, after, limit, table))
+    return cursor.fetchall()
+
+# 行格式 (group_id, sender_id, content)，返回每一行的 id
+def insert_group_messages(cursor, rows):
+    return insert_rows(cursor, 'group_messages', ('group_id', 'sender_id', 'content'), rows)
+
+# 群聊摘要更新：写在群组行上，每条群消息只更新一行
+def group_summary_update(group_id, message_id, sender_id, content):
+    sql = '''
+        UPDATE `groups`
+        SET last_message_at = %s, last_message_id = %s,
+            last_sender_id = %s, last_message_preview = %s
+        WHERE id = %s AND (last_message_id IS NULL OR last_message_id < %s)
+    '''
+    return sql, (current_timestamp(), message_id, sender_id, content[:CONVERSATION_PREVIEW_LENGTH],
+                 group_id, message_id)
+
+def update_group_summary(cursor, group_id, message_id, sender_id, content):
+    cursor.execute(*group_summary_update(group_id, message_id, sender_id, content))
+
+
+# 评论
+
+# 按 (created_at, id) 倒序取一页评论，多取一条用于判断是否还有更早的评论
+def find_comments(cursor, before, limit):
+    condition = ''
+    params = ()
+    if before:
+        condition = 'WHERE c.created_at < %s OR (c.created_at = %s AND c.id < %s)'
+        params = (before[0], before[0], before[1])
+    cursor.execute(f'''
+        SELECT c.*, u.username
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        {condition}
+        ORDER BY c.created_at DESC, c.id DESC
+        LIMIT %s
+    ''', params + (limit + 1,))
+    return cursor.fetchall()
+
+# 行格式 (user_id, content)，返回每一行的 id
+def insert_comments(cursor, rows):
+    return insert_rows(cursor, 'comments', ('user_id', 'content'), rows)
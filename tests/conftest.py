@@ -0,0 +1,96 @@
+# 测试使用临时目录中的 SQLite 数据库，不需要 MySQL 服务
+# app 在导入时读取环境变量，必须在导入之前设置好
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix='getmemory-tests-')
+os.environ.update({
+    'DB_BACKEND': 'sqlite',
+    'SQLITE_DB': os.path.join(TEST_DIR, 'app.db'),
+    'SESSION_DB': os.path.join(TEST_DIR, 'sessions.db'),
+    'SMS_GATEWAY': 'stub',
+    # 测试中直接在当前进程计算密码哈希，不启动进程池
+    'PASSWORD_HASH_WORKERS': '0',
+    'DB_REPLICAS': ''
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as webapp  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    webapp.init_db()
+    return webapp
+
+
+# 所有测试共用一个数据库，每个测试创建自己的用户和群组，互不影响
+@pytest.fixture
+def make_user(app_module):
+    def make(name=None):
+        name = name or 'user_' + uuid.uuid4().hex[:12]
+        conn = app_module.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            user_id = app_module.storage.create_user(cursor, name, 'not-a-real-hash', name)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+        return user_id
+    return make
+
+
+# 已登录用户的测试客户端
+@pytest.fixture
+def client_for(app_module):
+    def client(user_id):
+        test_client = app_module.app.test_client()
+        with test_client.session_transaction() as session:
+            session['user_id'] = user_id
+            session['username'] = f'user{user_id}'
+        return test_client
+    return client
+
+
+# 创建群组，第一个用户为管理员，其余为普通成员
+@pytest.fixture
+def make_group(app_module):
+    def make(admin_id, *member_ids):
+        conn = app_module.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            group_id = app_module.storage.create_group(cursor, 'group_' + uuid.uuid4().hex[:8], '', admin_id)
+            app_module.storage.add_group_member(cursor, group_id, admin_id, 'admin')
+            for member_id in member_ids:
+                app_module.storage.add_group_member(cursor, group_id, member_id)
+            app_module.storage.adjust_member_count(cursor, group_id, len(member_ids))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+        return group_id
+    return make
+
+
+# 按游标逐页请求列表接口，直到没有下一页，返回每一页的内容
+@pytest.fixture
+def collect():
+    def collect_pages(client, url, key, cursor_arg='before', cursor_key='next_cursor', limit=3, **args):
+        pages = []
+        cursor = None
+        while True:
+            params = dict(args, limit=limit)
+            if cursor is not None:
+                params[cursor_arg] = cursor
+            response = client.get(url, query_string=params).get_json()
+            assert response['success']
+            pages.append(response[key])
+            cursor = response[cursor_key]
+            if cursor is None:
+                return pages
+    return collect_pages
@@ -0,0 +1,99 @@
+# 消息归档：默认关闭；开启后只把所有接收者都已读的旧消息移入归档表，历史记录翻页时从归档表补齐
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def archiving(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'ARCHIVE_AFTER_DAYS', 30)
+    monkeypatch.setattr(app_module, 'ARCHIVE_ENABLED', True)
+    yield
+    app_module.archive_watermarks.clear()
+
+
+def execute(app_module, sql, params=()):
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall() if cursor.description else None
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return rows
+
+
+def backdate(app_module, table, ids):
+    created_at = datetime.now() - timedelta(days=60)
+    execute(app_module, f"UPDATE {table} SET created_at = %s WHERE id IN ({', '.join(['%s'] * len(ids))})",
+            [created_at] + list(ids))
+
+
+def ids_in(app_module, table, ids):
+    rows = execute(app_module, f"SELECT id FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+    return sorted(row[0] for row in rows)
+
+
+def test_archiving_is_off_by_default(app_module):
+    assert app_module.ARCHIVE_AFTER_DAYS == 0
+    assert not app_module.ARCHIVE_ENABLED
+
+
+def test_only_read_messages_are_archived(app_module, archiving, make_user, client_for):
+    alice, bob = make_user(), make_user()
+    alice_client, bob_client = client_for(alice), client_for(bob)
+    for i in range(4):
+        alice_client.post('/send_message', data={'receiver_id': bob, 'content': f'old {i}'})
+    ids = [m['id'] for m in bob_client.get(f'/chat/{alice}/history').get_json()['messages']]
+    bob_client.post(f'/chat/{alice}/read', data={'last_id': ids[1]})
+    backdate(app_module, 'messages', ids)
+
+    app_module.archive_old_messages()
+    assert ids_in(app_module, 'messages_archive', ids) == ids[:2]
+    assert ids_in(app_module, 'messages', ids) == ids[2:]
+
+    # 未读消息留在热表，对账后未读数不变
+    app_module.reconcile_unread_counters()
+    assert bob_client.get('/unread_counts').get_json()['conversations'] == {str(alice): 2}
+
+    # 翻页时从归档表补齐更早的消息
+    contents = []
+    before = None
+    while True:
+        query = {'limit': 2} if before is None else {'limit': 2, 'before': before}
+        response = bob_client.get(f'/chat/{alice}/history', query_string=query).get_json()
+        contents = [m['content'] for m in response['messages']] + contents
+        before = response['next_cursor']
+        if before is None:
+            break
+    assert contents == [f'old {i}' for i in range(4)]
+
+
+def test_group_messages_wait_for_every_reader(app_module, archiving, make_user, make_group, client_for):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    group_id = make_group(alice, bob, carol)
+    alice_client = client_for(alice)
+    for i in range(2):
+        alice_client.post('/send_group_message', data={'group_id': group_id, 'content': f'old {i}'})
+    ids = [m['id'] for m in client_for(bob).get(f'/group_chat/{group_id}/history').get_json()['messages']]
+    client_for(bob).post(f'/group_chat/{group_id}/read', data={'last_id': ids[1]})
+    client_for(carol).post(f'/group_chat/{group_id}/read', data={'last_id': ids[0]})
+    backdate(app_module, 'group_messages', ids)
+
+    # 发送者自己的水位不影响归档
+    app_module.archive_old_messages()
+    assert ids_in(app_module, 'group_messages_archive', ids) == ids[:1]
+    assert client_for(carol).get('/group_unread_counts').get_json()['groups'] == {str(group_id): 1}
+
+    history = client_for(carol).get(f'/group_chat/{group_id}/history', query_string={'before': ids[1]})
+    assert [m['content'] for m in history.get_json()['messages']] == ['old 0']
+
+
+def test_recent_messages_stay_hot(app_module, archiving, make_user, client_for):
+    alice, bob = make_user(), make_user()
+    client_for(alice).post('/send_message', data={'receiver_id': bob, 'content': 'recent'})
+    message_id = client_for(bob).get(f'/chat/{alice}/history').get_json()['messages'][0]['id']
+    client_for(bob).post(f'/chat/{alice}/read', data={'last_id': message_id})
+
+    app_module.archive_old_messages()
+    assert ids_in(app_module, 'messages', [message_id]) == [message_id]
@@ -0,0 +1,44 @@
+# 私聊历史的游标分页：逐页往前翻，每条消息出现且只出现一次，顺序与时间倒序一致
+# 测试中的消息大多在同一秒内写入，created_at 相同时靠 id 区分先后
+
+
+def test_chat_history_pages(make_user, client_for, collect):
+    alice, bob = make_user(), make_user()
+    alice_client, bob_client = client_for(alice), client_for(bob)
+    sent = []
+    for i in range(8):
+        client, receiver = (alice_client, bob) if i % 2 == 0 else (bob_client, alice)
+        content = f'message {i}'
+        assert client.post('/send_message', data={'receiver_id': receiver, 'content': content}).get_json()['success']
+        sent.append(content)
+
+    pages = collect(alice_client, f'/chat/{bob}/history', 'messages')
+    assert [len(page) for page in pages] == [3, 3, 2]
+    # 每页按时间正序返回，页与页之间从新到旧
+    contents = [message['content'] for page in reversed(pages) for message in page]
+    assert contents == sent
+
+
+def test_chat_history_rejects_bad_cursor(make_user, client_for):
+    alice, bob = make_user(), make_user()
+    response = client_for(alice).get(f'/chat/{bob}/history', query_string={'before': 'not-a-cursor'})
+    assert response.get_json() == {'success': False, 'message': '参数错误'}
+
+
+def test_chat_history_page_size_is_capped(app_module, monkeypatch, make_user, client_for):
+    monkeypatch.setattr(app_module, 'CHAT_PAGE_SIZE_MAX', 2)
+    alice, bob = make_user(), make_user()
+    alice_client = client_for(alice)
+    for i in range(3):
+        alice_client.post('/send_message', data={'receiver_id': bob, 'content': f'message {i}'})
+    response = alice_client.get(f'/chat/{bob}/history', query_string={'limit': 1000}).get_json()
+    assert [message['content'] for message in response['messages']] == ['message 1', 'message 2']
+    assert response['next_cursor']
+
+
+def test_cursor_round_trip(app_module):
+    created_at = app_module.datetime(2024, 1, 2, 3, 4, 5)
+    cursor = app_module.encode_cursor(created_at, 42)
+    assert cursor == '20240102030405-42'
+    assert app_module.decode_cursor(cursor) == (created_at, 42)
+    assert app_module.decode_cursor('20240102030405') is None
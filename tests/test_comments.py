@@ -0,0 +1,35 @@
+# 评论区分页：评论是公开的，其他测试的评论也在其中，只检查本测试写入的评论
+import uuid
+
+
+def test_comment_pages(make_user, client_for, collect):
+    client = client_for(make_user())
+    marker = uuid.uuid4().hex
+    sent = [f'{marker} comment {i}' for i in range(5)]
+    for content in sent:
+        assert client.post('/add_comment', data={'content': content}).get_json()['success']
+
+    pages = collect(client, '/comments/page', 'comments', limit=2)
+    ids = [comment['id'] for page in pages for comment in page]
+    assert len(ids) == len(set(ids))
+    contents = [comment['content'] for page in pages for comment in page if comment['content'].startswith(marker)]
+    assert contents == list(reversed(sent))
+
+
+def test_comment_first_page_sees_new_comment(make_user, client_for):
+    client = client_for(make_user())
+    client.get('/comments/page')
+    content = uuid.uuid4().hex
+    client.post('/add_comment', data={'content': content})
+    comments = client.get('/comments/page').get_json()['comments']
+    assert comments[0]['content'] == content
+
+
+def test_comment_page_rejects_bad_cursor(make_user, client_for):
+    response = client_for(make_user()).get('/comments/page', query_string={'before': 'not-a-cursor'})
+    assert response.get_json() == {'success': False, 'message': '参数错误'}
+
+
+def test_empty_comment_rejected(make_user, client_for):
+    response = client_for(make_user()).post('/add_comment', data={'content': ''})
+    assert response.get_json() == {'success': False, 'message': '评论内容不能为空'}
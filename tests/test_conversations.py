@@ -0,0 +1,37 @@
+# 会话列表：私聊和群聊按最近活跃时间合并分页，带最后一条消息预览和未读数
+# 测试中的消息大多在同一秒内写入，时间相同时按类型和 id 区分先后，游标翻页不重不漏
+
+
+def test_conversation_cursor_round_trip(app_module):
+    row = {'last_message_at': app_module.datetime(2024, 1, 2, 3, 4, 5), 'kind': 'group', 'target_id': 7}
+    cursor = app_module.encode_conversation_cursor(row)
+    assert cursor == '20240102030405-group-7'
+    assert app_module.decode_conversation_cursor(cursor) == (row['last_message_at'], 'group', 7)
+    assert app_module.decode_conversation_cursor('20240102030405-channel-7') is None
+    assert app_module.decode_conversation_cursor('20240102030405-7') is None
+
+
+def test_conversations_reject_bad_cursor(make_user, client_for):
+    response = client_for(make_user()).get('/conversations', query_string={'before': 'not-a-cursor'})
+    assert response.get_json() == {'success': False, 'message': '参数错误'}
+
+
+def test_conversations_merge_private_and_group(make_user, make_group, client_for, collect):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    first, second = make_group(alice, bob), make_group(carol, alice)
+    alice_client = client_for(alice)
+    client_for(bob).post('/send_message', data={'receiver_id': alice, 'content': 'from bob'})
+    alice_client.post('/send_message', data={'receiver_id': carol, 'content': 'to carol'})
+    client_for(bob).post('/send_group_message', data={'group_id': first, 'content': 'first group'})
+    client_for(carol).post('/send_group_message', data={'group_id': second, 'content': 'second group'})
+    alice_client.post('/send_group_message', data={'group_id': second, 'content': 'my reply'})
+
+    pages = collect(alice_client, '/conversations', 'conversations', limit=1)
+    items = {(item['kind'], item['target_id']): item for page in pages for item in page}
+    assert sum(len(page) for page in pages) == len(items) == 4
+    assert {key: (item['last_message_preview'], item['unread']) for key, item in items.items()} == {
+        ('private', bob): ('from bob', 1),
+        ('private', carol): ('to carol', 0),
+        ('group', first): ('first group', 1),
+        ('group', second): ('my reply', 1),
+    }
@@ -0,0 +1,52 @@
+# 群聊历史的分页（before 往前翻页，after 增量拉取新消息）和群组成员列表缓存
+
+
+def test_group_history_pages(make_user, make_group, client_for, collect):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice, bob)
+    alice_client = client_for(alice)
+    sent = [f'group message {i}' for i in range(7)]
+    for content in sent:
+        response = alice_client.post('/send_group_message', data={'group_id': group_id, 'content': content})
+        assert response.get_json()['success']
+
+    pages = collect(client_for(bob), f'/group_chat/{group_id}/history', 'messages')
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [message['content'] for page in reversed(pages) for message in page] == sent
+
+
+def test_group_new_messages_after(make_user, make_group, client_for):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice, bob)
+    alice_client, bob_client = client_for(alice), client_for(bob)
+    alice_client.post('/send_group_message', data={'group_id': group_id, 'content': 'old'})
+    last_id = bob_client.get(f'/group_chat/{group_id}/messages', query_string={'after': 0}).get_json()['last_id']
+
+    alice_client.post('/send_group_message', data={'group_id': group_id, 'content': 'new'})
+    response = bob_client.get(f'/group_chat/{group_id}/messages', query_string={'after': last_id}).get_json()
+    assert [message['content'] for message in response['messages']] == ['new']
+    assert response['last_id'] > last_id
+
+
+def test_group_history_requires_membership(make_user, make_group, client_for):
+    alice, carol = make_user(), make_user()
+    group_id = make_group(alice)
+    response = client_for(carol).get(f'/group_chat/{group_id}/history').get_json()
+    assert response == {'success': False, 'message': '你不是该群组成员'}
+
+
+def member_ids(app_module, group_id):
+    conn = app_module.get_db_connection()
+    try:
+        return sorted(member['id'] for member in app_module.get_group_members(conn, group_id))
+    finally:
+        conn.close()
+
+
+def test_member_cache_invalidated_on_join(app_module, make_user, make_group, client_for):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice)
+    assert member_ids(app_module, group_id) == [alice]
+
+    client_for(bob).get(f'/join_group/{group_id}')
+    assert member_ids(app_module, group_id) == sorted([alice, bob])
@@ -0,0 +1,123 @@
+# 群组未读：小群写扩散到成员收件箱，大群读扩散按成员水位统计，两种方式的结果一致
+import pytest
+
+
+def send_group(client, group_id, content='hi'):
+    response = client.post('/send_group_message', data={'group_id': group_id, 'content': content})
+    assert response.get_json()['success']
+
+
+def group_unread(client):
+    response = client.get('/group_unread_counts').get_json()
+    return {int(group_id): count for group_id, count in response['groups'].items()}
+
+
+@pytest.fixture(params=['inbox', 'on_read'])
+def fanout(request, app_module, monkeypatch):
+    # 读扩散：阈值小于任何群组的成员数
+    if request.param == 'on_read':
+        monkeypatch.setattr(app_module, 'GROUP_FANOUT_MAX_MEMBERS', 0)
+    return request.param
+
+
+def inbox_size(app_module, group_id):
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM group_inbox WHERE group_id = %s', (group_id,))
+    count = cursor.fetchone()[0]
+    cursor.close()
+    conn.close()
+    return count
+
+
+def test_group_unread(app_module, fanout, make_user, make_group, client_for):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    group_id = make_group(alice, bob, carol)
+    alice_client, bob_client = client_for(alice), client_for(bob)
+    for i in range(3):
+        send_group(alice_client, group_id, f'group {i}')
+    send_group(bob_client, group_id)
+
+    assert group_unread(bob_client) == {group_id: 3}
+    assert group_unread(client_for(carol)) == {group_id: 4}
+    assert group_unread(alice_client) == {group_id: 1}
+    # 写扩散给除发送者外的每个成员写指针，读扩散不写
+    assert inbox_size(app_module, group_id) == (8 if fanout == 'inbox' else 0)
+
+    messages = bob_client.get(f'/group_chat/{group_id}/history').get_json()['messages']
+    bob_client.post(f'/group_chat/{group_id}/read', data={'last_id': messages[1]['id']})
+    assert group_unread(bob_client) == {group_id: 1}
+    bob_client.post(f'/group_chat/{group_id}/read', data={'last_id': messages[-1]['id'] + 1000})
+    assert group_unread(bob_client) == {}
+    if fanout == 'inbox':
+        # 已读的指针被清理
+        assert inbox_size(app_module, group_id) == 5
+
+
+def test_group_feed(fanout, make_user, make_group, client_for):
+    alice, bob = make_user(), make_user()
+    first, second = make_group(alice, bob), make_group(alice, bob)
+    alice_client = client_for(alice)
+    for i in range(3):
+        send_group(alice_client, first, f'first {i}')
+        send_group(alice_client, second, f'second {i}')
+
+    bob_client = client_for(bob)
+    contents = []
+    before = None
+    while True:
+        query = {'limit': 4} if before is None else {'limit': 4, 'before': before}
+        response = bob_client.get('/group_feed', query_string=query).get_json()
+        contents += [message['content'] for message in response['messages']]
+        before = response['next_cursor']
+        if before is None:
+            break
+    assert contents == ['second 2', 'first 2', 'second 1', 'first 1', 'second 0', 'first 0']
+
+
+def test_new_member_starts_at_latest_message(fanout, make_user, make_group, client_for):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice)
+    alice_client = client_for(alice)
+    send_group(alice_client, group_id, 'before join')
+
+    bob_client = client_for(bob)
+    assert bob_client.get(f'/join_group/{group_id}').status_code == 302
+    assert group_unread(bob_client) == {}
+    send_group(alice_client, group_id, 'after join')
+    assert group_unread(bob_client) == {group_id: 1}
+
+
+def test_large_group_switches_to_fanout_on_read(app_module, monkeypatch, make_user, make_group, client_for):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    group_id = make_group(alice, bob, carol)
+    alice_client = client_for(alice)
+    send_group(alice_client, group_id, 'small')
+    assert inbox_size(app_module, group_id) == 2
+
+    # 成员数超过阈值后切换为读扩散，已有的指针和水位之后的新消息都计入未读
+    monkeypatch.setattr(app_module, 'GROUP_FANOUT_MAX_MEMBERS', 2)
+    send_group(alice_client, group_id, 'large')
+    assert inbox_size(app_module, group_id) == 2
+    assert group_unread(client_for(bob)) == {group_id: 2}
+
+    # 切换后不再切回
+    monkeypatch.setattr(app_module, 'GROUP_FANOUT_MAX_MEMBERS', 100)
+    send_group(alice_client, group_id, 'still large')
+    assert inbox_size(app_module, group_id) == 2
+    assert group_unread(client_for(carol)) == {group_id: 3}
+
+
+def test_removed_member_has_no_group_unread(app_module, make_user, make_group, client_for):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice, bob)
+    send_group(client_for(alice), group_id)
+
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    app_module.storage.remove_group_member(cursor, group_id, bob)
+    conn.commit()
+    cursor.close()
+    conn.close()
+    assert group_unread(client_for(bob)) == {}
+    assert inbox_size(app_module, group_id) == 0
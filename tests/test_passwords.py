@@ -0,0 +1,107 @@
+# 密码哈希和登录限流：哈希可以放到进程池计算，排队满时拒绝；登录成功后按当前配置重新哈希
+import uuid
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+
+def make_hasher(app_module, workers=0, max_pending=4, method='scrypt'):
+    return app_module.PasswordHasher(method, 16, workers, max_pending, timeout=30)
+
+
+def test_hash_and_verify_in_request_thread(app_module):
+    hasher = make_hasher(app_module)
+    pwhash = hasher.hash('secret')
+    assert hasher.verify(pwhash, 'secret')
+    assert not hasher.verify(pwhash, 'wrong')
+
+
+def test_hash_and_verify_in_process_pool(app_module):
+    hasher = make_hasher(app_module, workers=1)
+    try:
+        pwhash = hasher.hash('secret')
+        assert hasher.verify(pwhash, 'secret')
+    finally:
+        hasher.close()
+
+
+def test_full_queue_rejects(app_module):
+    hasher = make_hasher(app_module, workers=1, max_pending=1)
+    # 占满排队名额，不需要真正启动进程池
+    hasher._slots.acquire()
+    with pytest.raises(app_module.PasswordHasherBusy):
+        hasher.verify('hash', 'secret')
+
+
+def test_needs_rehash_when_method_changes(app_module):
+    hasher = make_hasher(app_module, method='scrypt')
+    assert not hasher.needs_rehash(hasher.hash('secret'))
+    assert hasher.needs_rehash(generate_password_hash('secret', 'pbkdf2:sha256:1000'))
+
+
+def test_throttle_counts_failures_in_window(app_module):
+    throttle = app_module.LoginThrottle(limit=2, window=60)
+    throttle.fail('key')
+    assert not throttle.blocked('key')
+    throttle.fail('key')
+    assert throttle.blocked('key') and throttle.failures('key') == 2
+    throttle.reset('key')
+    assert not throttle.blocked('key')
+
+
+@pytest.fixture
+def account(app_module, make_user):
+    name = 'login_' + uuid.uuid4().hex[:8]
+    user_id = make_user(name)
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    app_module.storage.update_user_password(cursor, user_id, generate_password_hash('secret', 'pbkdf2:sha256:1000'))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return user_id, name
+
+
+def stored_hash(app_module, user_id):
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT password FROM users WHERE id = %s', (user_id,))
+    pwhash = cursor.fetchone()[0]
+    cursor.close()
+    conn.close()
+    return pwhash
+
+
+def login(app_module, name, password, ip='10.0.0.1'):
+    client = app_module.app.test_client()
+    response = client.post('/login', data={'login_type': 'password', 'username': name, 'password': password},
+                           environ_base={'REMOTE_ADDR': ip})
+    return response.status_code, response.headers.get('Location')
+
+
+def test_login_rehashes_outdated_hash(app_module, account):
+    user_id, name = account
+    assert login(app_module, name, 'secret') == (302, '/dashboard')
+    assert stored_hash(app_module, user_id).startswith('scrypt:')
+
+
+def test_login_blocked_after_ip_failures(app_module, account):
+    user_id, name = account
+    ip = '10.1.' + '.'.join(str(b) for b in uuid.uuid4().bytes[:2])
+    for i in range(app_module.LOGIN_MAX_ATTEMPTS_PER_IP):
+        app_module.login_ip_throttle.fail(ip)
+    # 被限流时即使密码正确也不校验
+    assert login(app_module, name, 'secret', ip) == (302, '/login')
+    assert login(app_module, name, 'secret', '10.2.0.1') == (302, '/dashboard')
+
+
+def test_locked_username_only_blocks_failing_ips(app_module, account):
+    user_id, name = account
+    for i in range(app_module.LOGIN_MAX_ATTEMPTS_PER_USER):
+        app_module.login_user_throttle.fail(name)
+    app_module.login_ip_throttle.fail('10.3.0.1')
+
+    assert login(app_module, name, 'secret', '10.3.0.1') == (302, '/login')
+    # 没有失败过的 IP 不受用户名限流影响，成功登录后用户名的计数清零
+    assert login(app_module, name, 'secret', '10.3.0.2') == (302, '/dashboard')
+    assert not app_module.login_user_throttle.blocked(name)
@@ -0,0 +1,110 @@
+# 连接池：借出的连接 close() 时归还，连接数有上限，过期和失效的连接在借出前被替换
+import threading
+import time
+
+import pytest
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+        self.broken = False
+
+    def ping(self, reconnect=False):
+        if self.broken:
+            raise Error('server has gone away')
+
+    def rollback(self):
+        if self.broken:
+            raise Error('server has gone away')
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections():
+    return []
+
+
+@pytest.fixture
+def make_pool(app_module, connections):
+    def connect():
+        conn = FakeConnection()
+        connections.append(conn)
+        return conn
+
+    def make(**config):
+        return app_module.ConnectionPool(connect, **dict({'size': 2, 'timeout': 0.2}, **config))
+    return make
+
+
+def test_released_connection_is_reused(make_pool, connections):
+    pool = make_pool()
+    conn = pool.acquire()
+    conn.close()
+    # 归还时回滚未提交的事务
+    assert connections[0].rollbacks == 1
+    pool.acquire().close()
+    assert len(connections) == 1
+    assert pool.stats()['checkouts'] == 2 and pool.stats()['created'] == 1
+
+
+def test_returned_connection_cannot_be_used(make_pool):
+    conn = make_pool().acquire()
+    conn.close()
+    with pytest.raises(PoolError):
+        conn.commit()
+    # 重复 close 不会把同一条连接归还两次
+    conn.close()
+
+
+def test_acquire_times_out_when_exhausted(make_pool):
+    pool = make_pool()
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(PoolError):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+    for conn in held:
+        conn.close()
+
+
+def test_waiter_gets_released_connection(make_pool):
+    pool = make_pool(size=1, timeout=5)
+    conn = pool.acquire()
+    threading.Timer(0.05, conn.close).start()
+    pool.acquire().close()
+    assert pool.stats()['waits'] == 1
+    assert pool.stats()['open'] == 1
+
+
+def test_old_connection_is_recycled(make_pool, connections):
+    pool = make_pool(max_lifetime=0.05)
+    pool.acquire().close()
+    time.sleep(0.1)
+    pool.acquire().close()
+    assert connections[0].closed
+    assert len(connections) == 2 and pool.stats()['recycled'] == 1
+
+
+def test_broken_idle_connection_is_replaced(make_pool, connections):
+    pool = make_pool(ping_interval=0)
+    pool.acquire().close()
+    connections[0].broken = True
+    pool.acquire().close()
+    assert len(connections) == 2 and pool.stats()['broken'] == 1
+    assert pool.stats()['open'] == 1
+
+
+def test_failed_connect_frees_slot(app_module):
+    def connect():
+        raise Error('connection refused')
+    pool = app_module.ConnectionPool(connect, size=1, timeout=0.2)
+    for i in range(2):
+        with pytest.raises(Error):
+            pool.acquire()
+    assert pool.stats()['open'] == 0
@@ -0,0 +1,64 @@
+# 推送总线：同步服务的各进程和异步服务共用一个 SQLite 事件文件，任意一边发布的事件都推送到所有订阅者
+# 每个 SQLitePushBus 实例代表一个进程
+import asyncio
+import os
+import queue
+import time
+
+import pytest
+
+
+@pytest.fixture
+def bus_path(app_module, tmp_path):
+    return os.path.join(tmp_path, 'push.db')
+
+
+def test_events_reach_other_process(app_module, bus_path):
+    publisher = app_module.MessageHub(bus=app_module.SQLitePushBus(bus_path, 0.01))
+    listener = app_module.MessageHub(bus=app_module.SQLitePushBus(bus_path, 0.01))
+    subscriber = listener.subscribe(1)
+    other = listener.subscribe(2)
+
+    publisher.publish([1], 'message', {'content': '你好'})
+    assert subscriber.queue.get(timeout=5) == ('message', {'content': '你好'})
+    with pytest.raises(queue.Empty):
+        other.queue.get(timeout=0.1)
+
+
+def test_bus_skips_events_before_start(app_module, bus_path):
+    bus = app_module.SQLitePushBus(bus_path, 0.01)
+    bus.publish([1], 'message', {'content': 'old'})
+    hub = app_module.MessageHub(bus=app_module.SQLitePushBus(bus_path, 0.01))
+    subscriber = hub.subscribe(1)
+    bus.publish([1], 'message', {'content': 'new'})
+    assert subscriber.queue.get(timeout=5) == ('message', {'content': 'new'})
+
+
+def test_message_event_invalidates_unread_cache(app_module, bus_path):
+    bus = app_module.SQLitePushBus(bus_path, 0.01)
+    bus.listen(app_module.invalidate_unread_on_message)
+    bus.start()
+    app_module.unread_cache.set(-1, {2: 1})
+    app_module.SQLitePushBus(bus_path, 0.01).publish([-1], 'message', {})
+    for i in range(100):
+        if app_module.unread_cache.get(-1) is None:
+            break
+        time.sleep(0.05)
+    assert app_module.unread_cache.get(-1) is None
+
+
+def test_async_hub_shares_bus_with_flask(app_module, bus_path):
+    async_app = pytest.importorskip('async_app')
+    flask_hub = app_module.MessageHub(bus=app_module.SQLitePushBus(bus_path, 0.01))
+    flask_subscriber = flask_hub.subscribe(1)
+
+    async def run():
+        hub = async_app.AsyncMessageHub(bus=app_module.SQLitePushBus(bus_path, 0.01))
+        subscriber = hub.subscribe(2)
+        flask_hub.publish([2], 'message', {'content': 'from flask'})
+        received = await asyncio.wait_for(subscriber.queue.get(), 5)
+        await hub.publish([1], 'group_message', {'content': 'from async'})
+        return received
+
+    assert asyncio.run(run()) == ('message', {'content': 'from flask'})
+    assert flask_subscriber.queue.get(timeout=5) == ('group_message', {'content': 'from async'})
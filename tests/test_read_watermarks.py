@@ -0,0 +1,64 @@
+# 私聊已读水位：每个会话一行，记录读者已读到的最大消息 id，消息的已读状态由水位推算
+
+
+def send(client, receiver_id, content='hi'):
+    response = client.post('/send_message', data={'receiver_id': receiver_id, 'content': content})
+    assert response.get_json()['success']
+
+
+def unread(client):
+    response = client.get('/unread_counts').get_json()
+    return {int(peer_id): count for peer_id, count in response['conversations'].items()}
+
+
+def message_ids(client, peer_id):
+    return [message['id'] for message in client.get(f'/chat/{peer_id}/history').get_json()['messages']]
+
+
+def test_read_watermark_capped_at_peer_messages(make_user, client_for):
+    alice, bob = make_user(), make_user()
+    alice_client, bob_client = client_for(alice), client_for(bob)
+    send(alice_client, bob)
+    last_id = message_ids(bob_client, alice)[-1]
+
+    # 上报的 id 超过对方最后一条消息时，水位停在对方最后一条消息，之后的新消息仍是未读
+    response = bob_client.post(f'/chat/{alice}/read', data={'last_id': last_id + 1000}).get_json()
+    assert response['last_read_id'] == last_id
+    send(alice_client, bob)
+    assert unread(bob_client) == {alice: 1}
+
+
+def test_read_state_follows_watermarks(make_user, client_for):
+    alice, bob = make_user(), make_user()
+    alice_client, bob_client = client_for(alice), client_for(bob)
+    send(alice_client, bob, 'first')
+    send(alice_client, bob, 'second')
+    first_id = message_ids(bob_client, alice)[0]
+    bob_client.post(f'/chat/{alice}/read', data={'last_id': first_id})
+
+    messages = alice_client.get(f'/chat/{bob}/history').get_json()['messages']
+    assert [(m['content'], m['is_read']) for m in messages] == [('first', True), ('second', False)]
+
+
+def test_backfill_from_is_read_flags(app_module, make_user):
+    alice, bob = make_user(), make_user()
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    ids = []
+    for is_read in (True, True, False, True):
+        cursor.execute('INSERT INTO messages (sender_id, receiver_id, content, is_read) VALUES (%s, %s, %s, %s)',
+                       (alice, bob, 'imported', is_read))
+        ids.append(cursor.lastrowid)
+    cursor.execute('INSERT INTO messages (sender_id, receiver_id, content, is_read) VALUES (%s, %s, %s, %s)',
+                   (bob, alice, 'imported', True))
+    reply_id = cursor.lastrowid
+    app_module.backfill_conversation_reads(cursor)
+    cursor.execute('SELECT user_id, peer_id, last_read_id FROM conversation_reads WHERE user_id IN (%s, %s)',
+                   (alice, bob))
+    reads = sorted(cursor.fetchall())
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    # 第一条未读消息之前的都算已读，全部已读时水位为最后一条
+    assert reads == sorted([(bob, alice, ids[1]), (alice, bob, reply_id)])
@@ -0,0 +1,90 @@
+# 读写分离：用两个本地 SQLite 文件模拟主库和只读副本，用 sqlite3 的备份 API 代替复制
+# MySQL 环境的对应配置为 DB_REPLICAS=副本host:port，复制延迟由 replication_heartbeat 心跳表测量
+import sqlite3
+import time
+
+import pytest
+
+
+@pytest.fixture
+def replicate(app_module, monkeypatch, tmp_path):
+    path = str(tmp_path / 'replica.db')
+    replica_set = app_module.ReplicaSet([path], app_module.REPLICA_MAX_LAG)
+    monkeypatch.setattr(app_module, 'replica_set', replica_set)
+
+    # 把主库当前的全部数据复制到副本，并探测副本的复制进度
+    def sync():
+        app_module.write_replication_heartbeat()
+        source = sqlite3.connect(app_module.storage.SQLITE_DB)
+        target = sqlite3.connect(path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        replica_set.probe()
+        return replica_set
+
+    sync()
+    return sync
+
+
+def history(client, peer_id):
+    response = client.get(f'/chat/{peer_id}/history').get_json()
+    assert response['success']
+    return [message['content'] for message in response['messages']]
+
+
+def test_reads_use_replica_until_it_catches_up(make_user, client_for, replicate):
+    alice, bob = make_user(), make_user()
+    alice_client, bob_client = client_for(alice), client_for(bob)
+
+    response = alice_client.post('/send_message', data={'receiver_id': bob, 'content': 'hello bob'})
+    assert response.get_json()['success']
+
+    # 副本还没有这条消息：其他人的读取仍发往副本
+    assert history(bob_client, alice) == []
+    replicate()
+    assert history(bob_client, alice) == ['hello bob']
+
+
+def test_sender_reads_own_write_from_primary(app_module, make_user, client_for, replicate):
+    alice, bob = make_user(), make_user()
+    alice_client = client_for(alice)
+
+    response = alice_client.post('/send_message', data={'receiver_id': bob, 'content': 'mine'})
+    assert response.get_json()['success']
+    # 读己之写的时间点放在 cookie 中，不写会话存储
+    assert app_module.READ_AFTER_COOKIE in response.headers.get('Set-Cookie', '')
+    with alice_client.session_transaction() as session:
+        assert 'read_after' not in session
+
+    assert history(alice_client, bob) == ['mine']
+
+
+def test_lagging_replica_is_skipped(make_user, client_for, replicate):
+    alice, bob = make_user(), make_user()
+    replica_set = replicate()
+    client_for(alice).post('/send_message', data={'receiver_id': bob, 'content': 'late'})
+
+    replica_set._replicas[0].applied_at = time.time() - 60
+    assert history(client_for(bob), alice) == ['late']
+
+
+def test_group_membership_is_checked_on_primary(app_module, make_user, make_group, client_for, replicate):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice, bob)
+    bob_client = client_for(bob)
+    assert bob_client.get(f'/group_chat/{group_id}/history').get_json()['success']
+    replicate()
+
+    # 只在主库移除成员，副本上仍是成员
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    app_module.storage.remove_group_member(cursor, group_id, bob)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    response = bob_client.get(f'/group_chat/{group_id}/history').get_json()
+    assert response == {'success': False, 'message': '你不是该群组成员'}
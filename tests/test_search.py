@@ -0,0 +1,135 @@
+# 全文搜索：分词规则，以及倒排表上的交集、可见范围和候选文档上限
+import uuid
+
+
+def search(client, text, **args):
+    response = client.get('/search', query_string=dict(args, q=text)).get_json()
+    assert response['success']
+    return response
+
+
+def contents(client, text, **args):
+    return sorted(result['content'] for result in search(client, text, **args)['results'])
+
+
+def test_tokenize_index_mode(app_module):
+    # 中日韩文字写入单字和双字，其他文字按词切分
+    assert app_module.tokenize('今天天气 Hello, World') == [
+        '今', '天', '天', '气', '今天', '天天', '天气', 'hello', 'world']
+
+
+def test_tokenize_query_mode(app_module):
+    assert app_module.tokenize('今天天气', query=True) == ['今天', '天天', '天气']
+    assert app_module.tokenize('好', query=True) == ['好']
+
+
+def test_tokenize_normalizes_width_and_case(app_module):
+    assert app_module.tokenize('ＡＢＣ１２３') == ['abc123']
+    assert app_module.tokenize('x' * 40) == ['x' * app_module.SEARCH_TERM_LENGTH]
+    assert app_module.tokenize('') == []
+
+
+def word():
+    return 'w' + uuid.uuid4().hex[:10]
+
+
+def test_search_requires_all_terms(make_user, client_for):
+    alice, bob = make_user(), make_user()
+    alice_client = client_for(alice)
+    first, second = word(), word()
+    alice_client.post('/send_message', data={'receiver_id': bob, 'content': f'{first} {second}'})
+    alice_client.post('/send_message', data={'receiver_id': bob, 'content': first})
+
+    assert contents(client_for(bob), first) == [first, f'{first} {second}']
+    assert contents(client_for(bob), f'{second} {first}') == [f'{first} {second}']
+
+
+def test_search_single_cjk_character(make_user, client_for):
+    alice, bob = make_user(), make_user()
+    marker = word()
+    client_for(alice).post('/send_message', data={'receiver_id': bob, 'content': f'{marker} 你好'})
+
+    assert contents(client_for(bob), f'{marker} 好') == [f'{marker} 你好']
+    assert contents(client_for(bob), f'{marker} 你好') == [f'{marker} 你好']
+    assert contents(client_for(bob), f'{marker} 好你') == []
+
+
+def test_search_scopes(make_user, make_group, client_for):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    group_id = make_group(alice, bob)
+    marker = word()
+    alice_client = client_for(alice)
+    alice_client.post('/send_message', data={'receiver_id': bob, 'content': f'{marker} private'})
+    alice_client.post('/send_group_message', data={'group_id': group_id, 'content': f'{marker} group'})
+    alice_client.post('/add_comment', data={'content': f'{marker} comment'})
+
+    assert contents(client_for(bob), marker) == [f'{marker} comment', f'{marker} group', f'{marker} private']
+    # 不是私聊双方也不是群成员，只能搜到公开评论
+    assert contents(client_for(carol), marker) == [f'{marker} comment']
+    types = {result['content']: result['type'] for result in search(client_for(bob), marker)['results']}
+    assert types[f'{marker} group'] == 'group_message'
+    assert contents(client_for(bob), marker, type='message') == [f'{marker} private']
+
+
+def test_removed_member_loses_group_results(app_module, make_user, make_group, client_for):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice, bob)
+    marker = word()
+    client_for(alice).post('/send_group_message', data={'group_id': group_id, 'content': marker})
+    bob_client = client_for(bob)
+    assert contents(bob_client, marker) == [marker]
+
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    app_module.storage.remove_group_member(cursor, group_id, bob)
+    conn.commit()
+    cursor.close()
+    conn.close()
+    assert contents(bob_client, marker) == []
+
+
+def test_search_offset_pages(make_user, client_for):
+    alice, bob = make_user(), make_user()
+    marker = word()
+    alice_client = client_for(alice)
+    for i in range(5):
+        alice_client.post('/send_message', data={'receiver_id': bob, 'content': f'{marker} {i}'})
+
+    bob_client = client_for(bob)
+    found = []
+    offset = 0
+    while offset is not None:
+        response = search(bob_client, marker, offset=offset, limit=2)
+        found += [result['content'] for result in response['results']]
+        offset = response['next_offset']
+    # 同分时新的在前
+    assert found == [f'{marker} {i}' for i in reversed(range(5))]
+
+
+def test_search_candidates_capped(app_module, monkeypatch, make_user, client_for):
+    monkeypatch.setattr(app_module, 'SEARCH_MAX_POSTINGS', 3)
+    alice, bob = make_user(), make_user()
+    common, rare = word(), word()
+    alice_client = client_for(alice)
+    for i in range(5):
+        alice_client.post('/send_message', data={'receiver_id': bob, 'content': f'{common} {rare} {i}'})
+
+    # 所有词都超过上限时只在最新的 SEARCH_MAX_POSTINGS 篇文档中查找
+    found = contents(client_for(bob), f'{common} {rare}')
+    assert found == [f'{common} {rare} {i}' for i in (2, 3, 4)]
+
+
+def test_rebuild_search_index(app_module, make_user, client_for):
+    alice, bob = make_user(), make_user()
+    marker = word()
+    client_for(alice).post('/send_message', data={'receiver_id': bob, 'content': marker})
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM search_postings')
+    conn.commit()
+    cursor.close()
+    conn.close()
+    assert contents(client_for(bob), marker) == []
+
+    app_module.rebuild_search_index(batch_size=2)
+    assert contents(client_for(bob), marker) == [marker]
@@ -0,0 +1,104 @@
+# 服务端会话：cookie 里只有随机的会话 id，数据保存在会话存储中；登录换发会话 id，退出登录后旧 id 立即失效
+import os
+import time
+import uuid
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+
+def test_memory_store_expires_and_evicts(app_module):
+    store = app_module.MemorySessionStore(max_entries=2)
+    store.save('expired', 1, 'data', time.time() - 1)
+    assert store.get('expired') is None
+
+    expire_time = time.time() + 60
+    store.save('a', 1, 'a', expire_time)
+    store.save('b', 2, 'b', expire_time)
+    store.get('a')
+    store.save('c', 3, 'c', expire_time)
+    # 超过上限时淘汰最久未使用的会话
+    assert store.get('b') is None
+    assert store.get('a') == ('a', expire_time)
+
+
+def test_sqlite_store_is_shared_between_instances(app_module, tmp_path):
+    path = os.path.join(tmp_path, 'sessions.db')
+    first, second = app_module.SQLiteSessionStore(path), app_module.SQLiteSessionStore(path)
+    expire_time = time.time() + 60
+    first.save('sid', 1, 'data', expire_time)
+    assert tuple(second.get('sid')) == ('data', expire_time)
+
+    second.delete('sid')
+    assert first.get('sid') is None
+    first.save('expired', 1, 'data', time.time() - 1)
+    assert second.get('expired') is None
+
+
+def test_cached_store_delete_invalidates_cache(app_module, tmp_path):
+    store = app_module.CachedSessionStore(
+        app_module.SQLiteSessionStore(os.path.join(tmp_path, 'sessions.db')), ttl=60, maxsize=10)
+    store.save('sid', 1, 'data', time.time() + 60)
+    assert store.get('sid')[0] == 'data'
+    store.delete('sid')
+    assert store.get('sid') is None
+
+
+@pytest.fixture
+def account(app_module, make_user):
+    name = 'session_' + uuid.uuid4().hex[:8]
+    user_id = make_user(name)
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    app_module.storage.update_user_password(cursor, user_id, generate_password_hash('secret', 'scrypt'))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return user_id, name
+
+
+def session_id(app_module, client):
+    cookie = client.get_cookie(app_module.app.config['SESSION_COOKIE_NAME'])
+    return cookie.value if cookie else None
+
+
+def login(client, name):
+    response = client.post('/login', data={'login_type': 'password', 'username': name, 'password': 'secret'})
+    assert response.headers['Location'] == '/dashboard'
+
+
+def test_login_stores_session_server_side(app_module, account):
+    user_id, name = account
+    client = app_module.app.test_client()
+    login(client, name)
+
+    sid = session_id(app_module, client)
+    assert str(user_id) not in sid and name not in sid
+    assert app_module.load_session(sid) == {'user_id': user_id, 'username': name}
+
+
+def test_login_regenerates_session_id(app_module, account):
+    user_id, name = account
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['visited'] = True
+    old_sid = session_id(app_module, client)
+    assert old_sid
+
+    login(client, name)
+    assert session_id(app_module, client) != old_sid
+    assert app_module.load_session(old_sid) is None
+
+
+def test_logout_invalidates_session_id(app_module, account):
+    user_id, name = account
+    client = app_module.app.test_client()
+    login(client, name)
+    sid = session_id(app_module, client)
+
+    client.get('/logout')
+    assert app_module.load_session(sid) is None
+    # 退出前复制走的会话 id 不能再用
+    stolen = app_module.app.test_client()
+    stolen.set_cookie(app_module.app.config['SESSION_COOKIE_NAME'], sid)
+    assert stolen.get('/unread_counts').get_json() == {'count': 0, 'conversations': {}}
@@ -0,0 +1,118 @@
+# 短信发送：后台队列发送、失败重试、熔断，以及验证码只在发送成功后保存
+import time
+import uuid
+
+import pytest
+
+
+class FakeGateway:
+    def __init__(self, app_module, failures=0):
+        self._error = app_module.SMSError
+        self.failures = failures
+        self.sent = []
+
+    def send(self, phone, code):
+        if self.failures:
+            self.failures -= 1
+            raise self._error('gateway error')
+        self.sent.append((phone, code))
+
+
+@pytest.fixture
+def no_backoff(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'SMS_RETRY_BACKOFF', 0)
+
+
+def wait_for(dispatcher, job_id, statuses=('sent', 'failed')):
+    for i in range(100):
+        job = dispatcher.status(job_id)
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'任务状态未完成: {job}')
+
+
+def phone():
+    return '1' + uuid.uuid4().hex[:10]
+
+
+def test_breaker_opens_after_threshold_and_probes_once(app_module):
+    breaker = app_module.CircuitBreaker(threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    time.sleep(0.06)
+    # 超时后只放行一次试探
+    assert breaker.allow()
+    assert breaker.state == 'half_open' and not breaker.allow()
+    # 试探失败重新打开，试探成功关闭
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_code_saved_after_retried_send(app_module, no_backoff):
+    gateway = FakeGateway(app_module, failures=1)
+    dispatcher = app_module.SMSDispatcher(gateway, app_module.CircuitBreaker(5, 30), workers=1)
+    number = phone()
+    job_id = dispatcher.submit(number, '123456')
+
+    assert wait_for(dispatcher, job_id)['status'] == 'sent'
+    assert gateway.sent == [(number, '123456')]
+    assert app_module.verification_codes.verify(number, '123456') is True
+
+
+def test_failed_send_releases_resend_interval(app_module, no_backoff):
+    gateway = FakeGateway(app_module, failures=app_module.SMS_MAX_RETRIES)
+    dispatcher = app_module.SMSDispatcher(gateway, app_module.CircuitBreaker(100, 30), workers=1)
+    number = phone()
+    assert app_module.verification_codes.reserve_send(number, 60)
+    job = wait_for(dispatcher, dispatcher.submit(number, '123456'))
+
+    assert job == {'status': 'failed', 'phone': number, 'error': 'gateway error'}
+    assert app_module.verification_codes.verify(number, '123456') is None
+    # 发送失败后可以立即重新发送
+    assert app_module.verification_codes.reserve_send(number, 60)
+
+
+def test_open_breaker_skips_gateway(app_module, no_backoff):
+    gateway = FakeGateway(app_module)
+    breaker = app_module.CircuitBreaker(1, 30)
+    breaker.record_failure()
+    dispatcher = app_module.SMSDispatcher(gateway, breaker, workers=1)
+    job = wait_for(dispatcher, dispatcher.submit(phone(), '123456'))
+
+    assert job['error'] == '短信服务暂时不可用'
+    assert gateway.sent == []
+
+
+def test_full_queue_rejects_submit(app_module, monkeypatch):
+    dispatcher = app_module.SMSDispatcher(FakeGateway(app_module), app_module.CircuitBreaker(5, 30),
+                                          workers=1, queue_size=1)
+    # 不启动工作线程，队列中的任务不会被取走
+    monkeypatch.setattr(dispatcher, '_start', lambda: None)
+    assert dispatcher.submit(phone(), '111111')
+    assert dispatcher.submit(phone(), '222222') is None
+
+
+def test_send_code_endpoint(app_module, make_user):
+    number = phone()
+    make_user(number)
+    client = app_module.app.test_client()
+    response = client.post('/send_code', data={'phone': number}).get_json()
+    assert response['success'] and response['job_id']
+
+    for i in range(100):
+        status = client.get(f"/send_code/status/{response['job_id']}").get_json()
+        if status['status'] == 'sent':
+            break
+        time.sleep(0.02)
+    assert status == {'success': True, 'status': 'sent'}
+    # 发送间隔内再次请求被拒绝
+    assert client.post('/send_code', data={'phone': number}).get_json() == {
+        'success': False, 'message': '请稍后再试'}
@@ -0,0 +1,46 @@
+# 聊天页面流式输出：消息列表由按查看者缓存的单条消息片段拼成
+import jinja2
+import pytest
+
+TEMPLATES = {
+    'chat.html': '<h1>{{ chat_user.username }}</h1>{% for block in message_blocks %}{{ block }}{% endfor %}',
+    'group_chat.html': '<h1>{{ group.name }}</h1>{% for block in message_blocks %}{{ block }}{% endfor %}',
+    # 片段中使用请求上下文，不同查看者看到的内容不同
+    '_chat_message.html': '<p>{{ message.content }}|{{ is_mine }}|{{ message.is_read }}|{{ session.username }}</p>',
+    '_group_message.html': '<p>{{ message.content }}|{{ is_mine }}|{{ session.username }}</p>',
+}
+
+
+@pytest.fixture
+def templates(app_module, monkeypatch):
+    loader = jinja2.ChoiceLoader([jinja2.DictLoader(TEMPLATES), app_module.app.jinja_env.loader])
+    monkeypatch.setattr(app_module.app.jinja_env, 'loader', loader)
+    yield
+    app_module.message_fragment_cache.clear()
+
+
+def test_chat_page_streams_fragments(app_module, templates, make_user, client_for):
+    alice, bob = make_user(), make_user()
+    alice_client = client_for(alice)
+    alice_client.post('/send_message', data={'receiver_id': bob, 'content': 'hello'})
+
+    response = client_for(bob).get(f'/chat/{alice}')
+    assert response.is_streamed
+    body = response.get_data(as_text=True)
+    # 打开页面时水位推进到本页最新一条消息
+    assert f'<p>hello|False|True|user{bob}</p>' in body
+
+    body = alice_client.get(f'/chat/{bob}').get_data(as_text=True)
+    assert f'<p>hello|True|True|user{alice}</p>' in body
+
+
+def test_fragments_are_cached_per_viewer(app_module, templates, make_user, make_group, client_for):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice, bob)
+    client_for(alice).post('/send_group_message', data={'group_id': group_id, 'content': 'hi all'})
+
+    assert f'<p>hi all|True|user{alice}</p>' in client_for(alice).get(f'/group_chat/{group_id}').get_data(as_text=True)
+    assert f'<p>hi all|False|user{bob}</p>' in client_for(bob).get(f'/group_chat/{group_id}').get_data(as_text=True)
+    message_id = client_for(bob).get(f'/group_chat/{group_id}/history').get_json()['messages'][0]['id']
+    for viewer in (alice, bob):
+        assert app_module.message_fragment_cache.get(('_group_message.html', message_id, viewer)) is not None
@@ -0,0 +1,73 @@
+# 未读计数：私聊按会话维护的计数器，发送时累加，标记已读和定期对账时按水位重算
+
+
+def send(client, receiver_id, content='hi'):
+    response = client.post('/send_message', data={'receiver_id': receiver_id, 'content': content})
+    assert response.get_json()['success']
+
+
+def unread(client):
+    response = client.get('/unread_counts').get_json()
+    return {int(peer_id): count for peer_id, count in response['conversations'].items()}
+
+
+def message_ids(client, peer_id):
+    return [message['id'] for message in client.get(f'/chat/{peer_id}/history').get_json()['messages']]
+
+
+def test_unread_counter_and_watermark(make_user, client_for):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    alice_client, bob_client = client_for(alice), client_for(bob)
+    for i in range(3):
+        send(alice_client, bob)
+    send(client_for(carol), bob)
+    assert unread(bob_client) == {alice: 3, carol: 1}
+    assert bob_client.get('/unread_count').get_json() == {'count': 4}
+    # 发送者自己不计未读
+    assert unread(alice_client) == {}
+
+    ids = message_ids(bob_client, alice)
+    response = bob_client.post(f'/chat/{alice}/read', data={'last_id': ids[1]}).get_json()
+    assert response == {'success': True, 'last_read_id': ids[1]}
+    assert unread(bob_client) == {alice: 1, carol: 1}
+
+    # 水位不回退
+    bob_client.post(f'/chat/{alice}/read', data={'last_id': ids[0]})
+    assert unread(bob_client) == {alice: 1, carol: 1}
+
+
+def test_cached_counts_invalidated_on_send(app_module, make_user, client_for):
+    alice, bob = make_user(), make_user()
+    bob_client = client_for(bob)
+    send(client_for(alice), bob)
+    assert unread(bob_client) == {alice: 1}
+    assert app_module.unread_cache.get(bob) == {alice: 1}
+
+    send(client_for(alice), bob)
+    assert app_module.unread_cache.get(bob) is None
+    assert unread(bob_client) == {alice: 2}
+
+
+def test_unread_count_logged_out(app_module):
+    response = app_module.app.test_client().get('/unread_count')
+    assert response.get_json() == {'count': 0}
+
+
+def test_reconcile_fixes_drifted_counters(app_module, make_user, client_for):
+    alice, bob = make_user(), make_user()
+    bob_client = client_for(bob)
+    send(client_for(alice), bob)
+    send(client_for(alice), bob)
+    bob_client.post(f'/chat/{alice}/read', data={'last_id': message_ids(bob_client, alice)[0]})
+
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE unread_counters SET count = 7 WHERE user_id = %s AND peer_id = %s', (bob, alice))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    app_module.unread_cache.delete(bob)
+    assert unread(bob_client) == {alice: 7}
+
+    app_module.reconcile_unread_counters()
+    assert unread(bob_client) == {alice: 1}
@@ -0,0 +1,31 @@
+# 用户目录：按用户名前缀分页搜索，游标为上一页最后一个用户名
+import uuid
+
+
+def test_user_search_pages(make_user, client_for, collect):
+    prefix = 'page' + uuid.uuid4().hex[:8]
+    names = sorted(f'{prefix}_{i}' for i in range(5))
+    for name in names:
+        make_user(name)
+    client = client_for(make_user())
+
+    pages = collect(client, '/users/search', 'users', cursor_arg='after', limit=2, q=prefix)
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [user['username'] for page in pages for user in page] == names
+
+
+def test_user_search_escapes_like_wildcards(make_user, client_for):
+    prefix = 'esc' + uuid.uuid4().hex[:8]
+    make_user(prefix + '_a')
+    make_user(prefix + 'xa')
+    client = client_for(make_user())
+    users = client.get('/users/search', query_string={'q': prefix + '_'}).get_json()['users']
+    assert [user['username'] for user in users] == [prefix + '_a']
+
+
+def test_user_search_excludes_self(make_user, client_for):
+    prefix = 'self' + uuid.uuid4().hex[:8]
+    me = make_user(prefix + '_me')
+    make_user(prefix + '_other')
+    users = client_for(me).get('/users/search', query_string={'q': prefix}).get_json()['users']
+    assert [user['username'] for user in users] == [prefix + '_other']
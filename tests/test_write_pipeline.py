@@ -0,0 +1,148 @@
+# 批量写入：多行 INSERT 返回的 id 必须与每一行一一对应，管道按批提交后把 id 交回给每个写入
+import threading
+import uuid
+
+import pytest
+
+
+def contents_by_id(app_module, table, ids):
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id, content FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+    rows = dict(cursor.fetchall())
+    cursor.close()
+    conn.close()
+    return rows
+
+
+def test_insert_rows_returns_id_per_row(app_module, make_user):
+    user_id = make_user()
+    rows = [(user_id, uuid.uuid4().hex) for i in range(5)]
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    ids = app_module.storage.insert_rows(cursor, 'comments', ('user_id', 'content'), rows)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    assert ids == list(range(ids[0], ids[0] + 5))
+    assert contents_by_id(app_module, 'comments', ids) == {
+        comment_id: content for comment_id, (user_id, content) in zip(ids, rows)}
+
+
+def test_insert_rows_row_by_row_when_ids_not_contiguous(app_module, monkeypatch, make_user):
+    monkeypatch.setattr(app_module.dialect, 'contiguous_ids', lambda cursor: False)
+    user_id = make_user()
+    rows = [(user_id, uuid.uuid4().hex) for i in range(3)]
+    conn = app_module.get_db_connection()
+    cursor = conn.cursor()
+    ids = app_module.storage.insert_rows(cursor, 'comments', ('user_id', 'content'), rows)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    assert contents_by_id(app_module, 'comments', ids) == {
+        comment_id: content for comment_id, (user_id, content) in zip(ids, rows)}
+
+
+@pytest.fixture
+def pipeline(app_module):
+    # 等待时间足够长，测试中并发提交的写入会合并成一批
+    write_pipeline = app_module.WritePipeline(batch_size=100, max_delay=0.2)
+    yield write_pipeline
+    write_pipeline.close()
+
+
+def submit_all(pipeline, items):
+    submitted = [pipeline.submit(kind, row) for kind, row in items]
+    for item in submitted:
+        assert item.done.wait(5)
+    return submitted
+
+
+def test_pipeline_batch_assigns_ids_to_rows(app_module, pipeline, make_user, make_group):
+    alice, bob = make_user(), make_user()
+    group_id = make_group(alice, bob)
+    items = []
+    for i in range(4):
+        items.append(('message', (alice, bob, uuid.uuid4().hex)))
+        items.append(('group_message', (group_id, alice, uuid.uuid4().hex)))
+        items.append(('comment', (alice, uuid.uuid4().hex)))
+    submitted = submit_all(pipeline, items)
+
+    assert pipeline.stats()['batches'] == 1
+    tables = {'message': 'messages', 'group_message': 'group_messages', 'comment': 'comments'}
+    for kind, table in tables.items():
+        kind_items = [item for item in submitted if item.kind == kind]
+        assert all(item.error is None for item in kind_items)
+        stored = contents_by_id(app_module, table, [item.row_id for item in kind_items])
+        assert stored == {item.row_id: item.row[-1] for item in kind_items}
+
+
+def test_pipeline_bad_row_fails_alone(app_module, pipeline, make_user):
+    user_id = make_user()
+    good = [('comment', (user_id, uuid.uuid4().hex)) for i in range(2)]
+    # content 为 NULL 违反非空约束，整批回滚后逐条重试
+    good_first, bad, good_last = submit_all(pipeline, [good[0], ('comment', (user_id, None)), good[1]])
+
+    assert bad.error and bad.row_id is None
+    assert good_first.error is None and good_last.error is None
+    assert contents_by_id(app_module, 'comments', [good_first.row_id, good_last.row_id]) == {
+        good_first.row_id: good[0][1][1], good_last.row_id: good[1][1][1]}
+    assert pipeline.stats()['errors'] == 1
+
+
+def test_pipeline_survives_handler_error(app_module, monkeypatch, pipeline, make_user):
+    def broken(cursor, rows):
+        raise RuntimeError('broken handler')
+    monkeypatch.setitem(app_module.WRITE_HANDLERS, 'broken', broken)
+
+    item, = submit_all(pipeline, [('broken', ())])
+    assert item.error == 'broken handler'
+    # 写入线程仍在运行
+    item, = submit_all(pipeline, [('comment', (make_user(), 'after error'))])
+    assert item.error is None and item.row_id
+
+
+def test_write_row_through_pipeline(app_module, monkeypatch, pipeline, make_user, client_for):
+    monkeypatch.setattr(app_module, 'WRITE_PIPELINE_ENABLED', True)
+    monkeypatch.setattr(app_module, 'write_pipeline', pipeline)
+    alice, bob = make_user(), make_user()
+    alice_client = client_for(alice)
+    results = []
+
+    def send(i):
+        response = alice_client.post('/send_message', data={'receiver_id': bob, 'content': f'piped {i}'})
+        results.append(response.get_json().get('success'))
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True] * 6
+    assert pipeline.stats()['rows'] == 6
+    assert pipeline.stats()['batches'] < 6
+    # 同一批内的未读计数按接收者合并累加
+    assert client_for(bob).get('/unread_counts').get_json()['conversations'] == {str(alice): 6}
+
+
+def test_pipeline_close_flushes_buffer(app_module, make_user):
+    write_pipeline = app_module.WritePipeline(batch_size=100, max_delay=10)
+    item = write_pipeline.submit('comment', (make_user(), 'flushed on close'))
+    write_pipeline.close()
+    assert item.done.is_set() and item.row_id
+
+
+def test_full_buffer_rejects_write(app_module, monkeypatch, make_user):
+    write_pipeline = app_module.WritePipeline(buffer_size=1, enqueue_timeout=0.05)
+    # 不启动写入线程，缓冲区不会被取走
+    monkeypatch.setattr(write_pipeline, '_start', lambda: None)
+    monkeypatch.setattr(app_module, 'WRITE_PIPELINE_ENABLED', True)
+    monkeypatch.setattr(app_module, 'write_pipeline', write_pipeline)
+    user_id = make_user()
+
+    assert write_pipeline.submit('comment', (user_id, 'buffered'))
+    assert app_module.write_row('comment', (user_id, 'rejected')) == '服务器繁忙，请稍后重试'
+    assert write_pipeline.stats()['rejected'] == 1 and write_pipeline.stats()['buffered'] == 1